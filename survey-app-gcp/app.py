@@ -1,17 +1,17 @@
 import os
 import sys
-import csv
-import io
+import time
+import atexit
 import argparse
-import gcsfs
+import threading
 import json
 from datetime import datetime
 from flask import Flask, render_template, request, redirect, url_for, \
     session, jsonify, g
 
-from google.cloud import storage
 from http import HTTPStatus
 import uuid
+import objectstore
 
 #############################################################
 ## Initializations
@@ -20,31 +20,61 @@ import uuid
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'auth_not_supported_dummy_secret_key'
 
+# Answers are written as small append-only shard objects under SHARD_PREFIX
+# and appended to CSV_FILE_NAME with server-side compose at least every
+# GCS_MERGE_INTERVAL seconds and before results are read; see objectstore.py.
+# Like the local csv log, every row carries a seq and readers keep the last
+# write per (session_id, q_index).
 CSV_FILE_NAME = 'survey_responses.csv'
 CSV_COLUMN_NAMES = ['session_id', 'start_time', 'q_index', 'question',
-                    'response']
-PROJECT_ID = 'inbuild-dee'
-BUCKET_NAME = 'inbuild-dee.appspot.com'
-
-def create_csv():
-    # create a client
-    storage_client = storage.Client(PROJECT_ID)
+                    'response', 'seq']
+SHARD_PREFIX = 'survey_responses/shards/'
+GCS_MERGE_INTERVAL = float(os.getenv('GCS_MERGE_INTERVAL', '30'))
 
-    # get the bucket
-    bucket = storage_client.get_bucket(BUCKET_NAME)
+# Compact the csv when overwritten rows make up more than this fraction of it.
+# Checked whenever results are read, since that already downloads the file.
+CSV_COMPACT_RATIO = float(os.getenv('CSV_COMPACT_RATIO', '0.5'))
 
-    # create a new blob (i.e. a new file in GCP terms)
-    blob = bucket.blob(CSV_FILE_NAME)
-
-    # Check if the blob already exists
-    if not blob.exists():
-        # initialize csv data
-        csv_data = ','.join(CSV_COLUMN_NAMES) + '\n'
-        blob.upload_from_string(csv_data)
+PROJECT_ID = 'inbuild-dee'
+BUCKET_NAME = 'inbuild-dee.appspot.com'
 
-    print(f"CSV file {CSV_FILE_NAME} created in GCS bucket {BUCKET_NAME}.")
+# /results is served from a process-level cache of the parsed csv. Within
+# RESULTS_CACHE_TTL seconds it's served as is; after that a metadata request
+# checks the object's generation, and a changed object is re-read from the
+# cached offset when it was only appended to. Objects larger than
+# RESULTS_CACHE_MAX_BYTES aren't cached.
+RESULTS_CACHE_TTL = float(os.getenv('RESULTS_CACHE_TTL', '2'))
+RESULTS_CACHE_MAX_BYTES = int(os.getenv('RESULTS_CACHE_MAX_BYTES',
+                              str(64 * 1024 * 1024)))
+
+# Point at a directory to use the filesystem stand-in from fsbucket.py instead
+# of GCS, e.g. for local runs and benchmarks. LOCAL_BUCKET_LATENCY adds a
+# delay in seconds to every local bucket request, to benchmark as if the
+# bucket were remote.
+LOCAL_BUCKET_DIR = os.getenv('LOCAL_BUCKET_DIR')
+LOCAL_BUCKET_LATENCY = float(os.getenv('LOCAL_BUCKET_LATENCY', '0'))
+
+# Write-behind mode: answers are queued in-process and a background thread
+# writes up to WRITE_BATCH_SIZE of them as one shard object, at least every
+# WRITE_FLUSH_INTERVAL seconds. The queue holds at most WRITE_QUEUE_SIZE
+# answers; requests block once it's full. Results reads and shutdown flush
+# the queue. While the bucket is down, answers wait at most
+# WRITE_QUEUE_TIMEOUT seconds for room and then fail, and results reads wait
+# as long for the flush and then go ahead without the queued answers.
+WRITE_BEHIND = os.getenv('WRITE_BEHIND', '0') == '1'
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '100'))
+WRITE_FLUSH_INTERVAL = float(os.getenv('WRITE_FLUSH_INTERVAL', '0.5'))
+WRITE_QUEUE_SIZE = int(os.getenv('WRITE_QUEUE_SIZE', '10000'))
+WRITE_QUEUE_TIMEOUT = float(os.getenv('WRITE_QUEUE_TIMEOUT', '10'))
+
+bucket = objectstore.LazyBucket(BUCKET_NAME, LOCAL_BUCKET_DIR,
+                                LOCAL_BUCKET_LATENCY, PROJECT_ID)
+
+# The answer log, shared with survey-app's object storage backend
+log = objectstore.ObjectLog(bucket, CSV_FILE_NAME, SHARD_PREFIX,
+                            CSV_COLUMN_NAMES, GCS_MERGE_INTERVAL,
+                            CSV_COMPACT_RATIO)
 
-create_csv()
 
 class Question:
 
@@ -102,71 +132,128 @@ questions = [
 ## Storage interface
 #############################################################
 
-def write_response_csv(response):
-    try:
+def render_results_csv(live):
+    responses = [row for (seq, row) in live.values()]
+    responses.sort(key=lambda r: (r['start_time'], r['session_id'], int(r['q_index'])))
+    return render_template('results.html', responses=responses)
+
+
+class ResultsCache:
+
+    # The rendered results page. Within `ttl` seconds it's served as is;
+    # after that log.follow() checks the main object's generation and reads
+    # only what compose appended to it since, so an unchanged log costs a
+    # single metadata request. Logs larger than `max_bytes` aren't cached.
+
+    def __init__(self, log, ttl, max_bytes):
+        self.log = log
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidations = 0
+        self.generation = None
+        self.page = None
+        self.checked = 0.0
+
+    def get(self):
+
+        # None if there is no log yet
+
+        with self.lock:
+            if self.page is not None and time.monotonic() - self.checked \
+                < self.ttl:
+                self.hits += 1
+                return self.page
+            live, total, head, generation = self.log.follow(self.max_bytes)
+            if generation is None:
+                return None
+            if self.page is not None and generation == self.generation:
+                self.revalidations += 1
+                self.checked = time.monotonic()
+                return self.page
+            if self.log.needs_compaction(live, total):
+                self.log.compact()
+            page = render_results_csv(live)
+            if not self.log.following():
+                self.page = None
+                return page
+            (self.generation, self.page) = (generation, page)
+            self.checked = time.monotonic()
+            return self.page
+
+    def stats(self):
+        with self.lock:
+            return dict(self.log.follow_stats(), hits=self.hits,
+                        revalidations=self.revalidations, ttl=self.ttl,
+                        max_bytes=self.max_bytes)
+
+
+results_cache = ResultsCache(log, RESULTS_CACHE_TTL, RESULTS_CACHE_MAX_BYTES)
 
-        # Load existing data
 
-        data = []
-        
-        # create a client
-        storage_client = storage.Client(PROJECT_ID)
+def results_csv():
+    page = results_cache.get()
+    if page is None:
+        return 'No responses available.'
+    return page
 
-        # get the bucket
-        bucket = storage_client.get_bucket(BUCKET_NAME)
 
-        # Get the blob
-        blob = bucket.blob(CSV_FILE_NAME)
-        
-        if blob.exists():
-            # Load the data from GCP bucket into a DictReader
-            csv_file = blob.download_as_text().splitlines()
-            data = list(csv.DictReader(csv_file))
-
-        # Check if response already exists and update it
-
-        existing_response = next((item for item in data
-                                 if item['session_id']
-                                 == response['session_id']
-                                 and item['q_index']
-                                 == str(response['q_index'])), None)
-        if existing_response:
-            existing_response['response'] = response['response']
-        else:
-            data.append(response)
-
-        # Write data back to GCS bucket
-        csv_data = io.StringIO()
-        writer = csv.DictWriter(csv_data, fieldnames=CSV_COLUMN_NAMES)
-        writer.writeheader()
-        writer.writerows(data)
-        blob.upload_from_string(csv_data.getvalue())
-        
-    except csv.Error as e:
-        return f'Error processing CSV file: {e}'
+## Storage interface
+#############################################################
+
+#############################################################
+## Write-behind queue
+#############################################################
 
+write_queue = None
 
-def results_csv():
-    try:
-        gcp_path = f"gs://{BUCKET_NAME}/{CSV_FILE_NAME}"
 
-        client = storage.Client()
-        bucket = client.get_bucket(BUCKET_NAME)
+def write_batch(responses):
 
-        blob = storage.Blob(CSV_FILE_NAME, bucket)
-        content = blob.download_as_text()
+    # The queued answers that weren't written, as the queue expects
 
-        reader = csv.DictReader(content.splitlines())
-        
-        responses = [dict(row) for row in reader]
-        responses.sort(key=lambda r: (r['start_time'], r['session_id'], int(r['q_index'])))
-        
-        return render_template('results.html', responses=responses)
-    except FileNotFoundError:
-        return 'No responses available.'
+    error = log.write_batch(responses)
+    if error is not None:
+        app.logger.error('Failed to write %d queued answers: %s',
+                         len(responses), error)
+        return responses
+    return None
 
 
-## Storage interface
+def start_write_behind():
+    global write_queue
+    write_queue = objectstore.WriteBehindQueue(write_batch,
+            WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL, WRITE_QUEUE_SIZE,
+            app.logger)
+
+
+def restart_write_behind():
+
+    # Threads don't survive fork, so gunicorn --preload workers start their
+    # own flusher, on a queue of their own since the parent's flusher may
+    # have held its locks. Answers queued before the fork are the parent's.
+
+    if write_queue is not None:
+        start_write_behind()
+
+
+def close_write_behind():
+    if write_queue is not None:
+        write_queue.close()
+
+
+def flush_writes():
+    if write_queue is not None and not write_queue.flush(WRITE_QUEUE_TIMEOUT):
+        app.logger.warning('Reading results without the answers still queued')
+
+
+if WRITE_BEHIND:
+    start_write_behind()
+    atexit.register(close_write_behind)
+os.register_at_fork(after_in_child=restart_write_behind)
+
+## Write-behind queue
 #############################################################
 
 #############################################################
@@ -181,9 +268,34 @@ def start():
 
 @app.route('/results', methods=['GET'])
 def results():
+    flush_writes()
     return results_csv()
 
 
+@app.route('/_ah/warmup', methods=['GET'])
+def warmup():
+
+    # App Engine calls this before routing traffic to a new instance (see
+    # inbound_services in app.yaml), so the first survey-taker doesn't pay
+    # for the client and the bucket bootstrap
+
+    bucket.get()
+    log.ensure()
+    return ('', HTTPStatus.NO_CONTENT)
+
+
+@app.route('/results/cache', methods=['GET'])
+def results_cache_stats():
+    return jsonify(results_cache.stats())
+
+
+@app.route('/write-queue', methods=['GET'])
+def write_queue_stats():
+    if write_queue is None:
+        return jsonify({'write_behind': False})
+    return jsonify(dict(write_queue.stats(), write_behind=True))
+
+
 @app.route('/reset', methods=['POST'])
 def reset():
 
@@ -269,7 +381,9 @@ def reset_session():
 
 
 def write_response(response):
-    return write_response_csv(response)
+    if write_queue is not None:
+        return write_queue.put(response, WRITE_QUEUE_TIMEOUT)
+    return log.write_answer(response)
 
 
 def parse_and_set_answer(question, q_index, answer):
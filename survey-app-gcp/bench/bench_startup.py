@@ -0,0 +1,114 @@
+# Cold start benchmark of an instance, against the filesystem bucket
+# stand-in (fsbucket.py).
+#
+# Seeds the bucket with a --rows answer log, as a running app would have left
+# it, then starts --runs fresh interpreters, as App Engine does for a new
+# instance. Each one times importing app (what gunicorn does before it can
+# serve anything), the warmup request when --warmup is given, the first
+# answer and the first results page, and counts the bucket requests made in
+# each phase. LOCAL_BUCKET_LATENCY (seconds per bucket request) makes those
+# cost what a round trip to GCS would. Reports the median of every phase.
+#
+# python3 bench/bench_startup.py --runs=10 --rows=100000
+# LOCAL_BUCKET_LATENCY=0.03 python3 bench/bench_startup.py --warmup
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in each fresh interpreter. Counts bucket requests through the
+# stand-in's latency hook, which every request goes through. The hook is only
+# put in after app is imported and timed, since importing fsbucket first
+# would take its imports out of the import phase; app only loads fsbucket
+# with its first bucket call, so if it isn't loaded yet the import made no
+# requests.
+INSTANCE = '''
+import sys, json, time
+sys.path.insert(0, {app_dir!r})
+started = time.perf_counter()
+import app
+phases = {{'import': {{'ms': (time.perf_counter() - started) * 1000,
+          'requests': (None if 'fsbucket' in sys.modules else 0)}}}}
+import fsbucket
+requests = [0]
+wait = fsbucket.LocalBucket.wait
+
+
+def counted_wait(self):
+    requests[0] += 1
+    wait(self)
+
+
+fsbucket.LocalBucket.wait = counted_wait
+
+
+def timed(phase, fn):
+    (started, before) = (time.perf_counter(), requests[0])
+    fn()
+    phases[phase] = {{'ms': (time.perf_counter() - started) * 1000,
+                     'requests': requests[0] - before}}
+
+
+client = app.app.test_client()
+if {warmup!r}:
+    timed('warmup', lambda: client.get('/_ah/warmup'))
+timed('first answer', lambda: (client.get('/'), client.post('/question',
+      data={{'response': 'Bench', 'action': 'Next'}})))
+timed('first results', lambda: client.get('/results'))
+print(json.dumps(phases))
+'''
+
+
+def seed(bucket_dir, rows):
+    sys.path.insert(0, APP_DIR)
+    import fsbucket
+    columns = ['session_id', 'start_time', 'q_index', 'question', 'response',
+               'seq']
+    lines = [','.join(columns)]
+    for n in range(rows):
+        lines.append('seed{:08d},2023-01-01 00:00:00,{},Question {},'
+                     'answer,{}'.format(n // 6, n % 6, n % 6, n + 1))
+    fsbucket.LocalBucket(bucket_dir).blob('survey_responses.csv'
+            ).upload_from_string('\n'.join(lines) + '\n')
+
+
+def run_instance(bucket_dir, warmup):
+    code = INSTANCE.format(app_dir=APP_DIR, warmup=warmup)
+    env = dict(os.environ, LOCAL_BUCKET_DIR=bucket_dir)
+    output = subprocess.check_output([sys.executable, '-c', code],
+            cwd=APP_DIR, env=env, stderr=subprocess.DEVNULL)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='answers already in the bucket')
+    parser.add_argument('--warmup', action='store_true',
+                        help='send /_ah/warmup before the first request')
+    args = parser.parse_args()
+
+    bucket_dir = tempfile.mkdtemp(prefix='survey-startup-')
+    seed(bucket_dir, args.rows)
+    runs = [run_instance(bucket_dir, args.warmup) for _ in range(args.runs)]
+
+    print('{} instances, {} rows in the bucket, {}s per bucket request'
+          .format(args.runs, args.rows, os.getenv('LOCAL_BUCKET_LATENCY',
+          '0')))
+    print('  {:<14} {:>10} {:>10}'.format('phase', 'median ms', 'requests'))
+    for phase in runs[0]:
+        requests = runs[0][phase]['requests']
+        print('  {:<14} {:>10.1f} {:>10}'.format(phase,
+              statistics.median(run[phase]['ms'] for run in runs),
+              ('?' if requests is None else requests)))
+
+
+if __name__ == '__main__':
+    main()
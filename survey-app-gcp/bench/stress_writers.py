@@ -0,0 +1,113 @@
+# Multi-process stress test for the sharded object-store writer.
+#
+# Runs against the filesystem bucket stand-in (fsbucket.py), which enforces
+# the same generation preconditions as GCS. N worker processes, like several
+# App Engine instances, each run complete surveys through the Flask test
+# client while another process keeps merging shards into the main object.
+# Every survey goes back once to change an answer. At the end every answer of
+# every survey must be present with its final value.
+#
+# python3 bench/stress_writers.py --workers=8 --sessions=50
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import multiprocessing
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ANSWERS = ['{name}', 'red', 'Dog', 'Apple', '3', '4']
+FINAL_COLOR = 'blue'
+
+
+def load_app():
+    sys.path.insert(0, APP_DIR)
+    import app
+    return app
+
+
+def run_surveys(worker, sessions):
+    app = load_app()
+    client = app.app.test_client()
+    for n in range(sessions):
+        name = 'w{}-s{}'.format(worker, n)
+        client.get('/')
+        client.post('/question', data={'response': name, 'action': 'Next'})
+        client.post('/question', data={'response': 'red', 'action': 'Next'})
+
+        # go back from the pet question and change the color
+
+        client.post('/question', data={'response': 'Cat', 'action': 'Back'})
+        client.post('/question', data={'response': FINAL_COLOR,
+                    'action': 'Next'})
+        for answer in ANSWERS[2:]:
+            client.post('/question', data={'response': answer,
+                        'action': 'Next'})
+
+    # multiprocessing skips atexit handlers, so flush write-behind explicitly
+
+    app.flush_writes()
+
+
+def merge_forever(stop):
+    app = load_app()
+    while not stop.is_set():
+        app.log.merge()
+        time.sleep(0.01)
+
+
+def check(app, workers, sessions):
+    live, total, generation = app.log.read()
+    by_session = {}
+    for (seq, row) in live.values():
+        by_session.setdefault(row['session_id'], {})[int(row['q_index'])] = \
+            row['response']
+    names = set()
+    errors = 0
+    for answers in by_session.values():
+        names.add(answers.get(0))
+        if len(answers) != len(ANSWERS) or answers[1] != FINAL_COLOR:
+            errors += 1
+    expected = set('w{}-s{}'.format(w, n) for w in range(workers)
+                   for n in range(sessions))
+    return len(expected - names), errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--sessions', type=int, default=50,
+                        help='surveys completed per worker')
+    args = parser.parse_args()
+
+    os.environ['LOCAL_BUCKET_DIR'] = tempfile.mkdtemp(prefix='survey-bucket-')
+    ctx = multiprocessing.get_context('spawn')
+
+    started = time.time()
+    procs = [ctx.Process(target=run_surveys, args=(w, args.sessions))
+             for w in range(args.workers)]
+    stop = ctx.Event()
+    merger = ctx.Process(target=merge_forever, args=(stop, ))
+    for p in procs + [merger]:
+        p.start()
+    for p in procs:
+        p.join()
+    stop.set()
+    merger.join()
+    elapsed = time.time() - started
+
+    failed = [p.exitcode for p in procs + [merger] if p.exitcode != 0]
+    missing, errors = check(load_app(), args.workers, args.sessions)
+    answers = args.workers * args.sessions * (len(ANSWERS) + 2)
+    print('{} workers, {} answers in {:.2f}s ({:.0f}/s)'.format(args.workers,
+          answers, elapsed, answers / elapsed))
+    print('missing surveys: {}, incomplete or stale surveys: {}, '
+          'crashed workers: {}'.format(missing, errors, len(failed)))
+    if missing or errors or failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+# Filesystem stand-in for a GCS bucket, for running the app and its
+# benchmarks locally without GCP credentials. Implements just the parts of
+# google.cloud.storage's Bucket and Blob that app.py uses, including
+# generation-match preconditions, so conflicting writers behave like they do
+# against GCS. Objects are plain files under the bucket directory; an flock()
+# on a lock file makes each conditional operation atomic across processes.
+# `latency` adds a fixed delay to every request, to stand in for the round
+# trip to GCS in benchmarks.
+#
+# LOCAL_BUCKET_DIR=/tmp/bucket python3 app.py
+
+import os
+import time
+import fcntl
+import uuid
+from contextlib import contextmanager
+
+try:
+    from google.api_core.exceptions import NotFound, PreconditionFailed
+except ImportError:
+
+    class NotFound(Exception):
+        pass
+
+    class PreconditionFailed(Exception):
+        pass
+
+
+class LocalBucket:
+
+    def __init__(self, root, latency=0.0):
+        self.root = root
+        self.latency = latency
+        self.name = os.path.basename(os.path.normpath(root))
+        os.makedirs(root, exist_ok=True)
+
+    def blob(self, name):
+        return LocalBlob(name, self)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def list_blobs(self, prefix=''):
+        self.wait()
+        blobs = []
+        for (dir_path, dir_names, file_names) in os.walk(self.root):
+            for file_name in file_names:
+                name = os.path.relpath(os.path.join(dir_path, file_name),
+                                       self.root)
+                if name.startswith(prefix) and not name.startswith('.') \
+                    and not name.endswith('.tmp'):
+                    blobs.append(self.blob(name))
+        return sorted(blobs, key=lambda blob: blob.name)
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    @contextmanager
+    def lock(self):
+        self.wait()
+        with open(os.path.join(self.root, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class LocalBlob:
+
+    def __init__(self, name, bucket):
+        self.name = name
+        self.bucket = bucket
+        self.generation = None
+        self.size = None
+
+    def current_generation(self):
+
+        # The file's mtime in ns plays the role of the object generation;
+        # 0 means the object doesn't exist, as in GCS preconditions.
+
+        try:
+            return os.stat(self.bucket.path(self.name)).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def check(self, if_generation_match):
+        if if_generation_match is not None and if_generation_match \
+            != self.current_generation():
+            raise PreconditionFailed('generation mismatch for {}'.format(
+                                     self.name))
+
+    def write(self, data):
+
+        # Filesystem timestamps can be coarser than back-to-back writes, so
+        # the new generation is set explicitly and always moves forward.
+
+        path = self.bucket.path(self.name)
+        generation = max(time.time_ns(), self.current_generation() + 1)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.utime(tmp_path, ns=(generation, generation))
+        os.replace(tmp_path, path)
+        self.reload()
+
+    def exists(self):
+        return self.current_generation() != 0
+
+    def reload(self):
+        path = self.bucket.path(self.name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            raise NotFound(self.name)
+        self.generation = stat.st_mtime_ns
+        self.size = stat.st_size
+
+    def upload_from_string(self, data, if_generation_match=None):
+        if isinstance(data, str):
+            data = data.encode()
+        with self.bucket.lock():
+            self.check(if_generation_match)
+            self.write(data)
+
+    def download_as_bytes(self, start=None, end=None,
+                          if_generation_match=None):
+
+        # start and end are byte offsets; end is inclusive, as in GCS
+
+        with self.bucket.lock():
+            self.check(if_generation_match)
+            try:
+                with open(self.bucket.path(self.name), 'rb') as f:
+                    f.seek(start or 0)
+                    data = (f.read() if end is None else f.read(end + 1
+                            - (start or 0)))
+            except FileNotFoundError:
+                raise NotFound(self.name)
+            self.reload()
+        return data
+
+    def download_as_text(self, start=None, end=None,
+                         if_generation_match=None):
+        return self.download_as_bytes(start, end,
+                                      if_generation_match).decode()
+
+    def compose(self, sources, if_generation_match=None):
+        with self.bucket.lock():
+            self.check(if_generation_match)
+            parts = []
+            for source in sources:
+                try:
+                    with open(self.bucket.path(source.name), 'rb') as f:
+                        parts.append(f.read())
+                except FileNotFoundError:
+                    raise NotFound(source.name)
+            self.write(b''.join(parts))
+
+    def delete(self, if_generation_match=None):
+        with self.bucket.lock():
+            self.check(if_generation_match)
+            try:
+                os.remove(self.bucket.path(self.name))
+            except FileNotFoundError:
+                raise NotFound(self.name)
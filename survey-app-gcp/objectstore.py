@@ -0,0 +1,599 @@
+# The answer log kept as objects in a GCS bucket, shared by this app and the
+# object storage backend of survey-app, whose objectstore.py and fsbucket.py
+# are symlinks to these, so each app's directory deploys on its own. Both
+# apps' write-behind queues are the WriteBehindQueue at the end.
+#
+# Answers are written as small append-only shard objects, one per write (or
+# write-behind batch), created with ifGenerationMatch=0 so they never
+# overwrite anything. Shards are appended to the main csv object with
+# server-side compose, guarded by its generation, at least every
+# merge_interval seconds and before the log is read. Every row carries a seq
+# and readers keep the last write per (session_id, q_index).
+#
+# Only the standard library is imported here. The bucket client, or the
+# filesystem stand-in from fsbucket.py, is loaded on first use, and so are
+# the errors bucket calls raise, which LazyBucket keeps next to the bucket:
+# google.api_core's for GCS, fsbucket's for the stand-in. Importing
+# google.api_core loads grpc, about half of a cold import.
+
+import io
+import csv
+import time
+import uuid
+import queue
+import threading
+
+# GCS compose takes at most 32 source objects
+COMPOSE_MAX_SOURCES = 32
+
+
+def next_seq():
+
+    # Nanosecond timestamps keep increasing across restarts and are unique
+    # enough across instances, unlike an in-memory counter.
+
+    return time.time_ns()
+
+
+def replay_csv_log(rows, keep=None, live=None):
+
+    # Replay log rows and keep the last write per (session_id, q_index),
+    # on top of the `live` rows of an earlier replay if given.
+    # Returns the live rows and the total number of rows replayed.
+    # `keep` filters rows on fields that never change for a key (session and
+    # start time), so dropping rows early can't change which write wins.
+
+    live = ({} if live is None else live)
+    total = 0
+    for row in rows:
+        total += 1
+        if keep is not None and not keep(row):
+            continue
+        seq = int(row.get('seq') or 0)
+        key = (row['session_id'], row['q_index'])
+        existing = live.get(key)
+
+        # ties go to the later row in the log
+
+        if existing is None or seq >= existing[0]:
+            live[key] = (seq, row)
+    return live, total
+
+
+def complete_rows(data):
+
+    # The length of the complete csv rows at the start of `data`. Text
+    # answers can hold newlines inside quotes, so a row ends at the last
+    # newline with an even number of quotes before it.
+
+    end = data.rfind(b'\n') + 1
+    while end and data.count(b'"', 0, end) % 2:
+        end = data.rfind(b'\n', 0, end - 1) + 1
+    return end
+
+
+class LazyBucket:
+
+    # One client and bucket handle per process, made on first use so
+    # importing the app neither loads google.cloud.storage nor looks up
+    # credentials. client.bucket() doesn't make a request, unlike
+    # get_bucket(). With local_dir set, the filesystem stand-in is used
+    # instead, `latency` seconds per request. `errors` is the (NotFound,
+    # PreconditionFailed) classes that bucket raises, set by get().
+
+    def __init__(self, name, local_dir=None, latency=0.0, project=None):
+        self.name = name
+        self.local_dir = local_dir
+        self.latency = latency
+        self.project = project
+        self.lock = threading.Lock()
+        self.errors = None
+        self.bucket = None
+
+    def get(self):
+        if self.bucket is None:
+            with self.lock:
+                if self.bucket is None:
+                    if self.local_dir:
+                        import fsbucket
+                        self.errors = (fsbucket.NotFound,
+                                       fsbucket.PreconditionFailed)
+                        self.bucket = fsbucket.LocalBucket(self.local_dir,
+                                self.latency)
+                    else:
+                        from google.cloud import storage
+                        from google.api_core.exceptions import NotFound, \
+                            PreconditionFailed
+                        self.errors = (NotFound, PreconditionFailed)
+                        self.bucket = \
+                            storage.Client(self.project).bucket(self.name)
+        return self.bucket
+
+
+class ObjectLog:
+
+    # The log of one survey: the main object `object_name` and its shards
+    # under `shard_prefix` in `bucket`, a LazyBucket. write_answer(),
+    # write_batch() and compact() are named as in survey-app's
+    # StorageBackend.
+
+    # Bytes of the main object re-read before the appended ones, to check
+    # it was only appended to
+    FOLLOW_OVERLAP = 1024
+
+    def __init__(
+        self,
+        bucket,
+        object_name,
+        shard_prefix,
+        columns,
+        merge_interval,
+        compact_ratio,
+        followers=(),
+        ):
+
+        self.bucket = bucket
+        self.object_name = object_name
+        self.shard_prefix = shard_prefix
+        self.columns = columns
+        self.merge_interval = merge_interval
+        self.compact_ratio = compact_ratio
+
+        # State carried forward with the followed rows, e.g. summary counts:
+        # objects with reset(), and extend(rows) which is handed the rows
+        # follow() reads in log order
+        self.followers = list(followers)
+        self.ready = False
+        self.ready_lock = threading.Lock()
+        self.last_merge = time.monotonic()
+
+        # Shards this process wrote since its last merge. Other instances
+        # merge their own at least every merge_interval seconds.
+        self.unmerged_shards = 0
+
+        # Held while the followed rows change. Callers that use the live
+        # rows follow() returns while other threads may follow too hold it
+        # around both.
+        self.follow_lock = threading.RLock()
+        self.partial_refreshes = 0
+        self.full_refreshes = 0
+        self.bypassed = 0
+        self.reset_follow()
+
+    def ensure(self):
+
+        # Bootstrap the main object once per process, before the first
+        # merge or read; writes only upload shards and don't need it. Safe
+        # to repeat or race with other instances.
+
+        if not self.ready:
+            with self.ready_lock:
+                if not self.ready:
+                    self.setup()
+                    self.ready = True
+
+    def setup(self):
+        blob = self.bucket.get().blob(self.object_name)
+        (NotFound, PreconditionFailed) = self.bucket.errors
+
+        # Create it only if nobody else has; another instance may be racing
+        # us
+
+        header = ','.join(self.columns) + '\n'
+        try:
+            blob.upload_from_string(header, if_generation_match=0)
+            return
+        except PreconditionFailed:
+            pass
+
+        # Logs written before the shard log have no seq column, so shard
+        # rows can't be appended to them. Rewrite them once with the current
+        # header. Checking that only needs the first line (with a \r\n from
+        # compaction), not the whole log.
+
+        head = blob.download_as_bytes(end=len(header)).decode(errors='ignore')
+        if next(csv.reader(io.StringIO(head)), None) != self.columns:
+            self.write_compacted(*self.download())
+
+    def format_rows(self, rows, header=False):
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=self.columns,
+                                extrasaction='ignore')
+        if header:
+            writer.writeheader()
+        writer.writerows(rows)
+        return buf.getvalue()
+
+    def write_answer(self, response):
+        return self.write_batch([response])
+
+    def write_batch(self, responses):
+
+        # One new shard object per batch: no download, and O(batch) bytes up
+
+        try:
+            rows = [dict(response, seq=next_seq()) for response in responses]
+            name = '{}{:020d}-{}.csv'.format(self.shard_prefix,
+                    rows[0]['seq'], uuid.uuid4().hex)
+            self.bucket.get().blob(name).upload_from_string(
+                self.format_rows(rows), if_generation_match=0)
+        except csv.Error as e:
+            return 'Error processing CSV file: {}'.format(e)
+        self.unmerged_shards += 1
+        if time.monotonic() - self.last_merge > self.merge_interval:
+            self.merge()
+
+    def merge(self):
+
+        # Append pending shards to the main object with server-side compose.
+        # The generation precondition makes concurrent mergers safe: the
+        # loser fails without writing and leaves the shards to the winner. A
+        # shard that gets composed twice only duplicates rows, which
+        # last-write-wins drops.
+
+        self.ensure()
+        self.last_merge = time.monotonic()
+        self.unmerged_shards = 0
+        bucket = self.bucket.get()
+        (NotFound, PreconditionFailed) = self.bucket.errors
+        shards = list(bucket.list_blobs(prefix=self.shard_prefix))
+        main = bucket.blob(self.object_name)
+        merged = 0
+        step = COMPOSE_MAX_SOURCES - 1
+        for i in range(0, len(shards), step):
+            chunk = shards[i:i + step]
+            main.reload()
+            try:
+                main.compose([main] + chunk,
+                             if_generation_match=main.generation)
+            except (PreconditionFailed, NotFound):
+                break
+            for shard in chunk:
+                try:
+                    shard.delete()
+                except NotFound:
+                    pass
+            merged += len(chunk)
+        return merged
+
+    def merge_own(self):
+
+        # Merge this process's shards, so it reads its own writes
+
+        if self.unmerged_shards:
+            self.merge()
+
+    def download(self, keep=None):
+
+        # The live rows, the number of rows and the generation of the main
+        # object as it is now
+
+        blob = self.bucket.get().blob(self.object_name)
+        (NotFound, PreconditionFailed) = self.bucket.errors
+        try:
+            content = blob.download_as_text()
+        except NotFound:
+            return {}, 0, None
+        live, total = replay_csv_log(csv.DictReader(io.StringIO(content)),
+                                     keep)
+        return live, total, blob.generation
+
+    def read(self, keep=None):
+        self.ensure()
+        self.merge_own()
+        return self.download(keep)
+
+    def reset_follow(self):
+        self.followed = (None, 0, b'', {}, 0, 0)
+        for follower in self.followers:
+            follower.reset()
+
+    def following(self):
+
+        # Whether the last follow() kept the rows it read
+
+        return self.followed[0] is not None
+
+    def follow(self, max_bytes=None):
+
+        # The live rows of the main object, carried between calls: an
+        # unchanged generation costs a metadata request, one that only grew
+        # by compose a ranged read of the appended bytes, and anything else
+        # a full read. A main object over `max_bytes` is read in full every
+        # time rather than kept. Returns the live rows, the number of rows,
+        # the highest seq in them and the generation, None if there is no
+        # main object.
+
+        self.ensure()
+        self.merge_own()
+        blob = self.bucket.get().blob(self.object_name)
+        (NotFound, PreconditionFailed) = self.bucket.errors
+        with self.follow_lock:
+            (generation, offset, tail, live, total, head) = self.followed
+            try:
+                blob.reload()
+                if blob.generation == generation:
+                    return live, total, head, generation
+                if max_bytes is not None and blob.size > max_bytes:
+                    self.bypassed += 1
+                    self.reset_follow()
+                    return self.download_head()
+                data = None
+                if generation is not None and blob.size >= offset:
+                    data = blob.download_as_bytes(start=offset - len(tail),
+                            if_generation_match=blob.generation)
+                    data = (data[len(tail):] if data.startswith(tail)
+                            else None)
+                if data is None:
+                    self.full_refreshes += 1
+                    (offset, tail, live, total, head) = (0, b'', {}, 0, 0)
+                    data = blob.download_as_bytes(
+                        if_generation_match=blob.generation)
+                else:
+                    self.partial_refreshes += 1
+            except NotFound:
+                self.reset_follow()
+                return {}, 0, 0, None
+            except PreconditionFailed:
+
+                # changed again since the reload; read it uncached this time
+
+                self.reset_follow()
+                return self.download_head()
+            end = complete_rows(data)
+            rows = [dict(zip(self.columns, values)) for values in
+                    csv.reader(io.StringIO(data[:end].decode(), newline=''))]
+            if offset == 0:
+                rows = rows[1:]
+            live, added = replay_csv_log(rows, live=live)
+            for follower in self.followers:
+                if offset == 0:
+                    follower.reset()
+                follower.extend(rows)
+            head = max([head] + [int(row.get('seq') or 0) for row in rows])
+            self.followed = (blob.generation, offset + end, (tail
+                             + data[:end])[-self.FOLLOW_OVERLAP:], live,
+                             total + added, head)
+            return live, total + added, head, blob.generation
+
+    def download_head(self):
+        (live, total, generation) = self.download()
+        return live, total, max([seq for (seq, row) in live.values()]
+                                + [0]), generation
+
+    def follow_stats(self):
+        with self.follow_lock:
+            (generation, offset, tail, live, total, head) = self.followed
+            return {
+                'partial_refreshes': self.partial_refreshes,
+                'full_refreshes': self.full_refreshes,
+                'bypassed': self.bypassed,
+                'cached_bytes': offset,
+                'rows': total,
+                'live_rows': len(live),
+                }
+
+    def version(self):
+
+        # The main object's generation, which changes with every merge and
+        # compaction, or None if there is none
+
+        self.merge_own()
+        blob = self.bucket.get().blob(self.object_name)
+        (NotFound, PreconditionFailed) = self.bucket.errors
+        try:
+            blob.reload()
+        except NotFound:
+            return None
+        return blob.generation
+
+    def needs_compaction(self, live, total):
+
+        # Overwritten rows make up more than compact_ratio of the log
+
+        return bool(total) and (total - len(live)) / total \
+            > self.compact_ratio
+
+    def write_compacted(self, live, total, generation, keep=None):
+
+        # Rewrite the main object to just the live rows `keep` passes,
+        # unless it changed since it was read; the next read will try again.
+        # Returns the number of rows dropped.
+
+        blob = self.bucket.get().blob(self.object_name)
+        (NotFound, PreconditionFailed) = self.bucket.errors
+        rows = [row for (seq, row) in sorted(live.values(),
+                key=lambda item: item[0]) if keep is None or keep(row)]
+        try:
+            blob.upload_from_string(
+                self.format_rows(rows, header=True),
+                if_generation_match=generation)
+        except PreconditionFailed:
+            return 0
+        return total - len(rows)
+
+    def compact(self, keep=None):
+        (live, total, generation) = self.read()
+        if generation is None:
+            return 0
+        return self.write_compacted(live, total, generation, keep)
+
+
+class WriteBehindQueue:
+
+    # Answers queued in-process and written by a background thread in
+    # batches of up to `batch_size`, at least every `flush_interval`
+    # seconds. write_batch(items) returns the items it didn't write, having
+    # logged why, or None; those are retried. Once `maxsize` items are
+    # queued, put() blocks up to its timeout.
+
+    # Seconds between attempts at a batch that failed, doubling up to
+    # MAX_RETRY_DELAY
+    RETRY_DELAY = 1.0
+    MAX_RETRY_DELAY = 30.0
+
+    def __init__(
+        self,
+        write_batch,
+        batch_size,
+        flush_interval,
+        maxsize,
+        logger,
+        ):
+
+        self.write_batch = write_batch
+        self.logger = logger
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize)
+        self.flush_requested = threading.Event()
+        self.closing = threading.Event()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.written = 0
+        self.errors = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.flush_timeouts = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                name='write-behind')
+        self.thread.start()
+
+    def put(self, item, timeout=None):
+
+        # An error rather than waiting more than `timeout` seconds for room,
+        # e.g. while storage is down and batches are being retried
+
+        try:
+            self.queue.put(item, timeout=timeout)
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return 'Write queue is full.'
+        return None
+
+    def flush(self, timeout=None):
+
+        # Cut the current batch short and wait for everything queued so far,
+        # up to `timeout` seconds. False if that wasn't all written in time.
+
+        self.flush_requested.set()
+        deadline = (None if timeout is None else time.monotonic() + timeout)
+        flushed = True
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = (None if deadline is None else deadline
+                             - time.monotonic())
+                if remaining is not None and remaining <= 0:
+                    flushed = False
+                    break
+                self.queue.all_tasks_done.wait(remaining)
+        self.flush_requested.clear()
+        if not flushed:
+
+            # stats() takes self.lock before the queue's, so not in there
+
+            with self.lock:
+                self.flush_timeouts += 1
+        return flushed
+
+    def close(self):
+
+        # A batch that fails from here on is dropped instead of retried, so
+        # shutdown can't hang on storage that is down
+
+        self.closing.set()
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout <= 0 or self.flush_requested.is_set():
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def write(self, items):
+
+        # The items that weren't written. write_batch returns those, having
+        # logged why, and None when it wrote them all.
+
+        try:
+            return self.write_batch(items) or []
+        except Exception:
+            self.logger.exception('Failed to write %d queued answers',
+                                 len(items))
+            return items
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            items = [item for item in batch if item is not None]
+
+            # Answers that failed are retried, backing off up to
+            # MAX_RETRY_DELAY, until they are written; flush() waits for
+            # them meanwhile
+
+            delay = self.RETRY_DELAY
+            written = 0
+            started = time.monotonic()
+            while items:
+                unwritten = self.write(items)
+                written += len(items) - len(unwritten)
+                items = unwritten
+                if not items:
+                    break
+                with self.lock:
+                    self.errors += 1
+                if self.closing.is_set():
+                    self.logger.error('Dropped %d queued answers on shutdown',
+                                     len(items))
+                    with self.lock:
+                        self.dropped += len(items)
+                    break
+                self.closing.wait(delay)
+                delay = min(delay * 2, self.MAX_RETRY_DELAY)
+                started = time.monotonic()
+            elapsed = time.monotonic() - started
+            if written:
+                with self.lock:
+                    self.batches += 1
+                    self.written += written
+                    self.last_flush_seconds = elapsed
+                    self.max_flush_seconds = max(self.max_flush_seconds,
+                            elapsed)
+                    self.total_flush_seconds += elapsed
+            for _ in batch:
+                self.queue.task_done()
+            if batch[-1] is None:
+                return
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'queue_size': self.queue.maxsize,
+                'batch_size': self.batch_size,
+                'flush_interval': self.flush_interval,
+                'batches': self.batches,
+                'written': self.written,
+                'errors': self.errors,
+                'dropped': self.dropped,
+                'rejected': self.rejected,
+                'flush_timeouts': self.flush_timeouts,
+                'last_flush_seconds': self.last_flush_seconds,
+                'max_flush_seconds': self.max_flush_seconds,
+                'mean_flush_seconds': (self.total_flush_seconds
+                        / self.batches if self.batches else 0.0),
+                }
@@ -1,14 +1,39 @@
+import io
 import os
+import abc
 import sys
 import csv
+import json
+import re
+import time
+import fcntl
+import gzip
+import heapq
+import bisect
+import base64
+import itertools
+import collections
+import atexit
 import sqlite3
+import threading
+import hashlib
 import argparse
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import markupsafe
+import yaml
+import numpy
 from flask import Flask, render_template, request, redirect, url_for, \
-    session, jsonify, g
+    session, jsonify, stream_template, stream_with_context, Response, abort
+from flask.sessions import SessionInterface, SessionMixin, \
+    SecureCookieSessionInterface
+from flask.json.tag import TaggedJSONSerializer
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict
 
 from http import HTTPStatus
 import uuid
+import prometheus_client
 
 #############################################################
 ## Initializations
@@ -18,36 +43,361 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = 'auth_not_supported_dummy_secret_key'
 
 # Enabling support for both csvs and a SQLLite database. 
-# CSVs are a highly inefficient way of updating answer changes. But leaving the
-# initial csv implementation in here because they're readable and easier to debug.
-CSV_FILE_NAME = '/tmp/survey_responses.csv'
+# The csv is an append-only log: every answer (including changed answers) is a
+# new row tagged with a sequence number, and readers keep the last write per
+# (session_id, q_index). Overwritten rows are dropped by compact_csv().
+CSV_FILE_NAME = os.getenv('CSV_FILE', '/tmp/survey_responses.csv')
 CSV_COLUMN_NAMES = ['session_id', 'start_time', 'q_index', 'question',
-                    'response']
-DATABASE = '/tmp/responses.db'
+                    'response', 'seq']
+
+# Compact the csv when overwritten rows make up more than this fraction of it.
+# Checked whenever results are read, since that already scans the whole file.
+CSV_COMPACT_RATIO = float(os.getenv('CSV_COMPACT_RATIO', '0.5'))
+
+# The csv log only holds sessions whose start_time falls in a SEGMENT_PERIOD
+# ('day' or 'hour') that ended less than SEGMENT_GRACE seconds ago, so late
+# answers to a session still land in the log. Compaction moves the sessions
+# of closed periods into one archive segment per period: gzipped columns,
+# listed with their start_time range in an index so time-range reads skip
+# the segments they don't overlap. Sessions that started more than
+# RETENTION_DAYS ago are dropped by compaction (0 keeps everything).
+SEGMENT_PERIOD = os.getenv('SEGMENT_PERIOD', 'day')
+SEGMENT_GRACE = float(os.getenv('SEGMENT_GRACE', '86400'))
+RETENTION_DAYS = float(os.getenv('RETENTION_DAYS', '0'))
+
+# gunicorn runs several worker processes against the same files. Csv writers
+# serialize on an flock()ed side file (the csv itself is replaced on compaction,
+# so it can't hold the lock). SQLite runs in WAL mode so readers don't block
+# the writer, and waits up to DB_BUSY_TIMEOUT seconds for the write lock
+# instead of failing with "database is locked".
+DATABASE = os.getenv('DATABASE', '/tmp/responses.db')
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', '30'))
+
+# Write-behind mode: answers are queued in-process and a background thread
+# writes them in batches of up to WRITE_BATCH_SIZE, at least every
+# WRITE_FLUSH_INTERVAL seconds. The queue holds at most WRITE_QUEUE_SIZE answers;
+# requests block once it's full. Results reads and shutdown flush the queue.
+# While storage is down, answers wait at most WRITE_QUEUE_TIMEOUT seconds for
+# room and then fail, and reads wait as long for the flush and then go ahead
+# without the queued answers.
+WRITE_BEHIND = os.getenv('WRITE_BEHIND', '0') == '1'
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '100'))
+WRITE_FLUSH_INTERVAL = float(os.getenv('WRITE_FLUSH_INTERVAL', '0.5'))
+WRITE_QUEUE_SIZE = int(os.getenv('WRITE_QUEUE_SIZE', '10000'))
+WRITE_QUEUE_TIMEOUT = float(os.getenv('WRITE_QUEUE_TIMEOUT', '10'))
+
+# Where survey sessions live. 'cookie' keeps the whole session in Flask's
+# signed cookie. 'memory' (an LRU of SESSION_MAX_ENTRIES, single process only)
+# and 'sqlite' (SESSION_DATABASE, shared by all workers) keep it server-side
+# and the cookie only carries the signed sid. Server-side sessions expire
+# SESSION_TTL seconds after their last write.
+SESSION_STORE = os.getenv('SESSION_STORE', 'cookie')
+SESSION_DATABASE = os.getenv('SESSION_DATABASE', '/tmp/sessions.db')
+SESSION_TTL = int(os.getenv('SESSION_TTL', '86400'))
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', '10000'))
+
+# Answer dedup: a submitted answer that is the same as the last one written
+# for its session and question in the past ANSWER_DEDUP_WINDOW seconds, e.g.
+# from a double-clicked Next or a retried POST, isn't written again. 'memory'
+# keeps the window per worker process (ANSWER_DEDUP_MAX_ENTRIES answers) and,
+# as it can't see other workers' writes, only skips repeats from the same
+# page load, told apart by a nonce the page adds to the form. 'sqlite' shares
+# the window between workers in ANSWER_DEDUP_DATABASE. 'off' writes them all.
+ANSWER_DEDUP = os.getenv('ANSWER_DEDUP', 'memory')
+ANSWER_DEDUP_WINDOW = int(os.getenv('ANSWER_DEDUP_WINDOW', '600'))
+ANSWER_DEDUP_MAX_ENTRIES = int(os.getenv('ANSWER_DEDUP_MAX_ENTRIES',
+                               '100000'))
+ANSWER_DEDUP_DATABASE = os.getenv('ANSWER_DEDUP_DATABASE',
+                                  '/tmp/answer_dedup.db')
+
+# Client survey mode: /survey sends the whole survey definition with one
+# page and runs Back/Next in the browser, which posts the answers to
+# /api/answers in checkpoints: once SURVEY_CHECKPOINT_ANSWERS answers are
+# unsent, SURVEY_CHECKPOINT_SECONDS after the oldest unsent one, when the
+# page is hidden or closed, and with the last answer. SURVEY_MODE=client
+# makes / start surveys there instead of on the one page per question flow.
+SURVEY_MODE = os.getenv('SURVEY_MODE', 'server')
+SURVEY_CHECKPOINT_ANSWERS = int(os.getenv('SURVEY_CHECKPOINT_ANSWERS', '10'))
+SURVEY_CHECKPOINT_SECONDS = float(os.getenv('SURVEY_CHECKPOINT_SECONDS',
+                                  '20'))
+
+# /results/stream: in each worker, one thread per survey polls storage for
+# the answers changed since the newest it has seen, every
+# STREAM_POLL_INTERVAL seconds while anyone is subscribed (and at once after
+# a write in the same worker), and fans them out to all the survey's streams
+# from a buffer of the last STREAM_BUFFER_SIZE changes. Idle streams get a
+# comment every STREAM_KEEPALIVE seconds, which also finds closed ones.
+STREAM_POLL_INTERVAL = float(os.getenv('STREAM_POLL_INTERVAL', '1'))
+STREAM_BUFFER_SIZE = int(os.getenv('STREAM_BUFFER_SIZE', '10000'))
+STREAM_KEEPALIVE = float(os.getenv('STREAM_KEEPALIVE', '15'))
+
+# Object store backend: survey-app-gcp's answer log (objectstore.py, linked
+# into this directory along with fsbucket.py), kept as objects in BUCKET_NAME
+# on GCS, or under LOCAL_BUCKET_DIR with the filesystem stand-in from
+# fsbucket.py. Answers are written as shard objects under
+# SHARD_PREFIX and appended to OBJECT_NAME with server-side compose at least
+# every GCS_MERGE_INTERVAL seconds. LOCAL_BUCKET_LATENCY adds a delay in
+# seconds to every local bucket request, to benchmark as if the bucket were
+# remote.
+BUCKET_NAME = os.getenv('BUCKET', 'inbuild-dee.appspot.com')
+LOCAL_BUCKET_DIR = os.getenv('LOCAL_BUCKET_DIR')
+LOCAL_BUCKET_LATENCY = float(os.getenv('LOCAL_BUCKET_LATENCY', '0'))
+OBJECT_NAME = 'survey_responses.csv'
+SHARD_PREFIX = 'survey_responses/shards/'
+GCS_MERGE_INTERVAL = float(os.getenv('GCS_MERGE_INTERVAL', '30'))
+
+# Survey definitions: one YAML or JSON file per survey in SURVEY_DIR, named
+# after the survey id (see surveys/default.yaml). Each worker checks the
+# files' mtimes every SURVEY_RELOAD_INTERVAL seconds in the background and
+# swaps in changed surveys; sessions stay on the version they started with.
+SURVEY_DIR = os.getenv('SURVEY_DIR', os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), 'surveys'))
+SURVEY_RELOAD_INTERVAL = float(os.getenv('SURVEY_RELOAD_INTERVAL', '2'))
+
+# Every survey is served under /s/<survey id>/ and its answers are kept apart
+# from the other surveys': its own csv log, SQLite file or object prefix (see
+# partition_path()), so a busy survey never slows down reads of another.
+# DEFAULT_SURVEY is also served at the bare URLs and keeps the unpartitioned
+# CSV_FILE, DATABASE and OBJECT_NAME.
+DEFAULT_SURVEY = 'default'
+SURVEY_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+SURVEY_OBJECT_PREFIX = 'surveys/'
+
+# Request, phase and storage timings are kept as histograms and served in
+# Prometheus format at /metrics; METRICS=0 turns the timers off. Under
+# gunicorn, set PROMETHEUS_MULTIPROC_DIR to an empty directory so /metrics
+# adds up all workers.
+METRICS = os.getenv('METRICS', '1') == '1'
+
+# Sampling profiler. 'header' profiles requests sent with 'X-Profile: 1',
+# 'all' profiles every request. The request thread's stack is sampled every
+# PROFILE_INTERVAL seconds and written to PROFILE_DIR as collapsed stacks, one
+# file per request, which flamegraph.pl and speedscope read.
+PROFILE = os.getenv('PROFILE', 'off')
+PROFILE_DIR = os.getenv('PROFILE_DIR', '/tmp/survey_profiles')
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.001'))
 
 # STORAGE_TYPE variable for GCP's app engine that does not support command-line args
 # this script currently supports command line args and env variables as inputs
 # command-line args will override env variables
+# One of the names in BACKENDS: csv, db or object
 STORAGE_TYPE = os.getenv('STORAGE', 'csv') 
 
-def create_db():
-    conn = sqlite3.connect(DATABASE)
-    conn.execute('CREATE TABLE IF NOT EXISTS responses '
-                   '(session_id TEXT, start_time TEXT, q_index INTEGER, '
-                   'question TEXT, response TEXT, PRIMARY KEY (session_id, q_index))')
+def partition_path(path, survey_id):
+
+    # survey_responses.csv -> survey_responses-<survey id>.csv
+
+    if survey_id == DEFAULT_SURVEY:
+        return path
+    (root, extension) = os.path.splitext(path)
+    return '{}-{}{}'.format(root, survey_id, extension)
+
+
+def connect_db(survey_id=DEFAULT_SURVEY):
+
+    # sqlite3 keeps compiled statements per connection, keyed on the SQL
+    # text, so long-lived connections only prepare each query once.
+
+    conn = sqlite3.connect(partition_path(DATABASE, survey_id),
+                           timeout=DB_BUSY_TIMEOUT,
+                           cached_statements=256)
+
+    # WAL only needs an fsync at checkpoints with synchronous=NORMAL, and is
+    # still safe against corruption; a power loss can drop the last commits.
+
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def create_tables(conn):
+
+    # Normalized layout: prompts live once in questions (a new version per
+    # changed prompt), session start times once in sessions as integer epoch
+    # seconds, and answers reference both. sessions_by_start and the answers
+    # primary key walk results in (start_time, session_id, q_index) order
+    # without a sort, and sessions_by_start serves time-range filters.
+
+    conn.execute('CREATE TABLE IF NOT EXISTS questions '
+                 '(q_id INTEGER PRIMARY KEY, q_index INTEGER NOT NULL, '
+                 'version INTEGER NOT NULL, prompt TEXT NOT NULL, '
+                 'UNIQUE (q_index, version), UNIQUE (q_index, prompt))')
+    conn.execute('CREATE TABLE IF NOT EXISTS sessions '
+                 '(session_id TEXT PRIMARY KEY, start_time INTEGER NOT NULL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS sessions_by_start '
+                 'ON sessions (start_time, session_id)')
+    conn.execute('CREATE TABLE IF NOT EXISTS answers '
+                 '(session_id TEXT NOT NULL, q_index INTEGER NOT NULL, '
+                 'q_id INTEGER NOT NULL, response, change_id INTEGER, '
+                 'PRIMARY KEY (session_id, q_index)) WITHOUT ROWID')
+
+    # change_id orders answers by their last write for /results/stream:
+    # every write takes the next one in its transaction, so they increase in
+    # commit order. Answers written before it existed have none.
+
+    if 'change_id' not in [row[1] for row in
+                           conn.execute('PRAGMA table_info(answers)')]:
+        conn.execute('ALTER TABLE answers ADD COLUMN change_id INTEGER')
+    conn.execute('CREATE INDEX IF NOT EXISTS answers_by_change '
+                 'ON answers (change_id)')
+
+    # Per-question answer counts kept up to date by write_responses_db, so
+    # the summary never scans answers. See summary_bucket() for buckets.
+
+    conn.execute('CREATE TABLE IF NOT EXISTS answer_counts '
+                 '(q_index INTEGER, bucket TEXT, count INTEGER NOT NULL, '
+                 'PRIMARY KEY (q_index, bucket))')
+
+    # Full-text index of the text answers for /results/search. answers has
+    # no rowid, so search_docs gives each (session_id, q_index) a doc id to
+    # be its rowid in answer_search. Every write of an answer replaces its
+    # doc id with a new one, so doc ids follow write order. Kept up to date
+    # by write_responses_db, see search_updates().
+
+    conn.execute('CREATE TABLE IF NOT EXISTS search_docs '
+                 '(doc_id INTEGER PRIMARY KEY, session_id TEXT NOT NULL, '
+                 'q_index INTEGER NOT NULL, UNIQUE (session_id, q_index))')
+    conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS answer_search '
+                 "USING fts5(response, tokenize='unicode61 "
+                 "remove_diacritics 0', detail=none)")
+
+
+def migrate_db(conn):
+
+    # Databases from before the normalized layout have a single responses
+    # table with the prompt and an ISO start_time string in every row.
+
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                    "AND name = 'responses'").fetchone() is None:
+        return
+    conn.execute('INSERT OR IGNORE INTO sessions '
+                 "SELECT session_id, MIN(CAST(strftime('%s', start_time) "
+                 'AS INTEGER)) FROM responses GROUP BY session_id')
+    conn.execute('INSERT OR IGNORE INTO questions (q_index, version, prompt) '
+                 'SELECT q_index, ROW_NUMBER() OVER (PARTITION BY q_index '
+                 'ORDER BY MIN(rowid)), question FROM responses '
+                 'GROUP BY q_index, question')
+    conn.execute('INSERT OR REPLACE INTO answers '
+                 '(session_id, q_index, q_id, response) '
+                 'SELECT r.session_id, r.q_index, q.q_id, r.response '
+                 'FROM responses r JOIN questions q '
+                 'ON q.q_index = r.q_index AND q.prompt = r.question')
+    conn.execute('DROP TABLE responses')
+
+
+def create_db(survey_id=DEFAULT_SURVEY):
+    conn = connect_db(survey_id)
+    survey_questions = surveys.get(survey_id).questions
+
+    # journal_mode is persistent, so setting it once per file is enough
+
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('BEGIN IMMEDIATE')
+    new_search = conn.execute("SELECT 1 FROM sqlite_master WHERE type = "
+                              "'table' AND name = 'search_docs'").fetchone() \
+        is None
+    create_tables(conn)
+    migrate_db(conn)
+    if new_search:
+
+        # Index the text answers of databases from before search
+
+        text_indexes = [q_index for (q_index, question) in
+                        enumerate(survey_questions) if question.type == 'text']
+        conn.execute('INSERT INTO search_docs (session_id, q_index) '
+                     'SELECT session_id, q_index FROM answers '
+                     'WHERE q_index IN ({})'.format(', '.join('?'
+                     * len(text_indexes))), text_indexes)
+        conn.execute('INSERT INTO answer_search (rowid, response) '
+                     'SELECT d.doc_id, a.response FROM search_docs d '
+                     'JOIN answers a ON a.session_id = d.session_id '
+                     "AND a.q_index = d.q_index WHERE a.response != ''")
+    if conn.execute('SELECT 1 FROM answer_counts LIMIT 1').fetchone() \
+        is None:
+
+        # Backfill databases written before the counts existed
+
+        counts = collections.Counter(
+            (q_index, summary_bucket(q_index, response, survey_questions))
+            for (q_index, response) in
+            conn.execute('SELECT q_index, response FROM answers'))
+        conn.executemany('INSERT INTO answer_counts VALUES (?, ?, ?)',
+                         [(q_index, bucket, count) for ((q_index, bucket),
+                         count) in counts.items()])
+
+    # Register the current prompts so writes never have to look them up
+
+    ids = dict(((q_index, question.prompt), question_id(conn, q_index,
+               question.prompt, survey_id)) for (q_index, question) in
+               enumerate(survey_questions))
+    conn.commit()
     conn.close()
+    question_ids[survey_id].update(ids)
 
-def create_csv():
-    if not os.path.isfile(CSV_FILE_NAME):
-        with open(CSV_FILE_NAME, 'w', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=CSV_COLUMN_NAMES)
-            writer.writeheader()
 
-create_db()
-create_csv()
+def to_epoch(value):
+
+    # Session start times arrive as datetimes (naive ones are UTC) or as the
+    # str() of one, e.g. from a results cursor, or already in epoch seconds.
+
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+
+def from_epoch(value):
+    return str(datetime.fromtimestamp(value, timezone.utc))
+
+
+@contextmanager
+def csv_lock(exclusive=True, survey_id=DEFAULT_SURVEY):
+    with open(partition_path(CSV_FILE_NAME, survey_id) + '.lock', 'a') \
+        as lock_file:
+        fcntl.flock(lock_file, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH))
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def create_csv(survey_id=DEFAULT_SURVEY):
+    path = partition_path(CSV_FILE_NAME, survey_id)
+    with csv_lock(survey_id=survey_id):
+        if not os.path.isfile(path):
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=CSV_COLUMN_NAMES)
+                writer.writeheader()
+            return
+        with open(path, 'r', newline='') as f:
+            headers = next(csv.reader(f), None)
+
+    # Files written before the append-only log have no seq column.
+    # Rewrite them once with the current header.
+
+    if headers != CSV_COLUMN_NAMES:
+        compact_csv(survey_id)
 
 class Question:
 
+    # q_index is the position in its survey; it is filled in when the survey
+    # is registered
+
+    __slots__ = (
+        'q_index',
+        'type',
+        'prompt',
+        'options',
+        'mandatory',
+        'range_min',
+        'range_max',
+        'range_min_label',
+        'range_max_label',
+        'page',
+        )
+
     def __init__(
         self,
         q_type,
@@ -60,254 +410,3092 @@ class Question:
         range_max_label=None,
         ):
 
+        self.q_index = None
         self.type = q_type
         self.prompt = prompt
-        self.options = options
+        self.options = (tuple(options) if options is not None else None)
         self.mandatory = mandatory
         self.range_min = range_min
         self.range_max = range_max
         self.range_min_label = range_min_label
         self.range_max_label = range_max_label
+        self.page = None
+
+
+class QuestionPage:
+
+    # question.html prerendered for one question. Text questions are split
+    # around the current answer, which is escaped in. Choice and range
+    # questions are rendered once with no radio button checked, and
+    # `checked` holds where each answer's button takes its checked
+    # attribute, so a page per answer is a single join. Pages with an error
+    # message are rare and rendered in full.
+
+    __slots__ = ('question', 'show_back_button', 'checked', 'unchecked',
+                 'default', 'parts')
+
+    ANSWER_SLOT = '\x00answer\x00'
+
+    def __init__(self, question, show_back_button):
+        self.question = question
+        self.show_back_button = show_back_button
+        self.checked = {}
+        self.unchecked = None
+        self.default = self.render_template(None, None)
+        self.parts = None
+        if question.type == 'text':
+            self.parts = tuple(self.render_template(self.ANSWER_SLOT,
+                               None).split(self.ANSWER_SLOT))
+        else:
+
+            # The template compares range answers with |int, which makes
+            # None 0, so the unchecked range page is one for a value below it
+
+            if question.type == 'choice':
+                answers = question.options
+                self.unchecked = self.default
+            else:
+                answers = range(question.range_min, question.range_max + 1)
+                self.unchecked = self.render_template(question.range_min
+                        - 1, None)
+            position = 0
+            for answer in answers:
+                radio = 'name="response" value="{}" '.format(
+                    markupsafe.escape(answer))
+                position = self.unchecked.index(radio, position) \
+                    + len(radio)
+                self.checked[self.page_key(answer)] = position
+
+    def page_key(self, answer):
+
+        # the template compares range answers with |int, so '3' is 3
+
+        if self.question.type == 'range' and answer is not None:
+            return str(answer)
+        return answer
+
+    def render_template(self, current_answer, error):
+        return app.jinja_env.get_template('question.html').render(
+            question=self.question, error=error,
+            current_answer=current_answer,
+            show_back_button=self.show_back_button)
+
+    def render(self, current_answer, error=None):
+        if error:
+            return self.render_template(current_answer, error)
+        if self.parts is not None:
+            if current_answer is None:
+                return self.default
+            return str(markupsafe.escape(current_answer)).join(self.parts)
+        position = self.checked.get(self.page_key(current_answer))
+        if position is None:
+            return self.default
+        return self.unchecked[:position] + 'checked' \
+            + self.unchecked[position:]
+
+
+class Survey:
+
+    # page is survey.html for the client survey mode, prerendered with the
+    # survey's definition
+
+    __slots__ = ('survey_id', 'version', 'questions', 'page')
+
+    def __init__(self, survey_id, version, questions):
+        self.survey_id = survey_id
+        self.version = version
+        self.questions = questions
+        self.page = app.jinja_env.get_template('survey.html').render(
+            definition=survey_definition(self),
+            checkpoint_answers=SURVEY_CHECKPOINT_ANSWERS,
+            checkpoint_seconds=SURVEY_CHECKPOINT_SECONDS)
+
+
+def survey_definition(survey):
+
+    # The survey as the client survey page gets it, in the fields of a
+    # survey file
+
+    definition = []
+    for question in survey.questions:
+        item = {
+            'q_index': question.q_index,
+            'type': question.type,
+            'prompt': question.prompt,
+            'mandatory': question.mandatory,
+            }
+        if question.type == 'choice':
+            item['options'] = list(question.options)
+        elif question.type == 'range':
+            item.update({
+                'min': question.range_min,
+                'max': question.range_max,
+                'min_label': question.range_min_label,
+                'max_label': question.range_max_label,
+                })
+        definition.append(item)
+    return {'survey': survey.survey_id, 'version': survey.version,
+            'questions': definition}
+
+
+class SurveyRegistry:
+
+    # Surveys by id and the versions of them that sessions may be pinned to.
+    # Questions are compiled once when their survey is added: numbered,
+    # frozen into a tuple and their pages prerendered. Adding a new version
+    # replaces the current one with a single dict assignment, so requests see
+    # either version whole. retired holds when each older version stopped
+    # being current, for expire() to drop it once no session can still be on
+    # it.
+
+    __slots__ = ('surveys', 'versions', 'retired', 'lock')
+
+    def __init__(self):
+        self.surveys = {}
+        self.versions = {}
+        self.retired = {}
+        self.lock = threading.Lock()
+
+    def add(self, survey_id, questions, version=None):
+        with self.lock:
+            key = (survey_id, version)
+            survey = self.versions.get(key)
+            if survey is None:
+                for (q_index, question) in enumerate(questions):
+                    question.q_index = q_index
+                    question.page = QuestionPage(question, q_index > 0)
+                survey = Survey(survey_id, version, tuple(questions))
+                self.versions[key] = survey
+            current = self.surveys.get(survey_id)
+            if current is not None and current is not survey:
+                self.retired[(survey_id, current.version)] = time.monotonic()
+            self.retired.pop(key, None)
+            self.surveys[survey_id] = survey
+        return survey
+
+    def expire(self, ttl):
+
+        # Drops the versions that stopped being current more than ttl seconds
+        # ago. Sessions still on one carry on as session_survey() decides.
+
+        cutoff = time.monotonic() - ttl
+        with self.lock:
+            for (key, since) in list(self.retired.items()):
+                if since < cutoff:
+                    del self.retired[key]
+                    del self.versions[key]
+
+    def get(self, survey_id):
+        return self.surveys[survey_id]
+
+    def version(self, survey_id, version):
+        return self.versions.get((survey_id, version))
+
+
+surveys = SurveyRegistry()
+
+QUESTION_FIELDS = {
+    'text': {'type', 'prompt', 'mandatory'},
+    'choice': {'type', 'prompt', 'mandatory', 'options'},
+    'range': {'type', 'prompt', 'mandatory', 'min', 'max', 'min_label',
+              'max_label'},
+    }
+
+# A range question is a radio button per value; more than this many values
+# is a text question
+MAX_RANGE_VALUES = 101
+
+
+def parse_question(n, item):
+    if not isinstance(item, dict) or item.get('type') not in QUESTION_FIELDS:
+        raise ValueError('question {}: type must be one of {}'.format(n,
+                         ', '.join(QUESTION_FIELDS)))
+    unknown = set(item) - QUESTION_FIELDS[item['type']]
+    if unknown:
+        raise ValueError('question {}: unknown fields {}'.format(n,
+                         ', '.join(sorted(unknown))))
+    if not isinstance(item.get('prompt'), str) or not item['prompt'].strip():
+        raise ValueError('question {}: prompt is required'.format(n))
+    if not isinstance(item.get('mandatory', False), bool):
+        raise ValueError('question {}: mandatory must be true or false'.format(n))
+    question = Question(item['type'], item['prompt'],
+                        mandatory=item.get('mandatory', False))
+    if item['type'] == 'choice':
+        options = item.get('options')
+        if not isinstance(options, list) or not options \
+            or not all(isinstance(option, str) and option for option in
+                       options) or len(set(options)) != len(options):
+            raise ValueError('question {}: options must be a list of '
+                             'distinct strings'.format(n))
+        question.options = tuple(options)
+    elif item['type'] == 'range':
+        (low, high) = (item.get('min'), item.get('max'))
+        if type(low) is not int or type(high) is not int or low >= high:
+            raise ValueError('question {}: min and max must be integers '
+                             'with min < max'.format(n))
+        if high - low + 1 > MAX_RANGE_VALUES:
+            raise ValueError('question {}: a range has at most {} values'
+                             .format(n, MAX_RANGE_VALUES))
+        question.range_min = low
+        question.range_max = high
+        question.range_min_label = item.get('min_label')
+        question.range_max_label = item.get('max_label')
+    return question
+
+
+def parse_survey(content, json_format=False):
+
+    # A survey definition: {'version': ..., 'questions': [...]}. Raises
+    # ValueError, with the question number, for anything that doesn't fit.
+
+    try:
+        definition = (json.loads(content) if json_format
+                      else yaml.safe_load(content))
+    except (ValueError, yaml.YAMLError) as e:
+        raise ValueError('not valid {}: {}'.format(('JSON' if json_format
+                         else 'YAML'), e))
+    if not isinstance(definition, dict) \
+        or not isinstance(definition.get('questions'), list) \
+        or not definition['questions']:
+        raise ValueError('a survey needs a non-empty list of questions')
+    unknown = set(definition) - {'version', 'questions'}
+    if unknown:
+        raise ValueError('unknown fields {}'.format(', '.join(sorted(unknown))))
+    questions = [parse_question(n, item) for (n, item) in
+                 enumerate(definition['questions'], 1)]
 
+    # The version sessions are pinned to: the declared version plus a hash
+    # of the file, so an edit that forgets to bump it is still a new version
 
-questions = [
-    Question('text', 'What is your name?', mandatory=True),
-    Question('text', 'What is your favorite color?'),
-    Question('choice', 'What is your favorite pet?', ['Dog', 'Cat',
-             'Bird', 'Other']),
-    Question('choice', 'What is your favorite fruit?', ['Apple',
-             'Banana', 'Cherry', 'Other']),
-    Question(
-        'range',
-        'On a scale of 1 to 6, how do you feel today?',
-        mandatory=True,
-        range_min=1,
-        range_max=6,
-        range_min_label='Sad',
-        range_max_label='Happy',
-        ),
-    Question(
-        'range',
-        'On a scale of 1 to 6, how much do you like ice cream?',
-        mandatory=True,
-        range_min=1,
-        range_max=6,
-        range_min_label='Not at all',
-        range_max_label='Quite a bit',
-        ),
-    ]
+    digest = hashlib.sha1(content).hexdigest()[:8]
+    version = ('{}-{}'.format(definition['version'], digest) if 'version'
+               in definition else digest)
+    return version, questions
 
 
+SURVEY_EXTENSIONS = {'.yaml': False, '.yml': False, '.json': True}
+
+# survey file path -> mtime_ns it was last loaded at
+survey_mtimes = {}
+
+
+def load_surveys():
+
+    # (Re)loads the survey files that changed since the last call. A file
+    # that doesn't parse is logged and skipped, so a bad edit keeps the
+    # previous version running. Returns the ids of the surveys loaded.
+
+    global questions
+    loaded = []
+    try:
+        entries = list(os.scandir(SURVEY_DIR))
+    except FileNotFoundError:
+        entries = []
+    for entry in entries:
+        (survey_id, extension) = os.path.splitext(entry.name)
+        if extension not in SURVEY_EXTENSIONS or not entry.is_file():
+            continue
+        if not SURVEY_ID_PATTERN.fullmatch(survey_id):
+
+            # the id ends up in URLs and storage paths
+
+            app.logger.error('Not loading survey %s: invalid survey id',
+                             entry.path)
+            continue
+        mtime = entry.stat().st_mtime_ns
+        if survey_mtimes.get(entry.path) == mtime:
+            continue
+        survey_mtimes[entry.path] = mtime
+        try:
+            with open(entry.path, 'rb') as f:
+                (version, survey_questions) = parse_survey(f.read(),
+                        SURVEY_EXTENSIONS[extension])
+        except (OSError, ValueError) as e:
+            app.logger.error('Not loading survey %s: %s', entry.path, e)
+            continue
+        surveys.add(survey_id, survey_questions, version)
+        loaded.append(survey_id)
+    surveys.expire(SESSION_TTL)
+    if DEFAULT_SURVEY in surveys.surveys:
+        questions = surveys.get(DEFAULT_SURVEY).questions
+    return loaded
+
+
+def watch_surveys():
+    while True:
+        time.sleep(SURVEY_RELOAD_INTERVAL)
+        try:
+            for survey_id in load_surveys():
+                app.logger.info('Reloaded survey %s, version %s', survey_id,
+                                surveys.get(survey_id).version)
+        except Exception:
+            app.logger.exception('Failed to reload surveys')
+
+
+def start_survey_watcher():
+    if SURVEY_RELOAD_INTERVAL > 0:
+        threading.Thread(target=watch_surveys, daemon=True,
+                         name='survey-watcher').start()
+
+
+def session_survey(state):
+
+    # The survey version a session started on. Sessions from before a
+    # restart, which forgets old versions, or on a version that was replaced
+    # more than SESSION_TTL seconds ago, carry on with the current version
+    # if it has the same number of questions; otherwise None. So are cookie
+    # sessions from before answers were kept by q_index, which hold a dict
+    # of answers by prompt.
+
+    if not isinstance(state.get('responses'), list):
+        return None
+    survey_id = state.get('survey', DEFAULT_SURVEY)
+    survey = surveys.version(survey_id, state.get('survey_version'))
+    if survey is None and survey_id in surveys.surveys:
+        current = surveys.get(survey_id)
+        if len(current.questions) == len(state['responses']):
+            return current
+    return survey
+
+
+load_surveys()
+if DEFAULT_SURVEY not in surveys.surveys:
+    raise RuntimeError('No valid {} survey in {}'.format(DEFAULT_SURVEY,
+                       SURVEY_DIR))
+
+# The questions of the current version of the survey this app serves
+questions = surveys.get(DEFAULT_SURVEY).questions
+
+# Threads don't survive fork, so gunicorn --preload workers start their own
+
+start_survey_watcher()
+os.register_at_fork(after_in_child=start_survey_watcher)
+
 #############################################################
 ## Storage interface
 #############################################################
 
-def get_db():
-    db = getattr(g, '_database', None)
+# One long-lived connection per thread and survey, so requests don't pay for
+# connect() and PRAGMAs, and reuse prepared statements. Tagged with the pid so
+# a worker forked after import never shares its parent's connections.
+db_local = threading.local()
+
+
+def get_db(survey_id=DEFAULT_SURVEY):
+    if getattr(db_local, 'pid', None) != os.getpid():
+        db_local.conns = {}
+        db_local.pid = os.getpid()
+    db = db_local.conns.get(survey_id)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
+        db = db_local.conns[survey_id] = connect_db(survey_id)
     return db
 
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
 
+    # The connections outlive the request; just don't leak a transaction
+
+    for db in getattr(db_local, 'conns', {}).values():
+        if db.in_transaction:
+            db.rollback()
+
+
+def next_seq():
+
+    # Nanosecond timestamps keep increasing across restarts and are unique
+    # enough across workers, unlike an in-memory counter.
+
+    return time.time_ns()
+
+
+def replay_csv_log(rows, keep=None, live=None):
+
+    # Replay log rows and keep the last write per (session_id, q_index),
+    # on top of the `live` rows of an earlier replay if given.
+    # Returns the live rows and the total number of rows replayed.
+    # `keep` filters rows on fields that never change for a key (session and
+    # start time), so dropping rows early can't change which write wins.
+
+    live = {} if live is None else live
+    total = 0
+    for row in rows:
+        total += 1
+        if keep is not None and not keep(row):
+            continue
+        seq = int(row.get('seq') or 0)
+        key = (row['session_id'], row['q_index'])
+        existing = live.get(key)
+
+        # ties go to the later row in the log
+
+        if existing is None or seq >= existing[0]:
+            live[key] = (seq, row)
+    return live, total
+
+
+def read_csv_log(keep=None, survey_id=DEFAULT_SURVEY, since=None,
+                 until=None, archive=True):
+
+    # Replays the log and, unless `archive` is False, the archive segments
+    # that overlap [since, until).
+    # Writers only ever append whole rows under the lock and compaction swaps
+    # in new files by rename, so reading without the lock is consistent up
+    # to the last complete row. The log is opened before the archive is
+    # read, and compaction writes the archive before it replaces the log, so
+    # rows being moved are seen twice rather than not at all.
 
-def write_response_csv(response):
     try:
+        f = open(partition_path(CSV_FILE_NAME, survey_id), 'r', newline='')
+    except FileNotFoundError:
+        f = io.StringIO()
+    with f:
+        rows = csv.DictReader(f)
+        if archive:
+            rows = itertools.chain(archive_rows(survey_id, since, until),
+                                   rows)
+        return replay_csv_log(rows, keep)
 
-        # Load existing data
 
-        data = []
-        if os.path.isfile(CSV_FILE_NAME):
-            with open(CSV_FILE_NAME, 'r') as f:
-                data = list(csv.DictReader(f))
+# Segments are named after their period, which is a prefix of the
+# start_time strings in them
+SEGMENT_LENGTHS = {'day': 10, 'hour': 13}
 
-        # Check if response already exists and update it
+# survey id -> open_segment() when its log was last compacted, as read from
+# the segment directory's ROTATED_FILE, which every worker shares
+rotated_segments = {}
+ROTATED_FILE = 'rotated'
 
-        existing_response = next((item for item in data
-                                 if item['session_id']
-                                 == response['session_id']
-                                 and item['q_index']
-                                 == str(response['q_index'])), None)
-        if existing_response:
-            existing_response['response'] = response['response']
-        else:
-            data.append(response)
 
-        # Write data back to file
+def segment_of(start_time):
+    return str(start_time)[:SEGMENT_LENGTHS[SEGMENT_PERIOD]].replace(' ', 'T')
+
+
+def open_segment():
+
+    # The oldest period whose sessions stay in the log
+
+    return segment_of(datetime.now(timezone.utc)
+                      - timedelta(seconds=SEGMENT_GRACE))
 
-        with open(CSV_FILE_NAME, 'w', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=CSV_COLUMN_NAMES)
+
+def retention_cutoff():
+
+    # The start_time before which sessions are dropped, or None
+
+    if RETENTION_DAYS <= 0:
+        return None
+    return str(datetime.now(timezone.utc).replace(microsecond=0)
+               - timedelta(days=RETENTION_DAYS))
+
+
+def segment_dir(survey_id):
+    return os.path.splitext(partition_path(CSV_FILE_NAME, survey_id))[0] \
+        + '.segments'
+
+
+def read_segment_index(survey_id):
+
+    # segment -> {'file', 'rows', 'min_start_time', 'max_start_time'}
+
+    try:
+        with open(os.path.join(segment_dir(survey_id), 'index.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_segment_index(survey_id, index):
+    path = os.path.join(segment_dir(survey_id), 'index.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def read_segment(path):
+    with gzip.open(path, 'rt') as f:
+        columns = json.load(f)
+    for values in zip(*[columns[name] for name in CSV_COLUMN_NAMES]):
+        yield dict(zip(CSV_COLUMN_NAMES, values))
+
+
+def write_segment(directory, segment, rows):
+
+    # One gzipped JSON array per column, which compresses far better than
+    # csv rows since prompts and start times repeat down a column. Returns
+    # the segment's index entry.
+
+    name = segment + '.json.gz'
+    columns = dict((column, [row.get(column) for row in rows]) for column in
+                   CSV_COLUMN_NAMES)
+    tmp_name = os.path.join(directory, name + '.tmp')
+    with open(tmp_name, 'wb') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb') as archive:
+            archive.write(json.dumps(columns).encode())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_name, os.path.join(directory, name))
+    return {
+        'file': name,
+        'rows': len(rows),
+        'min_start_time': min(columns['start_time']),
+        'max_start_time': max(columns['start_time']),
+        }
+
+
+def archive_rows(survey_id=DEFAULT_SURVEY, since=None, until=None):
+
+    # Rows of the archive segments whose start_time range overlaps
+    # [since, until), going by the index alone for the rest
+
+    directory = segment_dir(survey_id)
+    for (segment, entry) in sorted(read_segment_index(survey_id).items()):
+        if since is not None and entry['max_start_time'] < since \
+            or until is not None and entry['min_start_time'] >= until:
+            continue
+        try:
+            yield from read_segment(os.path.join(directory, entry['file']))
+        except FileNotFoundError:
+
+            # dropped by retention since the index was read
+
+            continue
+
+
+def archive_segments(survey_id, closed):
+
+    # Merges the rows of closed periods into their segments, then drops
+    # the segments past retention. Runs under the csv lock. Returns how many
+    # archived rows were overwritten or dropped.
+
+    directory = segment_dir(survey_id)
+    os.makedirs(directory, exist_ok=True)
+    index = read_segment_index(survey_id)
+    dropped = 0
+    for (segment, rows) in closed.items():
+        entry = index.get(segment)
+        if entry is not None:
+
+            # late answers to sessions already archived
+
+            live, total = replay_csv_log(itertools.chain(read_segment(
+                os.path.join(directory, entry['file'])), rows))
+            rows = [row for (seq, row) in sorted(live.values(),
+                    key=lambda item: item[0])]
+            dropped += total - len(rows)
+        index[segment] = write_segment(directory, segment, rows)
+    cutoff = retention_cutoff()
+    expired = [segment for (segment, entry) in index.items() if cutoff
+               is not None and entry['max_start_time'] < cutoff]
+    expired_files = []
+    for segment in expired:
+        entry = index.pop(segment)
+        dropped += entry['rows']
+        expired_files.append(entry['file'])
+    if closed or expired:
+        write_segment_index(survey_id, index)
+    for name in expired_files:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+    return dropped
+
+
+def compact_csv(survey_id=DEFAULT_SURVEY, rotate_only=False):
+
+    # Rewrite the log to just the live rows of open periods, after moving
+    # closed periods to the archive (see read_csv_log()). Written to a
+    # temporary file and renamed so readers never see a half-written log.
+    # Holding the lock throughout keeps appends from landing in the file
+    # being replaced. With rotate_only, nothing is done if another worker
+    # rotated the log while we waited for the lock.
+
+    path = partition_path(CSV_FILE_NAME, survey_id)
+    with csv_lock(survey_id=survey_id):
+        if rotate_only and csv_rotated(survey_id):
+            return 0
+        live, total = read_csv_log(survey_id=survey_id, archive=False)
+        oldest_open = open_segment()
+        rows = []
+        closed = collections.defaultdict(list)
+        for (seq, row) in sorted(live.values(), key=lambda item: item[0]):
+            segment = segment_of(row['start_time'])
+            if segment < oldest_open:
+                closed[segment].append(row)
+            else:
+                rows.append(row)
+        dropped = total - len(live) + archive_segments(survey_id, closed)
+        tmp_name = path + '.tmp'
+        with open(tmp_name, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_COLUMN_NAMES,
+                                    extrasaction='ignore')
             writer.writeheader()
-            writer.writerows(data)
+            writer.writerows(rows)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, path)
+        rotated_path = os.path.join(segment_dir(survey_id), ROTATED_FILE)
+        with open(rotated_path + '.tmp', 'w') as f:
+            f.write(oldest_open)
+        os.replace(rotated_path + '.tmp', rotated_path)
+    rotated_segments[survey_id] = oldest_open
+    return dropped
+
+
+def csv_rotated(survey_id=DEFAULT_SURVEY):
+
+    # Whether the log was compacted, by any worker, since the current
+    # open_segment() began. Once that's known it's cached, so the file is
+    # only read again after the next period starts.
+
+    oldest_open = open_segment()
+    if rotated_segments.get(survey_id) != oldest_open:
+        try:
+            with open(os.path.join(segment_dir(survey_id), ROTATED_FILE)) \
+                as f:
+                rotated_segments[survey_id] = f.read()
+        except FileNotFoundError:
+            pass
+    return rotated_segments.get(survey_id) == oldest_open
+
+
+def rotate_csv(survey_id=DEFAULT_SURVEY):
+
+    # Archives the closed periods and applies retention once a period ends,
+    # from the write path, so a log that is only ever written to rotates too
+
+    if not csv_rotated(survey_id):
+        compact_csv(survey_id, rotate_only=True)
+
+
+def csv_needs_compaction(live, total, survey_id=DEFAULT_SURVEY):
+
+    # Overwritten rows past CSV_COMPACT_RATIO, or a period closed since the
+    # last compaction, whose sessions are to be archived
+
+    if total and (total - len(live)) / total > CSV_COMPACT_RATIO:
+        return True
+    return not csv_rotated(survey_id)
+
+
+def write_responses_csv(responses, survey_id=DEFAULT_SURVEY):
+    try:
+        with csv_lock(survey_id=survey_id):
+
+            # Take the seqs under the lock so file order matches seq order,
+            # and format the rows up front so they go out in a single write()
+
+            buf = io.StringIO()
+            writer = csv.DictWriter(buf, fieldnames=CSV_COLUMN_NAMES)
+            writer.writerows(dict(response, seq=next_seq())
+                             for response in responses)
+            with open(partition_path(CSV_FILE_NAME, survey_id), 'a',
+                      newline='') as f:
+                f.write(buf.getvalue())
     except csv.Error as e:
 
         return 'Error processing CSV file: {}'.format(e)
+    rotate_csv(survey_id)
 
 
-def write_response_db(response):
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)'
-                   , (response['session_id'], response['start_time'],
-                   response['q_index'], response['question'],
-                   response['response']))
-
-    conn.commit()
+def write_response_csv(response, survey_id=DEFAULT_SURVEY):
+    return write_responses_csv([response], survey_id)
 
 
-def start_csv():
-    return redirect(url_for('question', q_index=0))
+# survey id -> (q_index, prompt) -> q_id, only filled in from committed
+# transactions
+question_ids = collections.defaultdict(dict)
 
 
-def start_db():
+def question_id(conn, q_index, prompt, survey_id=DEFAULT_SURVEY):
+    q_id = question_ids[survey_id].get((q_index, prompt))
+    if q_id is not None:
+        return q_id
+    conn.execute('INSERT OR IGNORE INTO questions (q_index, version, prompt) '
+                 'SELECT ?, COALESCE(MAX(version), 0) + 1, ? FROM questions '
+                 'WHERE q_index = ?', (q_index, prompt, q_index))
+    return conn.execute('SELECT q_id FROM questions WHERE q_index = ? '
+                        'AND prompt = ?', (q_index, prompt)).fetchone()[0]
 
-    # Initialize the database and table if they don't exist
 
-    conn = get_db()
-    conn.execute('CREATE TABLE IF NOT EXISTS responses '
-                   '(session_id TEXT, start_time TEXT, q_index INTEGER, '
-                   'question TEXT, response TEXT, PRIMARY KEY (session_id, q_index))'
-                 )
-    conn.commit()
-    return redirect(url_for('question', q_index=0))
+def write_responses_db(conn, responses, survey_id=DEFAULT_SURVEY):
 
+    # One transaction for the whole batch. IMMEDIATE takes the write lock up
+    # front: the previous answers are read before writing, and upgrading a
+    # read transaction under WAL fails instead of waiting on busy_timeout.
 
-def results_csv():
-    responses = []
-    if os.path.isfile(CSV_FILE_NAME):
-        with open(CSV_FILE_NAME, 'r') as f:
-            if os.stat(CSV_FILE_NAME).st_size == 0:
-                return 'No responses available.'
+    survey_questions = surveys.get(survey_id).questions
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        deltas = collections.Counter()
+        current = {}
+        new_question_ids = {}
+        sessions = {}
+        answers = []
+        change_id = conn.execute(LAST_CHANGE_DB).fetchone()[0]
+        for response in responses:
+            key = (response['session_id'], response['q_index'])
+            if key in current:
+                previous = current[key]
             else:
-                reader = csv.reader(f)
-                headers = next(reader)
-                for row in reader:
-                    responses.append(dict(zip(headers, row)))
-        responses.sort(key=lambda r: (r['start_time'], r['session_id'],
-                       int(r['q_index'])))
-        return render_template('results.html', responses=responses)
-    else:
-        return 'No responses available.'
+                previous = conn.execute('SELECT response FROM answers '
+                        'WHERE session_id = ? AND q_index = ?', key).fetchone()
+            if previous is not None:
+                deltas[(response['q_index'], summary_bucket(response['q_index'
+                       ], previous[0], survey_questions))] -= 1
+            deltas[(response['q_index'], summary_bucket(response['q_index'],
+                   response['response'], survey_questions))] += 1
+            current[key] = (response['response'], )
+
+            prompt_key = (response['q_index'], response['question'])
+            if prompt_key not in new_question_ids:
+                new_question_ids[prompt_key] = question_id(conn,
+                        response['q_index'], response['question'], survey_id)
+            sessions[response['session_id']] = \
+                to_epoch(response['start_time'])
+            change_id += 1
+            answers.append((response['session_id'], response['q_index'],
+                           new_question_ids[prompt_key],
+                           response['response'], change_id))
+
+        conn.executemany('INSERT OR IGNORE INTO sessions VALUES (?, ?)',
+                         sessions.items())
+        conn.executemany(WRITE_ANSWER_DB, answers)
+        (search_keys, search_texts) = search_updates(responses,
+                survey_questions)
+        conn.executemany(SEARCH_UNINDEX_SQL, search_keys)
+        conn.executemany(SEARCH_DOCS_SQL, search_keys)
+        conn.executemany(SEARCH_INDEX_SQL, search_texts)
+        conn.executemany('INSERT INTO answer_counts VALUES (?, ?, ?) '
+                         'ON CONFLICT (q_index, bucket) '
+                         'DO UPDATE SET count = count + excluded.count',
+                         [(q_index, bucket, count) for ((q_index, bucket),
+                         count) in deltas.items() if count != 0])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    question_ids[survey_id].update(new_question_ids)
+
+
+def write_response_db(response, survey_id=DEFAULT_SURVEY):
+    write_responses_db(get_db(survey_id), [response], survey_id)
+
+
+WRITE_ANSWER_DB = 'INSERT OR REPLACE INTO answers ' \
+    '(session_id, q_index, q_id, response, change_id) VALUES (?, ?, ?, ?, ?)'
+LAST_CHANGE_DB = 'SELECT COALESCE(MAX(change_id), 0) FROM answers'
+VERSION_QUERY_DB = 'SELECT (SELECT MAX(change_id) FROM answers), ' \
+    '(SELECT SUM(count) FROM answer_counts)'
+CHANGES_QUERY_DB = 'SELECT a.change_id, s.session_id, s.start_time, ' \
+    'a.q_index, q.prompt, a.response FROM answers a ' \
+    'CROSS JOIN sessions s ON s.session_id = a.session_id ' \
+    'CROSS JOIN questions q ON q.q_id = a.q_id ' \
+    'WHERE a.change_id > ? ORDER BY a.change_id'
+
+
+def changes_db(after=None, limit=None, survey_id=DEFAULT_SURVEY):
+    query = CHANGES_QUERY_DB
+    params = [(0 if after is None else after)]
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+    return [(row[0], result_row_db(row[1:])) for row in
+            get_db(survey_id).execute(query, params)]
+
+
+def results_key(response):
+    return (str(response['start_time']), response['session_id'],
+            int(response['q_index']))
+
+
+def page_live_rows(live, after=None, limit=None):
+
+    # Last-write-wins needs the whole log replayed, so csv logs hold the live
+    # rows in memory. A page only keeps the `limit` smallest keys after the
+    # cursor on top of that instead of sorting everything.
+
+    responses = (row for (seq, row) in live.values() if after is None
+                 or results_key(row) > after)
+    if limit is None:
+        return sorted(responses, key=results_key)
+    return heapq.nsmallest(limit, responses, key=results_key)
+
+
+def iter_results_csv(after=None, limit=None, since=None, until=None,
+                     survey_id=DEFAULT_SURVEY):
+    live, total = read_csv_log(time_filter(since, until), survey_id, since,
+                               until)
+
+    # a filtered read can't tell how much of the log is overwritten
+
+    if since is None and until is None \
+        and csv_needs_compaction(live, total, survey_id):
+        compact_csv(survey_id)
+    return page_live_rows(live, after, limit)
+
+
+# CROSS JOIN pins the join order: sessions through sessions_by_start drive the
+# loop, so results come out in order and only the few answers of one session
+# are sorted at a time, instead of the planner picking a full scan of answers.
+RESULTS_QUERY_DB = 'SELECT s.session_id, s.start_time, a.q_index, ' \
+    'q.prompt AS question, a.response FROM sessions s ' \
+    'CROSS JOIN answers a ON a.session_id = s.session_id ' \
+    'CROSS JOIN questions q ON q.q_id = a.q_id'
+
+
+def iter_results_db(after=None, limit=None, since=None, until=None,
+                    survey_id=DEFAULT_SURVEY):
+
+    # Keyset pagination on the sort order, so a page never scans or sorts the
+    # rows before the cursor. Rows are yielded straight from the cursor.
+    # Sessions are unique, so only the cursor's own session needs the
+    # q_index check.
+
+    (query, params) = results_query_db(after, limit, since, until)
+    for row in get_db(survey_id).execute(query, params):
+        yield result_row_db(row)
+
+
+def results_query_db(after=None, limit=None, since=None, until=None):
+
+    # A time range is just tighter bounds on the sessions_by_start walk
+
+    query = RESULTS_QUERY_DB
+    clauses = []
+    params = []
+    if after is not None:
+        clauses.append('(s.start_time, s.session_id) >= (?, ?) '
+                       'AND NOT (s.session_id = ? AND a.q_index <= ?)')
+        params.extend([to_epoch(after[0]), after[1], after[1], after[2]])
+    if since is not None:
+        clauses.append('s.start_time >= ?')
+        params.append(to_epoch(since))
+    if until is not None:
+        clauses.append('s.start_time < ?')
+        params.append(to_epoch(until))
+    if clauses:
+        query += ' WHERE ' + ' AND '.join(clauses)
+    query += ' ORDER BY s.start_time, s.session_id, a.q_index'
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+    return query, params
+
+
+def prune_db(survey_id=DEFAULT_SURVEY):
+
+    # Drops the sessions past retention with their answers, and takes them
+    # out of the answer counts. Returns how many answers were dropped.
 
+    cutoff = retention_cutoff()
+    if cutoff is None:
+        return 0
+    survey_questions = surveys.get(survey_id).questions
+    conn = get_db(survey_id)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        deltas = collections.Counter()
+        for (q_index, response) in conn.execute('SELECT a.q_index, '
+                'a.response FROM sessions s CROSS JOIN answers a '
+                'ON a.session_id = s.session_id WHERE s.start_time < ?',
+                (to_epoch(cutoff), )):
+            deltas[(q_index, summary_bucket(q_index, response,
+                   survey_questions))] += 1
+        conn.execute('DELETE FROM answers WHERE session_id IN '
+                     '(SELECT session_id FROM sessions WHERE start_time < ?)',
+                     (to_epoch(cutoff), ))
+        conn.execute('DELETE FROM answer_search WHERE rowid IN '
+                     '(SELECT d.doc_id FROM sessions s CROSS JOIN '
+                     'search_docs d ON d.session_id = s.session_id '
+                     'WHERE s.start_time < ?)', (to_epoch(cutoff), ))
+        conn.execute('DELETE FROM search_docs WHERE session_id IN '
+                     '(SELECT session_id FROM sessions WHERE start_time < ?)',
+                     (to_epoch(cutoff), ))
+        conn.execute('DELETE FROM sessions WHERE start_time < ?',
+                     (to_epoch(cutoff), ))
+        conn.executemany('UPDATE answer_counts SET count = count - ? '
+                         'WHERE q_index = ? AND bucket = ?', [(count,
+                         q_index, bucket) for ((q_index, bucket), count) in
+                         deltas.items()])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return sum(deltas.values())
+
+
+def iter_answers_db(survey_id=DEFAULT_SURVEY):
+    return get_db(survey_id).execute('SELECT s.session_id, s.start_time, '
+            'a.q_index, a.response FROM sessions s CROSS JOIN answers a '
+            'ON a.session_id = s.session_id')
+
+
+def live_answers(live):
+    for (seq, row) in live.values():
+        yield (row['session_id'], row['start_time'], row['q_index'],
+               row['response'])
+
+
+def live_changes(live, after=None, limit=None):
+
+    # (seq, result dict) of the live rows written after the `after` seq, in
+    # seq order
+
+    changes = (item for item in live.values() if after is None
+               or item[0] > after)
+    changes = (heapq.nsmallest(limit, changes, key=lambda item: item[0])
+               if limit is not None else sorted(changes,
+               key=lambda item: item[0]))
+    return [(seq, dict(zip(EXPORT_COLUMNS, export_row(row)))) for (seq,
+            row) in changes]
+
+
+def result_row_db(row):
+    (session_id, start_time, q_index, question, response) = row
+    return {
+        'session_id': session_id,
+        'start_time': from_epoch(start_time),
+        'q_index': q_index,
+        'question': question,
+        'response': response,
+        }
 
-def results_db():
-    conn = get_db()
-    cur = conn.cursor()
-    
-    # TODO: Can remove this check since we're initializing the table 
-    # at the start
-    # Check if the table exists
-    #cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='responses'")
-    
-    #if cur.fetchone() is None:
-    #    return 'No responses available.'
-    
-    cur.execute('SELECT * FROM responses ORDER BY start_time, session_id, q_index'
-                )
-    responses = [dict(zip([column[0] for column in cur.description],
-                 row)) for row in cur.fetchall()]
-    if len(responses) == 0:
+
+## Storage interface
+#############################################################
+
+#############################################################
+## Results rendering
+#############################################################
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+    start_time, session_id, q_index = \
+        json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return (start_time, session_id, int(q_index))
+
+
+def render_results(responses, after, limit, stream,
+                   survey_id=DEFAULT_SURVEY, since=None, until=None):
+    responses = iter(responses)
+    first = next(responses, None)
+    if first is None and after is None:
         return 'No responses available.'
-    return render_template('results.html', responses=responses)
+    responses = (itertools.chain([first], responses) if first
+                 is not None else iter(()))
 
+    if limit is not None:
 
-## Storage interface
+        # One page: the last row of the page is the cursor for the next one
+
+        page = list(itertools.islice(responses, limit))
+        next_cursor = None
+        if len(page) == limit:
+            next_cursor = encode_cursor(results_key(page[-1]))
+        return render_template('results.html', responses=page,
+                               next_cursor=next_cursor, limit=limit,
+                               survey_id=survey_id, since=since, until=until)
+
+    if stream:
+
+        # The table is flushed to the client as rows come off the iterator
+
+        return stream_template('results.html', responses=responses,
+                               survey_id=survey_id)
+    return render_template('results.html', responses=responses,
+                           survey_id=survey_id)
+
+
+## Results rendering
 #############################################################
 
 #############################################################
-## Flask App functions
+## Results export
+#############################################################
+
+EXPORT_COLUMNS = ['session_id', 'start_time', 'q_index', 'question',
+                  'response']
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'columnar': 'application/x-ndjson',
+    }
+
+# Rows per column block in the columnar format, like a Parquet row group.
+# Bounds the memory used by an export.
+EXPORT_ROW_GROUP_SIZE = int(os.getenv('EXPORT_ROW_GROUP_SIZE', '10000'))
+
+
+def parse_time_arg(value):
+
+    # start_time is stored as str() of an aware UTC datetime, so bounds are
+    # normalized the same way to compare correctly as strings.
+
+    if not value:
+        return None
+    value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return str(value.astimezone(timezone.utc))
+
+
+def iter_export_db(since=None, until=None, session_id=None,
+                   survey_id=DEFAULT_SURVEY):
+    clauses = []
+    params = []
+    if since is not None:
+        clauses.append('s.start_time >= ?')
+        params.append(to_epoch(since))
+    if until is not None:
+        clauses.append('s.start_time < ?')
+        params.append(to_epoch(until))
+    if session_id is not None:
+        clauses.append('s.session_id = ?')
+        params.append(session_id)
+    query = RESULTS_QUERY_DB
+    if clauses:
+        query += ' WHERE ' + ' AND '.join(clauses)
+    query += ' ORDER BY s.start_time, s.session_id, a.q_index'
+    for (session_id, start_time, q_index, question, response) in \
+        get_db(survey_id).execute(query, params):
+        yield (session_id, from_epoch(start_time), q_index, question,
+               response)
+
+
+def time_filter(since=None, until=None, session_id=None):
+
+    # Rows outside the filters are dropped while a log is replayed, so only
+    # matching live rows are held. None when there is nothing to filter.
+
+    if since is None and until is None and session_id is None:
+        return None
+
+    def keep(row):
+        return (since is None or row['start_time'] >= since) \
+            and (until is None or row['start_time'] < until) \
+            and (session_id is None or row['session_id'] == session_id)
+
+    return keep
+
+
+def export_live_rows(live):
+
+    # in write order
+
+    for (seq, row) in sorted(live.values(), key=lambda item: item[0]):
+        yield export_row(row)
+
+
+def export_row(row):
+    return [row['session_id'], row['start_time'], int(row['q_index']),
+            row['question'], row['response']]
+
+
+def iter_export_csv(since=None, until=None, session_id=None,
+                    survey_id=DEFAULT_SURVEY):
+    live, total = read_csv_log(time_filter(since, until, session_id),
+                               survey_id, since, until)
+    return export_live_rows(live)
+
+
+def export_csv_lines(rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        writer.writerow(row)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+def export_ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_COLUMNS, row)), default=str) + '\n'
+
+
+def export_columnar_lines(rows):
+
+    # One JSON object per row group, mapping each column to its values
+
+    rows = iter(rows)
+    while True:
+        group = list(itertools.islice(rows, EXPORT_ROW_GROUP_SIZE))
+        if not group:
+            return
+        columns = dict(zip(EXPORT_COLUMNS, (list(values) for values in
+                       zip(*group))))
+        yield json.dumps(dict(columns, rows=len(group)), default=str) \
+            + '\n'
+
+
+EXPORT_WRITERS = {
+    'csv': export_csv_lines,
+    'ndjson': export_ndjson_lines,
+    'columnar': export_columnar_lines,
+    }
+
+## Results export
+#############################################################
+
+#############################################################
+## Results summary
+#############################################################
+
+def summary_bucket(q_index, response, survey_questions=None):
+
+    # Choice and range answers are counted per value. Free text is only
+    # counted as answered or not, so the counts stay O(options).
+
+    if survey_questions is None:
+        survey_questions = questions
+    if response is None or response == '':
+        return ''
+    if q_index < len(survey_questions) \
+        and survey_questions[q_index].type == 'text':
+        return '*'
+    return str(response)
+
+
+def complete_rows(data):
+
+    # The length of the complete csv rows at the start of `data`. Text
+    # answers can hold newlines inside quotes, so a row ends at the last
+    # newline with an even number of quotes before it.
+
+    end = data.rfind(b'\n') + 1
+    while end and data.count(b'"', 0, end) % 2:
+        end = data.rfind(b'\n', 0, end - 1) + 1
+    return end
+
+
+class CsvLogFollower(abc.ABC):
+
+    # State derived from the csv log, carried forward by parsing just the
+    # bytes appended since the last update. A compaction renames a new file
+    # over the log, which triggers a rebuild. Subclasses keep their state in
+    # reset() and add(), and call update() holding self.lock.
+
+    def __init__(self, survey_id=DEFAULT_SURVEY):
+        self.survey_id = survey_id
+        self.path = partition_path(CSV_FILE_NAME, survey_id)
+        self.lock = threading.Lock()
+        self.file = None
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+
+    def follow(self, f):
+        if self.file is not None:
+            self.file.close()
+        self.file = f
+        self.reset()
+
+    def update(self):
+
+        # The followed file stays open, so its inode can't be freed and
+        # handed to the file compaction renames in, as ext4 does: another
+        # file at the path always fails samestat(). A log shorter than what
+        # was read is rebuilt too. Reads use pread(), since a forked worker
+        # shares the file offset with its parent.
+
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            self.follow(None)
+            return
+        survey_questions = surveys.get(self.survey_id).questions
+        stat = os.fstat(f.fileno())
+        if self.file is not None and os.path.samestat(stat,
+                os.fstat(self.file.fileno())) and stat.st_size \
+            >= self.offset:
+            f.close()
+        else:
+
+            # Compaction also moves rows to the archive, which is read
+            # after the log was opened as in read_csv_log()
+
+            self.follow(f)
+            for row in archive_rows(self.survey_id):
+                self.add(row, survey_questions)
+        tail = os.pread(self.file.fileno(), stat.st_size - self.offset,
+                        self.offset)
+
+        # Only consume complete rows; a writer may be mid-append
+
+        end = complete_rows(tail)
+        rows = csv.reader(io.StringIO(tail[:end].decode(), newline=''))
+        if self.offset == 0:
+            next(rows, None)
+        self.offset += end
+        for values in rows:
+            self.add(dict(zip(CSV_COLUMN_NAMES, values)), survey_questions)
+
+    @abc.abstractmethod
+    def add(self, row, survey_questions):
+        pass
+
+
+class LiveCounts:
+
+    # Summary counts carried forward row by row in log order, the last
+    # write per (session_id, q_index) winning. CsvSummary feeds it from the
+    # csv log; the object store's ObjectLog follows its log with one.
+
+    def __init__(self, survey_id=DEFAULT_SURVEY):
+        self.survey_id = survey_id
+        self.reset()
+
+    def reset(self):
+        self.live = {}
+        self.counts = collections.Counter()
+
+    def extend(self, rows):
+        survey_questions = surveys.get(self.survey_id).questions
+        for row in rows:
+            self.add(row, survey_questions)
+
+    def add(self, row, survey_questions):
+        key = (row['session_id'], int(row['q_index']))
+        seq = int(row.get('seq') or 0)
+        bucket = summary_bucket(key[1], row['response'], survey_questions)
+        previous = self.live.get(key)
+        if previous is not None:
+            if seq < previous[0]:
+                return
+            self.counts[(key[1], previous[1])] -= 1
+        self.live[key] = (seq, bucket)
+        self.counts[(key[1], bucket)] += 1
+
+
+class CsvSummary(CsvLogFollower):
+
+    # Summary counts of the csv log
+
+    def reset(self):
+        super().reset()
+        self.live_counts = LiveCounts(self.survey_id)
+
+    def refresh(self):
+        with self.lock:
+            self.update()
+            return collections.Counter(self.live_counts.counts)
+
+    def add(self, row, survey_questions):
+        self.live_counts.add(row, survey_questions)
+
+
+def answer_counts_db(survey_id=DEFAULT_SURVEY):
+    return collections.Counter(dict(((q_index, bucket), count)
+                               for (q_index, bucket, count) in
+                               get_db(survey_id).execute('SELECT q_index, '
+                               'bucket, count FROM answer_counts '
+                               'WHERE count != 0')))
+
+
+def count_live_rows(live, survey_questions=None):
+    return collections.Counter((int(row['q_index']),
+                               summary_bucket(int(row['q_index']),
+                               row['response'], survey_questions))
+                               for (seq, row) in live.values())
+
+
+def build_summary(counts, survey_questions=None):
+    if survey_questions is None:
+        survey_questions = questions
+    by_question = collections.defaultdict(dict)
+    for ((q_index, bucket), count) in counts.items():
+        if count:
+            by_question[q_index][bucket] = count
+
+    # Every session writes the first question before anything else
+
+    sessions = sum(by_question[0].values())
+    summary = {'sessions': sessions, 'questions': []}
+    for (q_index, question) in enumerate(survey_questions):
+        buckets = by_question[q_index]
+        viewed = sum(buckets.values())
+        answered = viewed - buckets.get('', 0)
+        item = {
+            'q_index': q_index,
+            'question': question.prompt,
+            'type': question.type,
+            'viewed': viewed,
+            'answered': answered,
+            'completion_rate': (answered / sessions if sessions else 0.0),
+            }
+        if question.type == 'choice':
+            item['counts'] = dict((option, buckets.get(option, 0))
+                                  for option in question.options)
+        elif question.type == 'range':
+            histogram = dict((value, buckets.get(str(value), 0))
+                             for value in range(question.range_min,
+                             question.range_max + 1))
+            item['histogram'] = histogram
+            item.update(histogram_stats(histogram))
+        summary['questions'].append(item)
+    return summary
+
+
+def histogram_stats(histogram):
+    total = sum(histogram.values())
+    if not total:
+        return {'mean': None, 'median': None}
+    mean = sum(value * count for (value, count) in histogram.items()) \
+        / total
+
+    # the middle value, or the average of the two middle values
+
+    (low_rank, high_rank) = ((total - 1) // 2, total // 2)
+    low = None
+    seen = 0
+    for value in sorted(histogram):
+        seen += histogram[value]
+        if low is None and seen > low_rank:
+            low = value
+        if seen > high_rank:
+            return {'mean': mean, 'median': (low + value) / 2}
+
+## Results summary
+#############################################################
+
+#############################################################
+## Results crosstab
+#############################################################
+
+class ResponseColumns:
+
+    # The live answers of one survey as arrays, one row per session: its
+    # start time (epoch seconds) and a small integer code per question, -1
+    # if the session never saw the question, 0 if it left it empty and
+    # 1.. for the question's values as answer_values() lists them. Loaded
+    # once per version of the stored data, so crosstabs and filters over
+    # millions of answers are vectorized passes over the codes.
+
+    def __init__(self, survey_questions, rows):
+        self.questions = survey_questions
+        codes = [answer_codes(question) for question in survey_questions]
+        sessions = {}
+        starts = []
+        (session_index, question_index, answer_code) = ([], [], [])
+        for (session_id, start_time, q_index, response) in rows:
+            q_index = int(q_index)
+            if q_index >= len(codes):
+                continue
+            n = sessions.get(session_id)
+            if n is None:
+                n = sessions[session_id] = len(starts)
+                starts.append(to_epoch(start_time))
+            session_index.append(n)
+            question_index.append(q_index)
+            response = ('' if response is None else str(response))
+            if codes[q_index] is None:
+                answer_code.append((1 if response else 0))
+            else:
+                answer_code.append(codes[q_index].get(response, 0))
+        self.starts = numpy.array(starts, dtype=numpy.int64)
+        self.codes = numpy.full((len(starts), len(survey_questions)), -1,
+                                dtype=numpy.int16)
+        self.codes[numpy.array(session_index, dtype=numpy.intp),
+                   numpy.array(question_index, dtype=numpy.intp)] = \
+            numpy.array(answer_code, dtype=numpy.int16)
+
+    def select(self, since=None, until=None, where=()):
+
+        # Mask of the sessions in [since, until) whose answers match every
+        # (q_index, code) in `where`
+
+        mask = numpy.ones(len(self.starts), dtype=bool)
+        if since is not None:
+            mask &= self.starts >= to_epoch(since)
+        if until is not None:
+            mask &= self.starts < to_epoch(until)
+        for (q_index, code) in where:
+            mask &= self.codes[:, q_index] == code
+        return mask
+
+    def crosstab(self, row_index, col_index, mask):
+
+        # Counts of answered (row value, column value) pairs, rows x columns
+
+        rows = self.codes[mask, row_index].astype(numpy.intp)
+        cols = self.codes[mask, col_index].astype(numpy.intp)
+        answered = (rows > 0) & (cols > 0)
+        n_cols = len(answer_values(self.questions[col_index]))
+        n_rows = len(answer_values(self.questions[row_index]))
+        cells = (rows[answered] - 1) * n_cols + cols[answered] - 1
+        return numpy.bincount(cells, minlength=n_rows
+                              * n_cols).reshape(n_rows, n_cols)
+
+
+def answer_values(question):
+    if question.type == 'choice':
+        return list(question.options)
+    if question.type == 'range':
+        return list(range(question.range_min, question.range_max + 1))
+    return ['answered']
+
+
+def answer_codes(question):
+
+    # stored response -> code, None for text questions, which are only
+    # answered or not
+
+    if question.type == 'text':
+        return None
+    return dict((str(value), code) for (code, value) in
+                enumerate(answer_values(question), 1))
+
+
+# (backend, survey id) -> (data version, ResponseColumns)
+response_columns_cache = {}
+response_columns_lock = threading.Lock()
+
+
+def response_columns(storage):
+    key = (storage.name, storage.survey_id)
+    version = storage.version()
+    survey_questions = storage.questions()
+    cached = response_columns_cache.get(key)
+    if cached is not None and version is not None and cached[0] == version \
+        and cached[1].questions is survey_questions:
+        return cached[1]
+    columns = ResponseColumns(survey_questions, storage.iter_answers())
+    with response_columns_lock:
+        response_columns_cache[key] = (version, columns)
+    return columns
+
+
+def build_crosstab(columns, row_index, col_index, since=None, until=None,
+                   where=()):
+    mask = columns.select(since, until, where)
+    table = columns.crosstab(row_index, col_index, mask)
+    (row_question, col_question) = (columns.questions[row_index],
+                                    columns.questions[col_index])
+    (row_values, col_values) = (answer_values(row_question),
+                                answer_values(col_question))
+    crosstab = {
+        'sessions': int(mask.sum()),
+        'rows': {'q_index': row_index, 'question': row_question.prompt,
+                 'values': row_values},
+        'cols': {'q_index': col_index, 'question': col_question.prompt,
+                 'values': col_values},
+        'counts': table.tolist(),
+        'row_totals': table.sum(axis=1).tolist(),
+        'col_totals': table.sum(axis=0).tolist(),
+        }
+
+    # per row segment stats of a range question, from its histogram
+
+    if col_question.type == 'range':
+        crosstab['stats'] = [histogram_stats(dict(zip(col_values,
+                             counts))) for counts in table.tolist()]
+    return crosstab
+
+
+def parse_crosstab_filter(value, survey_questions):
+
+    # ?where=<q_index>:<answer>, e.g. where=2:Dog
+
+    (q_index, answer) = value.split(':', 1)
+    q_index = int(q_index)
+    if not 0 <= q_index < len(survey_questions):
+        raise ValueError(value)
+    codes = answer_codes(survey_questions[q_index])
+    if codes is None:
+        return (q_index, (1 if answer else 0))
+    return (q_index, codes[answer])
+
+## Results crosstab
+#############################################################
+
+#############################################################
+## Results search
+#############################################################
+
+# Hits per /results/search page unless ?limit= says otherwise
+SEARCH_PAGE_SIZE = 50
+
+# Rewriting an answer drops its index entry and gives it the next doc id,
+# so search results are newest write first, as in CsvSearchIndex
+SEARCH_UNINDEX_SQL = 'DELETE FROM answer_search WHERE rowid = ' \
+    '(SELECT doc_id FROM search_docs WHERE session_id = ? AND q_index = ?)'
+SEARCH_DOCS_SQL = 'INSERT OR REPLACE INTO search_docs (session_id, q_index) ' \
+    'VALUES (?, ?)'
+SEARCH_INDEX_SQL = 'INSERT INTO answer_search (rowid, response) ' \
+    'SELECT doc_id, ? FROM search_docs WHERE session_id = ? AND q_index = ?'
+SEARCH_QUERY_DB = 'SELECT f.rowid, s.session_id, s.start_time, a.q_index, ' \
+    'q.prompt, a.response FROM answer_search f ' \
+    'CROSS JOIN search_docs d ON d.doc_id = f.rowid ' \
+    'CROSS JOIN answers a ON a.session_id = d.session_id ' \
+    'AND a.q_index = d.q_index ' \
+    'CROSS JOIN sessions s ON s.session_id = d.session_id ' \
+    'CROSS JOIN questions q ON q.q_id = a.q_id WHERE answer_search MATCH ?'
+
+
+def search_terms(text):
+
+    # Words as FTS5's unicode61 tokenizer splits them: runs of letters and
+    # digits, lowercased
+
+    return re.findall(r'[^\W_]+', str(text).lower())
+
+
+def matches_terms(terms, text):
+    words = search_terms(text)
+    return all(any(word.startswith(term) for word in words)
+               for term in terms)
+
+
+def search_updates(responses, survey_questions):
+
+    # The (session_id, q_index) of the text answers in a batch, to give them
+    # a new doc id, and the (text, session_id, q_index) replacing their index
+    # entries, the last one per key. Empty answers are indexed as empty
+    # documents, which match nothing.
+
+    latest = {}
+    for response in responses:
+        q_index = response['q_index']
+        if q_index < len(survey_questions) \
+            and survey_questions[q_index].type == 'text':
+            latest[(response['session_id'], q_index)] = \
+                ('' if response['response'] is None
+                 else str(response['response']))
+    return (list(latest), [(text, session_id, q_index) for ((session_id,
+            q_index), text) in latest.items()])
+
+
+def search_db(terms, after=None, limit=None, survey_id=DEFAULT_SURVEY):
+
+    # Prefix queries of every term; FTS5 walks the matches in rowid order,
+    # so a page stops after `limit` of them
+
+    query = SEARCH_QUERY_DB
+    params = [' '.join('"{}"*'.format(term) for term in terms)]
+    if after is not None:
+        query += ' AND f.rowid < ?'
+        params.append(after)
+    query += ' ORDER BY f.rowid DESC'
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+    return [(row[0], result_row_db(row[1:])) for row in
+            get_db(survey_id).execute(query, params)]
+
+
+class CsvSearchIndex(CsvLogFollower):
+
+    # Inverted index of the csv log's text answers: every answer written
+    # gets the next doc id, and each word the ids of the answers it is in.
+    # Overwritten answers stay in the postings and are skipped at query
+    # time. Prefixes are looked up in the sorted words.
+
+    def reset(self):
+        super().reset()
+        self.live = {}
+        self.docs = []
+        self.postings = collections.defaultdict(list)
+        self.words = []
+
+    def add(self, row, survey_questions):
+        key = (row['session_id'], int(row['q_index']))
+        seq = int(row.get('seq') or 0)
+        previous = self.live.get(key)
+        if previous is not None:
+            if seq < previous[0]:
+                return
+            self.docs[previous[1]] = None
+        if key[1] >= len(survey_questions) \
+            or survey_questions[key[1]].type != 'text':
+            return
+        doc_id = len(self.docs)
+        self.docs.append(row)
+        self.live[key] = (seq, doc_id)
+        for word in set(search_terms(row['response'])):
+            if word not in self.postings:
+                self.words = None
+            self.postings[word].append(doc_id)
+
+    def matching(self, term):
+        docs = set()
+        n = bisect.bisect_left(self.words, term)
+        while n < len(self.words) and self.words[n].startswith(term):
+            docs.update(self.postings[self.words[n]])
+            n += 1
+        return docs
+
+    def search(self, terms, after=None, limit=None):
+        with self.lock:
+            self.update()
+            if self.words is None:
+                self.words = sorted(self.postings)
+            docs = set.intersection(*[self.matching(term) for term in
+                                    terms])
+            docs = (doc_id for doc_id in docs if self.docs[doc_id] is not None
+                    and (after is None or doc_id < after))
+            doc_ids = (heapq.nlargest(limit, docs) if limit is not None
+                       else sorted(docs, reverse=True))
+            return [(doc_id, dict(zip(EXPORT_COLUMNS,
+                    export_row(self.docs[doc_id])))) for doc_id in doc_ids]
+
+## Results search
+#############################################################
+
+#############################################################
+## Results stream
+#############################################################
+
+class CsvChangeLog(CsvLogFollower):
+
+    # The latest rows appended to the csv log, so polling for changes reads
+    # only new bytes. Keeps STREAM_BUFFER_SIZE to 2 * STREAM_BUFFER_SIZE
+    # rows; floor is the highest seq dropped, below which reads go to the
+    # whole log.
+
+    def reset(self):
+        super().reset()
+        self.rows = []
+        self.floor = 0
+
+    def add(self, row, survey_questions):
+        self.rows.append((int(row.get('seq') or 0), row))
+        if len(self.rows) > 2 * STREAM_BUFFER_SIZE:
+
+            # rows from the archive come first after a compaction, so they
+            # aren't in seq order
+
+            self.rows.sort(key=lambda item: item[0])
+            self.floor = max(self.floor, self.rows[-STREAM_BUFFER_SIZE
+                             - 1][0])
+            del self.rows[:-STREAM_BUFFER_SIZE]
+
+    def changes(self, after=None, limit=None):
+
+        # None if rows after `after` may have been dropped
+
+        with self.lock:
+            self.update()
+            if (0 if after is None else after) < self.floor:
+                return None
+            return live_changes(dict(enumerate(self.rows)), after, limit)
+
+    def last_change(self):
+        with self.lock:
+            self.update()
+            return max([seq for (seq, row) in self.rows] + [self.floor])
+
+
+class ChangeFeed:
+
+    # The shared fan-out of one survey's changes in a worker. While anyone
+    # is subscribed, a thread polls the backend for changes after the newest
+    # cursor it has seen and keeps the last STREAM_BUFFER_SIZE of them, then
+    # calls every subscriber's wake(). Subscribers read from the buffer, so
+    # the number of streams doesn't add storage reads; one that is further
+    # behind than the buffer reads storage itself until it catches up.
+
+    def __init__(self, survey_id):
+        self.survey_id = survey_id
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.waiters = set()
+        self.thread = None
+        self.cursors = []
+        self.rows = []
+        self.floor = self.head = 0
+
+    def subscribe(self, wake):
+
+        # Returns the newest cursor, where a stream without one starts
+
+        with self.lock:
+            self.waiters.add(wake)
+            if self.thread is not None:
+                return self.head
+        head = storage_for(self.survey_id).last_change()
+        with self.lock:
+            if self.thread is None:
+                self.floor = self.head = head
+                self.cursors = []
+                self.rows = []
+                self.thread = threading.Thread(target=self.poll, daemon=True)
+                self.thread.start()
+            return self.head
+
+    def unsubscribe(self, wake):
+        with self.lock:
+            self.waiters.discard(wake)
+            if not self.waiters:
+                self.wakeup.set()
+
+    def notify(self):
+        self.wakeup.set()
+
+    def buffered(self, after):
+
+        # Buffered changes after the `after` cursor, None if the buffer
+        # doesn't reach back that far
+
+        with self.lock:
+            if after < self.floor:
+                return None
+            n = bisect.bisect_right(self.cursors, after)
+            return list(zip(self.cursors[n:], self.rows[n:]))
+
+    def changes(self, after):
+        changes = self.buffered(after)
+        if changes is None:
+            changes = storage_for(self.survey_id).changes(after,
+                    STREAM_BUFFER_SIZE)
+        return changes
+
+    def poll(self):
+        while True:
+            self.wakeup.wait(STREAM_POLL_INTERVAL)
+            self.wakeup.clear()
+            with self.lock:
+                if not self.waiters:
+                    self.thread = None
+                    return
+                head = self.head
+            try:
+                changes = storage_for(self.survey_id).changes(head,
+                        STREAM_BUFFER_SIZE)
+            except Exception:
+                app.logger.exception('Failed to read changes of survey %s',
+                                     self.survey_id)
+                continue
+            if not changes:
+                continue
+            with self.lock:
+                for (cursor, row) in changes:
+                    self.cursors.append(cursor)
+                    self.rows.append(row)
+                self.head = changes[-1][0]
+                dropped = len(self.cursors) - STREAM_BUFFER_SIZE
+                if dropped > 0:
+                    self.floor = self.cursors[dropped - 1]
+                    del self.cursors[:dropped]
+                    del self.rows[:dropped]
+                waiters = list(self.waiters)
+            for wake in waiters:
+                wake()
+            if len(changes) == STREAM_BUFFER_SIZE:
+                self.wakeup.set()
+
+
+# survey id -> its ChangeFeed in this worker
+change_feeds = {}
+change_feeds_lock = threading.Lock()
+
+
+def change_feed(survey_id):
+    with change_feeds_lock:
+        feed = change_feeds.get(survey_id)
+        if feed is None:
+            feed = change_feeds[survey_id] = ChangeFeed(survey_id)
+    return feed
+
+
+def notify_changes(survey_id):
+
+    # Writes in this worker reach its streams without waiting for a poll
+
+    feed = change_feeds.get(survey_id)
+    if feed is not None:
+        feed.notify()
+
+
+def stream_event(cursor, changes=None):
+
+    # An event per batch of changes, with the cursor as its id so an
+    # EventSource reconnects from there (Last-Event-ID). The first event of
+    # a stream is 'ready' with the cursor it starts from.
+
+    if changes is None:
+        return 'id: {}\nevent: ready\ndata: {{}}\n\n'.format(cursor)
+    return 'id: {}\nevent: answers\ndata: {}\n\n'.format(cursor,
+            json.dumps([row for (change, row) in changes], default=str))
+
+
+STREAM_KEEPALIVE_EVENT = ': keepalive\n\n'
+
+
+def stream_changes(survey_id, after=None):
+    feed = change_feed(survey_id)
+    ready = threading.Event()
+    head = feed.subscribe(ready.set)
+    try:
+        after = (head if after is None else after)
+        yield stream_event(after)
+        while True:
+            changes = feed.changes(after)
+            if changes:
+                after = changes[-1][0]
+                yield stream_event(after, changes)
+                continue
+            if not ready.wait(STREAM_KEEPALIVE):
+                yield STREAM_KEEPALIVE_EVENT
+            ready.clear()
+    finally:
+        feed.unsubscribe(ready.set)
+
+## Results stream
+#############################################################
+
+#############################################################
+## Instrumentation
+#############################################################
+
+# Most phases take well under the default buckets' 5ms floor
+
+TIMING_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                  0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+if METRICS:
+    REQUEST_SECONDS = prometheus_client.Histogram('survey_request_seconds',
+            'Time to handle a request, including the session',
+            ['endpoint', 'method'], buckets=TIMING_BUCKETS)
+    PHASE_SECONDS = prometheus_client.Histogram('survey_phase_seconds',
+            'Time spent in each phase of handling a request', ['phase'],
+            buckets=TIMING_BUCKETS)
+    STORAGE_SECONDS = prometheus_client.Histogram('survey_storage_seconds',
+            'Time spent in storage backend calls', ['backend', 'operation'],
+            buckets=TIMING_BUCKETS)
+    ANSWERS = prometheus_client.Counter('survey_answers',
+            'Submitted answers by outcome: written, duplicate (skipped by '
+            'the dedup window) or stale_page (not applied)', ['outcome'])
+else:
+    REQUEST_SECONDS = PHASE_SECONDS = STORAGE_SECONDS = ANSWERS = None
+
+
+def observe(histogram, labels, seconds):
+    if histogram is not None:
+        histogram.labels(*labels).observe(seconds)
+
+
+def increment(counter, labels):
+    if counter is not None:
+        counter.labels(*labels).inc()
+
+
+@contextmanager
+def timed(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(PHASE_SECONDS, [phase], time.perf_counter() - started)
+
+
+def metrics_registry():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return prometheus_client.REGISTRY
+
+
+class TimedSessionInterface(SessionInterface):
+
+    # Times loading and saving the session around whichever interface
+    # set_session_store() picked
+
+    def __init__(self, session_interface):
+        self.session_interface = session_interface
+
+    def open_session(self, app, request):
+        with timed('session_open'):
+            return self.session_interface.open_session(app, request)
+
+    def save_session(self, app, session, response):
+        with timed('session_save'):
+            return self.session_interface.save_session(app, session,
+                    response)
+
+
+class TimedBackend:
+
+    # Wraps the selected backend so every storage call is timed, including
+    # the write-behind flusher's. Results and exports are iterated lazily by
+    # the caller, so for those only the time spent producing rows counts.
+
+    OPERATIONS = {'write_answer', 'write_batch', 'iter_results',
+                  'iter_export', 'iter_answers', 'answer_counts', 'summarize',
+                  'search', 'changes', 'last_change', 'compact'}
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if not METRICS or name not in self.OPERATIONS:
+            return attr
+        labels = [self.backend.name, name]
+
+        def timed_call(*args, **kwargs):
+            started = time.perf_counter()
+            result = attr(*args, **kwargs)
+            elapsed = time.perf_counter() - started
+            if name.startswith('iter_'):
+                return self.timed_rows(labels, result, elapsed)
+            observe(STORAGE_SECONDS, labels, elapsed)
+            return result
+
+        return timed_call
+
+    def timed_rows(self, labels, rows, elapsed):
+        rows = iter(rows)
+        while True:
+            started = time.perf_counter()
+            try:
+                row = next(rows)
+            except StopIteration:
+                elapsed += time.perf_counter() - started
+                break
+            elapsed += time.perf_counter() - started
+            yield row
+        observe(STORAGE_SECONDS, labels, elapsed)
+
+
+class StackSampler:
+
+    # Samples one thread's stack from a background thread. Stacks are kept
+    # collapsed, root first and ';'-separated, with their sample counts.
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                name='stack-sampler')
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name,
+                             os.path.basename(code.co_filename),
+                             frame.f_lineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for (stack, count) in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+
+class RequestTimer:
+
+    # WSGI middleware, so the request time includes opening and saving the
+    # session, which happen outside Flask's request hooks. The endpoint is
+    # filled in by label_endpoint(). Streamed responses are timed until the
+    # body starts.
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        sampler = None
+        if PROFILE == 'all' or PROFILE == 'header' \
+            and environ.get('HTTP_X_PROFILE') == '1':
+            sampler = StackSampler(threading.get_ident(), PROFILE_INTERVAL)
+            sampler.start()
+        started = time.perf_counter()
+        try:
+            return self.wsgi_app(environ, start_response)
+        finally:
+            elapsed = time.perf_counter() - started
+            endpoint = environ.get('survey.endpoint', 'unmatched')
+            observe(REQUEST_SECONDS, [endpoint, environ['REQUEST_METHOD']],
+                    elapsed)
+            if sampler is not None:
+                sampler.stop()
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                path = os.path.join(PROFILE_DIR, '{}-{}-{}.txt'.format(
+                    time.strftime('%Y%m%dT%H%M%S'), endpoint,
+                    uuid.uuid4().hex[:8]))
+                sampler.write(path)
+                app.logger.info('Profiled %s %s in %.1fms: %s',
+                                environ['REQUEST_METHOD'],
+                                environ.get('PATH_INFO'), elapsed * 1000,
+                                path)
+
+
+@app.before_request
+def label_endpoint():
+    request.environ['survey.endpoint'] = request.endpoint or 'unmatched'
+
+
+app.wsgi_app = RequestTimer(app.wsgi_app)
+
+## Instrumentation
+#############################################################
+
+#############################################################
+## Storage backends
+#############################################################
+
+class StorageBackend(abc.ABC):
+
+    # What every storage backend provides. Answers are the response dicts
+    # built by set_answer(). bench/conformance.py checks that
+    # backends behave the same and bench/bench_backends.py compares them.
+    # An instance only ever reads and writes one survey's partition.
+
+    name = None
+
+    def __init__(self, survey_id=DEFAULT_SURVEY):
+        self.survey_id = survey_id
+
+    def questions(self):
+        return surveys.get(self.survey_id).questions
+
+    def setup(self):
+
+        # Create whatever the backend needs. Runs once per process.
+
+        pass
+
+    def write_answer(self, response):
+        return self.write_batch([response])
+
+    @abc.abstractmethod
+    def write_batch(self, responses):
+        pass
+
+    @abc.abstractmethod
+    def iter_results(self, after=None, limit=None, since=None, until=None):
+
+        # Result dicts ordered by results_key(), after the `after` key, at
+        # most `limit` of them, of sessions that started in [since, until)
+
+        pass
+
+    @abc.abstractmethod
+    def iter_export(self, since=None, until=None, session_id=None):
+
+        # Rows as lists in EXPORT_COLUMNS order
+
+        pass
+
+    def iter_answers(self):
+
+        # Live answers as (session_id, start_time, q_index, response) in any
+        # order, for the crosstab arrays
+
+        for (session_id, start_time, q_index, question, response) in \
+            self.iter_export():
+            yield (session_id, start_time, q_index, response)
+
+    @abc.abstractmethod
+    def answer_counts(self):
+
+        # Counter of (q_index, summary_bucket) -> number of live answers
+
+        pass
+
+    def summarize(self):
+        return build_summary(self.answer_counts(), self.questions())
+
+    def version(self):
+
+        # A token that changes whenever the stored answers do, or None if
+        # the backend can't tell. Crosstabs reuse their arrays until then.
+
+        return None
+
+    def search(self, terms, after=None, limit=None):
+
+        # (cursor, result dict) of the live text answers with a word
+        # starting with each of `terms`, newest first, from before the
+        # `after` cursor. Backends with an index override this scan.
+
+        survey_questions = self.questions()
+        hits = []
+        for (n, row) in enumerate(self.iter_export()):
+            q_index = int(row[2])
+            if (after is None or n < after) and q_index \
+                < len(survey_questions) and survey_questions[q_index].type \
+                == 'text' and matches_terms(terms, row[4]):
+                hits.append((n, dict(zip(EXPORT_COLUMNS, row))))
+        hits.reverse()
+        return hits[:limit]
+
+    @abc.abstractmethod
+    def changes(self, after=None, limit=None):
+
+        # (cursor, result dict) of the answers written or overwritten after
+        # the `after` cursor (from the start if None), oldest first, at most
+        # `limit` of them. Cursors are ints that increase in write order.
+
+        pass
+
+    @abc.abstractmethod
+    def last_change(self):
+
+        # The cursor of the latest write, 0 if there is none
+
+        pass
+
+    def compact(self):
+
+        # Drop overwritten answers and those past retention, returns how
+        # many were dropped
+
+        return 0
+
+
+class CsvBackend(StorageBackend):
+
+    name = 'csv'
+
+    def __init__(self, survey_id=DEFAULT_SURVEY):
+        super().__init__(survey_id)
+        self.summary = CsvSummary(survey_id)
+        self.search_index = CsvSearchIndex(survey_id)
+        self.change_log = CsvChangeLog(survey_id)
+
+    def setup(self):
+        create_csv(self.survey_id)
+
+    def write_batch(self, responses):
+        return write_responses_csv(responses, self.survey_id)
+
+    def iter_results(self, after=None, limit=None, since=None, until=None):
+        return iter_results_csv(after, limit, since, until, self.survey_id)
+
+    def iter_export(self, since=None, until=None, session_id=None):
+        return iter_export_csv(since, until, session_id, self.survey_id)
+
+    def iter_answers(self):
+        live, total = read_csv_log(None, self.survey_id)
+        return live_answers(live)
+
+    def answer_counts(self):
+        return self.summary.refresh()
+
+    def search(self, terms, after=None, limit=None):
+        return self.search_index.search(terms, after, limit)
+
+    def changes(self, after=None, limit=None):
+
+        # Cursors are seqs, which writers take under the log lock
+
+        changes = self.change_log.changes(after, limit)
+        if changes is None:
+            live, total = read_csv_log(None, self.survey_id)
+            changes = live_changes(live, after, limit)
+        return changes
+
+    def last_change(self):
+        return self.change_log.last_change()
+
+    def version(self):
+
+        # Writes append to the log and compaction replaces it, archive
+        # included
+
+        try:
+            stat = os.stat(partition_path(CSV_FILE_NAME, self.survey_id))
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def compact(self):
+        return compact_csv(self.survey_id)
+
+
+class SqliteBackend(StorageBackend):
+
+    name = 'db'
+
+    def setup(self):
+        create_db(self.survey_id)
+
+    def write_batch(self, responses):
+
+        # the write-behind flusher thread gets its own connection
+
+        write_responses_db(get_db(self.survey_id), responses, self.survey_id)
+
+    def iter_results(self, after=None, limit=None, since=None, until=None):
+        return iter_results_db(after, limit, since, until, self.survey_id)
+
+    def iter_export(self, since=None, until=None, session_id=None):
+        return iter_export_db(since, until, session_id, self.survey_id)
+
+    def iter_answers(self):
+        return iter_answers_db(self.survey_id)
+
+    def answer_counts(self):
+        return answer_counts_db(self.survey_id)
+
+    def search(self, terms, after=None, limit=None):
+        return search_db(terms, after, limit, self.survey_id)
+
+    def changes(self, after=None, limit=None):
+        return changes_db(after, limit, self.survey_id)
+
+    def last_change(self):
+        return get_db(self.survey_id).execute(LAST_CHANGE_DB).fetchone()[0]
+
+    def version(self):
+
+        # Read from the data itself, so it's the same on every connection:
+        # every write takes a new change_id, and answer_counts adds up to
+        # the number of answers, which retention lowers. Both are index
+        # lookups, where COUNT(*) would scan answers.
+
+        return get_db(self.survey_id).execute(VERSION_QUERY_DB).fetchone()
+
+    def compact(self):
+
+        # SQLite reuses the space of overwritten rows; only retention drops
+        # anything
+
+        return prune_db(self.survey_id)
+
+
+class ObjectStoreBackend(StorageBackend):
+
+    # survey-app-gcp's answer log (see objectstore.py) as a backend. Results
+    # and exports read the whole log; changes() follows it.
+
+    name = 'object'
+
+    # One handle for the bucket, shared by every survey's backend
+    bucket = None
+    bucket_lock = threading.Lock()
+
+    def __init__(self, survey_id=DEFAULT_SURVEY):
+
+        # Imported here, so the other storage types don't need it
+
+        import objectstore
+        super().__init__(survey_id)
+        with self.bucket_lock:
+            if ObjectStoreBackend.bucket is None:
+                ObjectStoreBackend.bucket = objectstore.LazyBucket(
+                    BUCKET_NAME, LOCAL_BUCKET_DIR, LOCAL_BUCKET_LATENCY)
+        if survey_id == DEFAULT_SURVEY:
+            (object_name, shard_prefix) = (OBJECT_NAME, SHARD_PREFIX)
+        else:
+            prefix = '{}{}/'.format(SURVEY_OBJECT_PREFIX, survey_id)
+            (object_name, shard_prefix) = (prefix + OBJECT_NAME, prefix
+                    + 'shards/')
+        self.live_counts = LiveCounts(survey_id)
+        self.log = objectstore.ObjectLog(self.bucket, object_name,
+                shard_prefix, CSV_COLUMN_NAMES, GCS_MERGE_INTERVAL,
+                CSV_COMPACT_RATIO, [self.live_counts])
+
+    def setup(self):
+        self.log.ensure()
+
+    def write_batch(self, responses):
+        return self.log.write_batch(responses)
+
+    def merge(self):
+        return self.log.merge()
+
+    def iter_results(self, after=None, limit=None, since=None, until=None):
+        live, total, generation = self.log.read(time_filter(since, until))
+        if since is None and until is None \
+            and self.log.needs_compaction(live, total):
+            self.log.write_compacted(live, total, generation,
+                                     time_filter(retention_cutoff()))
+        return page_live_rows(live, after, limit)
+
+    def iter_export(self, since=None, until=None, session_id=None):
+        live, total, generation = self.log.read(time_filter(since, until,
+                session_id))
+        return export_live_rows(live)
+
+    def iter_answers(self):
+        with self.log.follow_lock:
+            live = self.log.follow()[0]
+            return list(live_answers(live))
+
+    def changes(self, after=None, limit=None):
+
+        # Seqs are taken per shard, so a shard merged late from another
+        # instance can land behind a cursor already handed out. Nothing
+        # past the newest seq means no changes, without scanning the rows.
+
+        with self.log.follow_lock:
+            (live, total, head, generation) = self.log.follow()
+            if after is not None and after >= head:
+                return []
+            return live_changes(live, after, limit)
+
+    def last_change(self):
+        return self.log.follow()[2]
+
+    def answer_counts(self):
+
+        # Carried forward with the followed log, like CsvSummary's
+
+        with self.log.follow_lock:
+            live = self.log.follow()[0]
+            if self.log.following():
+                return collections.Counter(self.live_counts.counts)
+            return count_live_rows(live, self.questions())
+
+    def version(self):
+        return self.log.version()
+
+    def compact(self):
+
+        # Drops overwritten answers and sessions past retention
+
+        return self.log.compact(time_filter(retention_cutoff()))
+
+
+BACKENDS = {
+    'csv': CsvBackend,
+    'db': SqliteBackend,
+    'object': ObjectStoreBackend,
+    }
+
+# survey id -> its backend, created on the survey's first use. `backend` is
+# the default survey's.
+backends = {}
+backends_lock = threading.Lock()
+backend = None
+
+
+def storage_for(survey_id):
+    survey_backend = backends.get(survey_id)
+    if survey_backend is None:
+        with backends_lock:
+            survey_backend = backends.get(survey_id)
+            if survey_backend is None:
+                survey_backend = \
+                    TimedBackend(BACKENDS[STORAGE_TYPE](survey_id))
+                survey_backend.setup()
+                backends[survey_id] = survey_backend
+    return survey_backend
+
+
+def set_storage(name):
+    global STORAGE_TYPE, backend
+    STORAGE_TYPE = name
+    with backends_lock:
+        backends.clear()
+    backend = storage_for(DEFAULT_SURVEY)
+    return backend
+
+
+set_storage(STORAGE_TYPE)
+
+## Storage backends
+#############################################################
+
+#############################################################
+## Write-behind queue
+#############################################################
+
+write_queue = None
+
+
+def write_survey_batch(survey_id, responses):
+
+    # True once the answers are written, otherwise logs why
+
+    try:
+        error = storage_for(survey_id).write_batch(responses)
+    except Exception:
+        app.logger.exception('Failed to write %d queued answers of survey %s',
+                             len(responses), survey_id)
+        return False
+    if error is not None:
+        app.logger.error('Failed to write %d queued answers of survey %s: %s',
+                         len(responses), survey_id, error)
+        return False
+    return True
+
+
+def write_batch(items):
+
+    # Queued items are (survey id, answer). Each survey's answers go to its
+    # own partition in one batch. Backends are looked up per batch so
+    # set_storage() also applies to queued answers. A survey whose write
+    # fails doesn't keep the others from being written; its items are
+    # returned for the queue to retry.
+
+    by_survey = collections.defaultdict(list)
+    for (survey_id, response) in items:
+        by_survey[survey_id].append(response)
+    unwritten = []
+    for (survey_id, responses) in by_survey.items():
+        if write_survey_batch(survey_id, responses):
+            notify_changes(survey_id)
+        else:
+            unwritten.extend((survey_id, response) for response in
+                             responses)
+    return unwritten
+
+
+def start_write_behind():
+
+    # The queue is objectstore.py's, shared with survey-app-gcp
+
+    import objectstore
+    global write_queue
+    write_queue = objectstore.WriteBehindQueue(write_batch,
+            WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL, WRITE_QUEUE_SIZE,
+            app.logger)
+
+
+def restart_write_behind():
+
+    # Threads don't survive fork, so gunicorn --preload workers start their
+    # own flusher, on a queue of their own since the parent's flusher may
+    # have held its locks. Answers queued before the fork are the parent's.
+
+    if write_queue is not None:
+        start_write_behind()
+
+
+def close_write_behind():
+    if write_queue is not None:
+        write_queue.close()
+
+
+def flush_writes():
+    if write_queue is not None and not write_queue.flush(WRITE_QUEUE_TIMEOUT):
+        app.logger.warning('Reading without the answers still queued')
+
+
+if WRITE_BEHIND:
+    start_write_behind()
+    atexit.register(close_write_behind)
+os.register_at_fork(after_in_child=restart_write_behind)
+
+## Write-behind queue
 #############################################################
 
-@app.route('/', methods=['GET', 'POST'])
-def start():
-    reset_session()
-    if STORAGE_TYPE == 'csv':
-        return start_csv()
+#############################################################
+## Session store
+#############################################################
+
+class MemorySessionStore:
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, sid):
+        with self.lock:
+            entry = self.entries.get(sid)
+            if entry is None:
+                return None
+            (expires, data) = entry
+            if expires < time.time():
+                del self.entries[sid]
+                return None
+            self.entries.move_to_end(sid)
+            return data
+
+    def set(self, sid, data):
+        with self.lock:
+            self.entries[sid] = (time.time() + self.ttl, data)
+            self.entries.move_to_end(sid)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self.lock:
+            self.entries.pop(sid, None)
+
+
+class SqliteSessionStore:
+
+    # Expired sessions are skipped on read and purged every PURGE_EVERY
+    # writes, so there's no extra statement on the hot path.
+
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.serializer = TaggedJSONSerializer()
+        self.local = threading.local()
+        self.writes = itertools.count()
+        conn = self.connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS session_store '
+                     '(sid TEXT PRIMARY KEY, data TEXT NOT NULL, '
+                     'expires INTEGER NOT NULL)')
+        conn.commit()
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = self.local.conn = sqlite3.connect(self.path,
+                    timeout=DB_BUSY_TIMEOUT)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.pid = os.getpid()
+        return conn
+
+    def get(self, sid):
+        row = self.connect().execute('SELECT data FROM session_store '
+                'WHERE sid = ? AND expires >= ?', (sid,
+                int(time.time()))).fetchone()
+        return (self.serializer.loads(row[0]) if row else None)
+
+    def set(self, sid, data):
+        conn = self.connect()
+        now = int(time.time())
+        conn.execute('INSERT OR REPLACE INTO session_store VALUES (?, ?, ?)',
+                     (sid, self.serializer.dumps(data), now + self.ttl))
+        if next(self.writes) % self.PURGE_EVERY == 0:
+            conn.execute('DELETE FROM session_store WHERE expires < ?',
+                         (now, ))
+        conn.commit()
+
+    def delete(self, sid):
+        conn = self.connect()
+        conn.execute('DELETE FROM session_store WHERE sid = ?', (sid, ))
+        conn.commit()
+
+
+class ServerSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, store_sid=None):
+
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.store_sid = store_sid
+        self.modified = False
+
+
+class ServerSideSessionInterface(SessionInterface):
+
+    # The survey's own sid is the store key, so reset_session() starting a
+    # new survey also moves the session to a new key.
+
+    def __init__(self, store):
+        self.store = store
+
+    def get_signer(self, app):
+        return Signer(app.secret_key, salt='survey-session')
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self.get_signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            data = (self.store.get(sid) if sid else None)
+            if data is not None:
+                return ServerSession(data, sid)
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        sid = session.get('sid')
+        if session.store_sid and session.store_sid != sid:
+            self.store.delete(session.store_sid)
+        if not sid:
+            if session.store_sid:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if session.modified or session.store_sid != sid:
+            self.store.set(sid, dict(session))
+        if session.store_sid != sid:
+            response.set_cookie(
+                name,
+                self.get_signer(app).sign(sid).decode(),
+                httponly=self.get_cookie_httponly(app),
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+                domain=domain,
+                path=path,
+                )
+
+
+def set_session_store(kind):
+    if kind == 'memory':
+        session_interface = \
+            ServerSideSessionInterface(MemorySessionStore(SESSION_MAX_ENTRIES,
+                SESSION_TTL))
+    elif kind == 'sqlite':
+        session_interface = \
+            ServerSideSessionInterface(SqliteSessionStore(SESSION_DATABASE,
+                SESSION_TTL))
     else:
-        return start_db()
+        session_interface = SecureCookieSessionInterface()
+    app.session_interface = TimedSessionInterface(session_interface)
+
+
+set_session_store(SESSION_STORE)
+
+## Session store
+#############################################################
+
+#############################################################
+## Answer dedup
+#############################################################
+
+class AnswerDedup:
+
+    # The last answer written per session and question, with the nonce of
+    # the page it was submitted from, kept in one of the session store
+    # classes above so entries expire after the window.
+
+    def __init__(self, store, shared):
+        self.store = store
+        self.shared = shared
+
+    def key(self, response):
+        return 'answer:{}:{}'.format(response['session_id'],
+                                     response['q_index'])
+
+    def unchanged(self, response, nonce):
+        last = self.store.get(self.key(response))
+        return last is not None and last['response'] \
+            == response['response'] and last['question'] \
+            == response['question'] and (self.shared or bool(nonce)
+                and last['nonce'] == nonce)
 
+    def written(self, response, nonce):
+        self.store.set(self.key(response), {
+            'response': response['response'],
+            'question': response['question'],
+            'nonce': nonce,
+            })
 
-@app.route('/results', methods=['GET'])
-def results():
-    if STORAGE_TYPE == 'csv':
-        return results_csv()
+
+answer_dedup = None
+
+
+def set_answer_dedup(kind):
+    global answer_dedup
+    if kind == 'memory':
+        answer_dedup = AnswerDedup(MemorySessionStore(ANSWER_DEDUP_MAX_ENTRIES,
+                                   ANSWER_DEDUP_WINDOW), False)
+    elif kind == 'sqlite':
+        answer_dedup = AnswerDedup(SqliteSessionStore(ANSWER_DEDUP_DATABASE,
+                                   ANSWER_DEDUP_WINDOW), True)
     else:
-        return results_db()
+        answer_dedup = None
+
+
+set_answer_dedup(ANSWER_DEDUP)
+
+## Answer dedup
+#############################################################
+
+#############################################################
+## Client survey
+#############################################################
+
+REQUIRED_ANSWER_ERROR = \
+    'This is a required question. Please enter a response before you can move on.'
+INVALID_ANSWER_ERROR = 'This is not a valid response to this question.'
+
+
+def valid_answer(question, answer):
+    if answer == '' or question.type == 'text':
+        return True
+    if question.type == 'choice':
+        return answer in question.options
+    try:
+        return question.range_min <= int(answer) <= question.range_max
+    except ValueError:
+        return False
+
+
+def apply_checkpoint(state, survey, checkpoint):
+
+    # Applies a checkpoint from the client survey page to the session in
+    # `state`: {'answers': [{'q_index': n, 'response': ...}, ...], 'q_index':
+    # the question the page is on, 'done': true with the last answer,
+    # 'nonce': the page load, 'seq': its count of checkpoints}. Returns the
+    # answers to write, the errors by q_index and whether the survey is
+    # complete, or None for a checkpoint older than one already applied
+    # (beacons and retries may arrive out of order). Raises ValueError for
+    # one that doesn't fit the survey.
+    #
+    # The rules of question() hold: an empty mandatory answer isn't written
+    # and is an error, and the survey is only complete once every mandatory
+    # question has an answer.
+
+    answers = checkpoint.get('answers', [])
+    q_index = checkpoint.get('q_index', state['q_index'])
+    (nonce, seq) = (checkpoint.get('nonce', ''), checkpoint.get('seq', 0))
+    count = len(survey.questions)
+    if not isinstance(answers, list) or len(answers) > count \
+        or type(q_index) is not int or not 0 <= q_index < count \
+        or not isinstance(nonce, str) or type(seq) is not int:
+        raise ValueError('invalid checkpoint')
+    for item in answers:
+        if not isinstance(item, dict) or type(item.get('q_index')) \
+            is not int or not 0 <= item['q_index'] < count \
+            or isinstance(item.get('response'), (dict, list)):
+            raise ValueError('invalid answer')
+    last = state.get('checkpoint')
+    if nonce and last is not None and last[0] == nonce and seq <= last[1]:
+        return None
+    state['checkpoint'] = [nonce, seq]
+
+    responses = {}
+    errors = {}
+    for item in answers:
+        question = survey.questions[item['q_index']]
+        answer = item.get('response')
+        answer = ('' if answer is None else str(answer).strip())
+        if question.mandatory and answer == '':
+            errors[question.q_index] = REQUIRED_ANSWER_ERROR
+        elif not valid_answer(question, answer):
+            errors[question.q_index] = INVALID_ANSWER_ERROR
+        else:
+            errors.pop(question.q_index, None)
+            responses[question.q_index] = set_answer(state, question,
+                    question.q_index, answer)
+    state['q_index'] = q_index
+    done = checkpoint.get('done') is True
+    if done:
+        for question in survey.questions:
+            if question.mandatory and state['responses'][question.q_index] \
+                in ('', None):
+                errors.setdefault(question.q_index, REQUIRED_ANSWER_ERROR)
+    return list(responses.values()), errors, done and not errors
+
+
+def checkpoint_result(written, errors, done):
+    return {
+        'written': written,
+        'errors': dict((str(q_index), error) for (q_index, error) in
+                       sorted(errors.items())),
+        'done': done,
+        }
+
+## Client survey
+#############################################################
+
+#############################################################
+## Flask App functions
+#############################################################
+
+# Every route is served for DEFAULT_SURVEY at its bare URL and for any
+# survey under /s/<survey_id>/.
+
+@app.route('/', methods=['GET', 'POST'],
+           defaults={'survey_id': DEFAULT_SURVEY})
+@app.route('/s/<survey_id>/', methods=['GET', 'POST'])
+def start(survey_id):
+    survey_storage(survey_id)
+    if SURVEY_MODE == 'client':
+        return redirect(url_for('client_survey', survey_id=survey_id))
+    reset_session(survey_id)
+    return redirect(url_for('question', survey_id=survey_id, q_index=0))
+
+
+@app.route('/survey', methods=['GET'],
+           defaults={'survey_id': DEFAULT_SURVEY})
+@app.route('/s/<survey_id>/survey', methods=['GET'])
+def client_survey(survey_id):
+
+    # The whole survey in one page that runs Back/Next itself and sends the
+    # answers to /api/answers. Starts a new session, as / does.
+
+    survey_storage(survey_id)
+    reset_session(survey_id)
+    return surveys.get(survey_id).page
+
+
+@app.route('/api/answers', methods=['POST'],
+           defaults={'survey_id': DEFAULT_SURVEY})
+@app.route('/s/<survey_id>/api/answers', methods=['POST'])
+def api_answers(survey_id):
+
+    # A checkpoint of answers from the client survey page, see
+    # apply_checkpoint(). Valid answers are written in one batch even when
+    # others have errors; those make it a 422 with the errors by q_index.
+
+    survey_storage(survey_id)
+    survey = current_survey(session, survey_id)
+    if survey is None:
+        return ('No survey in progress.', HTTPStatus.CONFLICT)
+    checkpoint = request.get_json(force=True, silent=True)
+    if not isinstance(checkpoint, dict):
+        return ('Invalid checkpoint.', HTTPStatus.BAD_REQUEST)
+    try:
+        applied = apply_checkpoint(session, survey, checkpoint)
+    except ValueError:
+        return ('Invalid checkpoint.', HTTPStatus.BAD_REQUEST)
+    if applied is None:
+        increment(ANSWERS, ['stale_page'])
+        return jsonify(checkpoint_result(0, {}, False))
+    (responses, errors, done) = applied
+    session.modified = True
+    with timed('write_response'):
+        error = write_responses(responses, survey_id,
+                                checkpoint.get('nonce', ''))
+    if error is not None:
+        return (error, HTTPStatus.INTERNAL_SERVER_ERROR)
+    if done:
+        reset_session(survey_id)
+    return (jsonify(checkpoint_result(len(responses), errors, done)),
+            (HTTPStatus.UNPROCESSABLE_ENTITY if errors else HTTPStatus.OK))
+
+
+@app.route('/results', methods=['GET'],
+           defaults={'survey_id': DEFAULT_SURVEY})
+@app.route('/s/<survey_id>/results', methods=['GET'])
+def results(survey_id):
+
+    # ?limit=N pages through the results with ?after=<cursor> from the
+    # previous page, ?stream=1 streams the whole table. ?since= and ?until=
+    # (ISO times, on start_time) only read the sessions in that range.
+
+    storage = survey_storage(survey_id)
+    flush_writes()
+    after = request.args.get('after')
+    limit = request.args.get('limit', type=int)
+    stream = request.args.get('stream') == '1'
+    try:
+        after = (decode_cursor(after) if after else None)
+    except (ValueError, TypeError):
+        return ('Invalid cursor.', HTTPStatus.BAD_REQUEST)
+    if limit is not None and limit <= 0:
+        return ('Invalid limit.', HTTPStatus.BAD_REQUEST)
+    try:
+        since = parse_time_arg(request.args.get('since'))
+        until = parse_time_arg(request.args.get('until'))
+    except ValueError:
+        return ('Invalid time range.', HTTPStatus.BAD_REQUEST)
+    return render_results(storage.iter_results(after, limit, since, until),
+                          after, limit, stream, survey_id, since, until)
+
+
+@app.route('/compact', methods=['POST'],
+           defaults={'survey_id': DEFAULT_SURVEY})
+@app.route('/s/<survey_id>/compact', methods=['POST'])
+def compact(survey_id):
+
+    # On-demand compaction of the append-only csv logs
+
+    storage = survey_storage(survey_id)
+    flush_writes()
+    storage.compact()
+    return ('', HTTPStatus.NO_CONTENT)
+
+
+@app.route('/results/export', methods=['GET'],
+           defaults={'survey_id': DEFAULT_SURVEY})
+@app.route('/s/<survey_id>/results/export', methods=['GET'])
+def results_export(survey_id):
+
+    # ?format=csv|ndjson|columnar, optional ?since= and ?until= (ISO times,
+    # on start_time) and ?session_id=, pushed down into the read.
+
+    storage = survey_storage(survey_id)
+    flush_writes()
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return ('Unknown format.', HTTPStatus.BAD_REQUEST)
+    try:
+        since = parse_time_arg(request.args.get('since'))
+        until = parse_time_arg(request.args.get('until'))
+    except ValueError:
+        return ('Invalid time range.', HTTPStatus.BAD_REQUEST)
+    session_id = request.args.get('session_id')
+    rows = storage.iter_export(since, until, session_id)
+    body = EXPORT_WRITERS[export_format](rows)
+    return Response(stream_with_context(body),
+                    mimetype=EXPORT_FORMATS[export_format],
+                    headers={'Content-Disposition': 'attachment; '
+                    'filename=survey_responses.{}'.format(export_format)})
+
+
+@app.route('/results/summary', methods=['GET'],
+           defaults={'survey_id': DEFAULT_SURVEY})
+@app.route('/s/<survey_id>/results/summary', methods=['GET'])
+def results_summary(survey_id):
+    storage = survey_storage(survey_id)
+    flush_writes()
+    return jsonify(storage.summarize())
+
+
+@app.route('/results/search', methods=['GET'],
+           defaults={'survey_id': DEFAULT_SURVEY})
+@app.route('/s/<survey_id>/results/search', methods=['GET'])
+def results_search(survey_id):
+
+    # ?q= finds the text answers with a word starting with each word of it,
+    # newest first. ?limit=N hits per page, then ?after=<next> from the
+    # previous page.
+
+    storage = survey_storage(survey_id)
+    flush_writes()
+    terms = search_terms(request.args.get('q', ''))
+    if not terms:
+        return ('Invalid query.', HTTPStatus.BAD_REQUEST)
+    after = request.args.get('after', type=int)
+    limit = request.args.get('limit', SEARCH_PAGE_SIZE, type=int)
+    if limit <= 0:
+        return ('Invalid limit.', HTTPStatus.BAD_REQUEST)
+    hits = storage.search(terms, after, limit)
+    return jsonify({
+        'results': [row for (cursor, row) in hits],
+        'next': (hits[-1][0] if len(hits) == limit else None),
+        })
+
+
+@app.route('/results/stream', methods=['GET'],
+           defaults={'survey_id': DEFAULT_SURVEY})
+@app.route('/s/<survey_id>/results/stream', methods=['GET'])
+def results_stream(survey_id):
+
+    # Server-sent events with the answers written or changed after ?after=
+    # (or the Last-Event-ID of a reconnecting EventSource), or from now on.
+    # Every stream holds a worker thread here; asgi.py serves them from its
+    # event loop.
+
+    survey_storage(survey_id)
+    after = request.args.get('after', request.headers.get('Last-Event-ID'))
+    try:
+        after = (int(after) if after else None)
+    except ValueError:
+        return ('Invalid cursor.', HTTPStatus.BAD_REQUEST)
+    return Response(stream_changes(survey_id, after),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/results/crosstab', methods=['GET'],
+           defaults={'survey_id': DEFAULT_SURVEY})
+@app.route('/s/<survey_id>/results/crosstab', methods=['GET'])
+def results_crosstab(survey_id):
+
+    # ?rows=<q_index>&cols=<q_index> counts the sessions per pair of answers
+    # to two questions. Repeatable ?where=<q_index>:<answer>, ?since= and
+    # ?until= narrow down the sessions counted.
+
+    storage = survey_storage(survey_id)
+    flush_writes()
+    survey_questions = storage.questions()
+    row_index = request.args.get('rows', type=int)
+    col_index = request.args.get('cols', type=int)
+    if row_index is None or col_index is None \
+        or not 0 <= row_index < len(survey_questions) \
+        or not 0 <= col_index < len(survey_questions):
+        return ('Invalid rows or cols.', HTTPStatus.BAD_REQUEST)
+    try:
+        where = [parse_crosstab_filter(value, survey_questions) for value in
+                 request.args.getlist('where')]
+    except (ValueError, KeyError):
+        return ('Invalid filter.', HTTPStatus.BAD_REQUEST)
+    try:
+        since = parse_time_arg(request.args.get('since'))
+        until = parse_time_arg(request.args.get('until'))
+    except ValueError:
+        return ('Invalid time range.', HTTPStatus.BAD_REQUEST)
+    return jsonify(build_crosstab(response_columns(storage), row_index,
+                   col_index, since, until, where))
+
+
+@app.route('/write-queue', methods=['GET'])
+def write_queue_stats():
+    if write_queue is None:
+        return jsonify({'write_behind': False})
+    return jsonify(dict(write_queue.stats(), write_behind=True))
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if not METRICS:
+        return ('Metrics are disabled.', HTTPStatus.NOT_FOUND)
+    return Response(prometheus_client.generate_latest(metrics_registry()),
+                    content_type=prometheus_client.CONTENT_TYPE_LATEST)
 
 
-@app.route('/reset', methods=['POST'])
-def reset():
+@app.route('/reset', methods=['POST'],
+           defaults={'survey_id': DEFAULT_SURVEY})
+@app.route('/s/<survey_id>/reset', methods=['POST'])
+def reset(survey_id):
 
     # Reset the session and start new survey
 
-    reset_session()
+    survey_storage(survey_id)
+    reset_session(survey_id)
     return ('', HTTPStatus.NO_CONTENT)  # success, but empty response
 
 
-@app.route('/question', methods=['GET', 'POST'])
-def question():
-    if 'sid' not in session:
-        return redirect(url_for('start'))
+@app.route('/question', methods=['GET', 'POST'],
+           defaults={'survey_id': DEFAULT_SURVEY})
+@app.route('/s/<survey_id>/question', methods=['GET', 'POST'])
+def question(survey_id):
+    survey_storage(survey_id)
+
+    # A session is on one survey at a time; opening another survey's
+    # question starts that survey over
+
+    survey = current_survey(session, survey_id)
+    if survey is None:
+        return redirect(url_for('start', survey_id=survey_id))
     q_index = session.get('q_index', 0)
     error = None
-    current_answer = session['responses'
-                             ].get(questions[q_index].prompt, '')
-    question = questions[q_index]
 
     if request.method == 'POST':
-        answer = request.form.get('response', '').strip()
-        action = request.form.get('action')
-        
-        ## Note, writing all inputs, even empty ones to indicate that
-        ## this is a question the user has seen but is choosing not to answer.
-        ## This does not apply to Mandatory questions which will never have empty answers.
-        if action == 'Next':
-
-            # Valid inputs, can move forward
-
-            if not question.mandatory or question.mandatory and answer \
-                != '':
-                response = parse_and_set_answer(question, q_index,
-                        answer)
-                write_response(response)
-                return navigate(action, q_index)
-            else:
-                error = \
-                    'This is a required question. Please enter a response before you can move on.'
-
-                # clear past responses if any
-
-                session['responses'][question.prompt] = None
-        elif action == 'Back':
-            response = parse_and_set_answer(question, q_index, answer)
-
-            # don't save mandatory unanswered questions. We are saving non-mandatory
-            # blanks to allow the db reader to see these questions were "viewed"
-            # by the user, but deliberately not answered.
-
-            if not question.mandatory or question.mandatory and answer \
-                != '':
-                write_response(response)
-            return navigate(action, q_index)
+        with timed('parse_answer'):
+            (response, endpoint, error) = answer_question(session, survey,
+                    request.form)
 
-        # Fall-through, update current answer in case it changed.
+            # in-place changes to the list aren't seen by the session
 
-        current_answer = session['responses'][question.prompt]
+            session.modified = True
+        if response is not None:
+            with timed('write_response'):
+                write_response(response, survey_id,
+                               request.form.get('nonce', ''))
+        if endpoint is not None:
+            with timed('redirect'):
+                return redirect(url_for(endpoint, survey_id=survey_id))
 
     # Fall-through to GET or insisting user answers a question before moving forward.
-    return render_template('question.html', question=question,
-                           error=error, current_answer=current_answer,
-                           show_back_button=q_index > 0)
+    with timed('render'):
+        return survey.questions[q_index].page.render(
+            session['responses'][q_index], error)
 
 
-@app.route('/done')
-def done():
-    reset_session()
+@app.route('/done', defaults={'survey_id': DEFAULT_SURVEY})
+@app.route('/s/<survey_id>/done')
+def done(survey_id):
+    survey_storage(survey_id)
+    reset_session(survey_id)
     return 'Thank you for your responses!'
 
 #############################################################
@@ -316,46 +3504,176 @@ def done():
 ## Utils
 #############################################################
 
-def reset_session():
+def new_survey(survey_id=DEFAULT_SURVEY):
+
+    # Answers by question index. Whole seconds in UTC, which is also what a
+    # cookie session round-trips, so every session store records the same
+    # start_time.
+
+    survey = surveys.get(survey_id)
+    return {
+        'survey': survey.survey_id,
+        'survey_version': survey.version,
+        'responses': [''] * len(survey.questions),
+        'sid': str(uuid.uuid4()),
+        'start_time': datetime.now(timezone.utc).replace(microsecond=0),
+        'q_index': 0,
+        }
+
+
+def reset_session(survey_id=DEFAULT_SURVEY):
     session.clear()
-    session['responses'] = {}
-    session['sid'] = str(uuid.uuid4())
-    session['start_time'] = datetime.utcnow()
-    session['q_index'] = 0
+    session.update(new_survey(survey_id))
+
+
+def survey_storage(survey_id):
 
+    # The backend of a survey in the URL; 404 for surveys that aren't loaded
 
-def write_response(response):
-    if STORAGE_TYPE == 'csv':
-        return write_response_csv(response)
+    if survey_id not in surveys.surveys:
+        abort(HTTPStatus.NOT_FOUND)
+    return storage_for(survey_id)
+
+
+def write_response(response, survey_id=DEFAULT_SURVEY, nonce=''):
+    return write_responses([response], survey_id, nonce)
+
+
+def write_responses(responses, survey_id=DEFAULT_SURVEY, nonce=''):
+
+    # The answers that aren't duplicates go to storage in one write, or to
+    # the write-behind queue
+
+    responses = fresh_responses(responses, nonce)
+    if not responses:
+        return None
+    error = None
+    if write_queue is not None:
+        for response in responses:
+            error = write_queue.put((survey_id, response),
+                                    WRITE_QUEUE_TIMEOUT)
+            if error is not None:
+                break
+    elif len(responses) == 1:
+        error = storage_for(survey_id).write_answer(responses[0])
     else:
-        return write_response_db(response)
+        error = storage_for(survey_id).write_batch(responses)
+    if error is None:
+        mark_written(responses, nonce)
+        if write_queue is None:
+            notify_changes(survey_id)
+    return error
 
 
-def parse_and_set_answer(question, q_index, answer):
+def fresh_responses(responses, nonce=''):
+
+    # The answers not already written from this page load
+
+    if answer_dedup is None:
+        return responses
+    fresh = []
+    for response in responses:
+        if answer_dedup.unchanged(response, nonce):
+            increment(ANSWERS, ['duplicate'])
+        else:
+            fresh.append(response)
+    return fresh
+
+
+def mark_written(responses, nonce=''):
+    for response in responses:
+        if answer_dedup is not None:
+            answer_dedup.written(response, nonce)
+        increment(ANSWERS, ['written'])
+
+
+def current_survey(state, survey_id):
+
+    # The survey the session in `state` is taking, or None unless it is on
+    # `survey_id`
+
+    if 'sid' not in state or state.get('survey', DEFAULT_SURVEY) \
+        != survey_id:
+        return None
+    return session_survey(state)
+
+
+def answer_question(state, survey, form):
+
+    # Applies a post of the question page to the session in `state`, as
+    # apply_checkpoint() does for the client survey. Returns the answer to
+    # write or None, the endpoint to go to next or None to show the page
+    # again, and the error to show on it.
+
+    q_index = state.get('q_index', 0)
+    question = survey.questions[q_index]
+    answer = form.get('response', '').strip()
+    action = form.get('action')
+
+    # The page says which question it was for. One for another question
+    # is stale, e.g. the second click of a double click once the first
+    # moved a server-side session on, and isn't applied to this one.
+
+    page_index = form.get('q_index')
+    if page_index is not None and page_index.isdigit() \
+        and int(page_index) != q_index:
+        increment(ANSWERS, ['stale_page'])
+        return None, 'question', None
+
+    ## Note, writing all inputs, even empty ones to indicate that
+    ## this is a question the user has seen but is choosing not to answer.
+    ## This does not apply to Mandatory questions which will never have empty answers.
+    if action == 'Next':
+
+        # Valid inputs, can move forward
+
+        if not question.mandatory or question.mandatory and answer != '':
+            response = set_answer(state, question, q_index, answer)
+            return response, move(state, action, q_index), None
+
+        # clear past responses if any
+
+        state['responses'][q_index] = None
+        return None, None, REQUIRED_ANSWER_ERROR
+    elif action == 'Back':
+        response = set_answer(state, question, q_index, answer)
+
+        # don't save mandatory unanswered questions. We are saving non-mandatory
+        # blanks to allow the db reader to see these questions were "viewed"
+        # by the user, but deliberately not answered.
+
+        if question.mandatory and answer == '':
+            response = None
+        return response, move(state, action, q_index), None
+    return None, None, None
+
+
+def set_answer(state, question, q_index, answer):
     if question.type == 'range':
-        session['responses'][question.prompt] = \
-            (int(answer) if answer else None)
+        state['responses'][q_index] = (int(answer) if answer else None)
     else:
-        session['responses'][question.prompt] = \
-            (answer if answer else '')
+        state['responses'][q_index] = (answer if answer else '')
 
     response = {
-        'session_id': session['sid'],
-        'start_time': session['start_time'],
+        'session_id': state['sid'],
+        'start_time': state['start_time'],
         'q_index': q_index,
         'question': question.prompt,
-        'response': session['responses'][question.prompt],
+        'response': state['responses'][q_index],
         }
     return response
 
 
-def navigate(action, q_index):
+def move(state, action, q_index):
+
+    # Moves the survey in `state` and returns the endpoint to go to next
+
     if action == 'Next':
-        if q_index < len(questions) - 1:
-            session['q_index'] += 1
-            return redirect(url_for('question'))
+        if q_index < len(state['responses']) - 1:
+            state['q_index'] += 1
+            return 'question'
         else:
-            return redirect(url_for('done'))
+            return 'done'
     elif action == 'Back':
 
         # note: we strictly don't need to check for q_index > 0 for Back button clicks
@@ -363,8 +3681,8 @@ def navigate(action, q_index):
         # decouple client-server checks
 
         if q_index > 0:
-            session['q_index'] -= 1
-            return redirect(url_for('question'))
+            state['q_index'] -= 1
+            return 'question'
     return None
 
 
@@ -373,9 +3691,32 @@ def navigate(action, q_index):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--storage', choices=['csv', 'db'])
+    parser.add_argument('--storage', choices=sorted(BACKENDS))
+    parser.add_argument('--session-store', choices=['cookie', 'memory',
+                        'sqlite'])
+    parser.add_argument('--answer-dedup', choices=['memory', 'sqlite',
+                        'off'])
+    parser.add_argument('--survey-mode', choices=['server', 'client'],
+                        help='where / starts surveys')
+    parser.add_argument('--write-behind', action='store_true',
+                        help='queue answers and write them in batches')
+    parser.add_argument('--compact', action='store_true',
+                        help='compact the storage log and exit')
     args = parser.parse_args()
     if args.storage:
-        STORAGE_TYPE = args.storage
+        set_storage(args.storage)
     ## no else, storage type is already set from the env or to the default.
+    if args.compact:
+        dropped = sum(storage_for(survey_id).compact() for survey_id in
+                      surveys.surveys)
+        print('Dropped {} overwritten or expired rows.'.format(dropped))
+        sys.exit(0)
+    if args.session_store:
+        set_session_store(args.session_store)
+    if args.answer_dedup:
+        set_answer_dedup(args.answer_dedup)
+    if args.survey_mode:
+        SURVEY_MODE = args.survey_mode
+    if args.write_behind:
+        start_write_behind()
     app.run(debug=True)
@@ -0,0 +1,603 @@
+# Async serving mode for the survey flow on an ASGI server.
+#
+# Serves /, /question, /survey, /api/answers, /results, /results/stream,
+# /reset and /done like app.py, for the default survey and every survey under
+# /s/<survey_id>/, with the same questions, templates, session cookies and
+# storage layout, so it can run against the same files and sessions as the
+# Flask app. The routes share their rules with app.py's (answer_question(),
+# apply_checkpoint(), write_responses()) and storage is app.py's backends, run
+# on threads so they don't block the event loop. Answers from concurrent
+# requests are written together (see GroupCommit), so one worker can carry
+# many survey-takers waiting on storage, and results streams cost a task each
+# rather than a thread. The other routes (export, summary, metrics...) stay on
+# the Flask app.
+#
+# uvicorn asgi:app --workers 4
+# gunicorn -k uvicorn.workers.UvicornWorker --workers 4 asgi:app
+# STORAGE=db uvicorn asgi:app --port 8080
+
+import json
+import asyncio
+import concurrent.futures
+import time
+from urllib.parse import parse_qs, urlencode
+from http import HTTPStatus
+
+from itsdangerous import BadSignature
+from flask.sessions import SecureCookieSessionInterface
+from werkzeug.http import dump_cookie, parse_cookie
+
+import app as survey
+
+#############################################################
+## Storage
+#############################################################
+
+class GroupCommit:
+
+    # Answers that arrive while a batch is being written go out together in
+    # the next batch, so concurrent requests share one transaction, append
+    # or shard instead of queueing for the write lock one by one. Each caller
+    # still waits until its own answer is written, and gets the error the
+    # batch's write returned, if any.
+
+    def __init__(self, write_batch):
+        self.write_batch = write_batch
+        self.pending = []
+        self.lock = asyncio.Lock()
+
+    async def write(self, *responses):
+        written = asyncio.get_running_loop().create_future()
+        self.pending.extend((response, written) for response in responses)
+        async with self.lock:
+            if not written.done():
+                (batch, self.pending) = (self.pending, [])
+                try:
+                    error = await self.write_batch([response for (response,
+                            _) in batch])
+                except Exception as e:
+                    for (_, future) in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for (_, future) in batch:
+                        if not future.done():
+                            future.set_result(error)
+        return await written
+
+
+class AsyncBackend:
+
+    # Runs a survey's backend from app.py off the event loop. Writes go
+    # through GroupCommit to one writer thread, which keeps its own SQLite
+    # connection; reads run on the default thread pool.
+    #
+    # This is what aiosqlite and aiofiles do underneath: aiosqlite runs
+    # each connection's calls on a thread of its own, and aiofiles runs
+    # file calls on the loop's default executor. Using them here meant a
+    # second copy of app.py's SQL, csv locking and rotation, which drifted,
+    # so the async mode uses app.py's backends directly instead.
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = backend.name
+        self.writer = concurrent.futures.ThreadPoolExecutor(1)
+        self.commits = GroupCommit(self.write_batch)
+
+    async def write_batch(self, responses):
+        return await asyncio.get_running_loop().run_in_executor(self.writer,
+                self.backend.write_batch, responses)
+
+    async def results(self, after=None, limit=None, since=None, until=None):
+        return await asyncio.to_thread(lambda: list(
+            self.backend.iter_results(after, limit, since, until)))
+
+    async def close(self):
+        await asyncio.to_thread(self.writer.shutdown)
+
+
+# survey id -> its backend, created on the survey's first use
+backends = {}
+
+
+async def storage_for(survey_id):
+    if survey_id not in backends:
+
+        # app.py sets up the survey's files or tables on first use, which
+        # blocks
+
+        survey_backend = await asyncio.to_thread(survey.storage_for,
+                survey_id)
+        backends.setdefault(survey_id, AsyncBackend(survey_backend))
+    return backends[survey_id]
+
+## Storage
+#############################################################
+
+#############################################################
+## Sessions
+#############################################################
+
+class AsyncSession(dict):
+
+    def __init__(self, data=None, store_sid=None):
+        dict.__init__(self, data or {})
+        self.store_sid = store_sid
+        self.modified = False
+
+
+class CookieSessions:
+
+    # Flask's signed cookie sessions, read and written with the Flask app's
+    # own serializer so both modes understand each other's cookies
+
+    def __init__(self, flask_app):
+        self.name = flask_app.config['SESSION_COOKIE_NAME']
+        self.serializer = \
+            SecureCookieSessionInterface().get_signing_serializer(flask_app)
+        self.max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+
+    async def load(self, cookies):
+        value = cookies.get(self.name)
+        if value:
+            try:
+                return AsyncSession(self.serializer.loads(value,
+                                    max_age=self.max_age))
+            except BadSignature:
+                pass
+        return AsyncSession()
+
+    async def save(self, session):
+        if not session.modified:
+            return None
+        return dump_cookie(self.name, self.serializer.dumps(dict(session)),
+                           httponly=True, path='/')
+
+
+class StoreSessions:
+
+    # Server-side sessions in the store set_session_store() picked; the
+    # SQLite store blocks, so it runs on a thread
+
+    def __init__(self, flask_app, interface):
+        self.name = flask_app.config['SESSION_COOKIE_NAME']
+        self.signer = interface.get_signer(flask_app)
+        self.store = interface.store
+        self.blocking = isinstance(self.store, survey.SqliteSessionStore)
+
+    async def call(self, fn, *args):
+        if self.blocking:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    async def load(self, cookies):
+        value = cookies.get(self.name)
+        if value:
+            try:
+                sid = self.signer.unsign(value).decode()
+            except BadSignature:
+                sid = None
+            data = (await self.call(self.store.get, sid) if sid else None)
+            if data is not None:
+                return AsyncSession(data, sid)
+        return AsyncSession()
+
+    async def save(self, session):
+        sid = session.get('sid')
+        if session.store_sid and session.store_sid != sid:
+            await self.call(self.store.delete, session.store_sid)
+        if not sid:
+            return None
+        if session.modified or session.store_sid != sid:
+            await self.call(self.store.set, sid, dict(session))
+        if session.store_sid != sid:
+            return dump_cookie(self.name, self.signer.sign(sid).decode(),
+                               httponly=True, path='/')
+        return None
+
+
+def session_backend(flask_app):
+    interface = getattr(flask_app.session_interface, 'session_interface',
+                        flask_app.session_interface)
+    if isinstance(interface, survey.ServerSideSessionInterface):
+        return StoreSessions(flask_app, interface)
+    return CookieSessions(flask_app)
+
+
+sessions = session_backend(survey.app)
+
+## Sessions
+#############################################################
+
+#############################################################
+## Routes
+#############################################################
+
+class Request:
+
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = dict((key, values[-1]) for (key, values) in
+                         parse_qs(scope['query_string'].decode()).items())
+        self.headers = dict((key.decode('latin-1'), value.decode('latin-1'))
+                            for (key, value) in scope['headers'])
+        self.cookies = parse_cookie(self.headers.get('cookie', ''))
+
+    async def body(self):
+        body = b''
+        while True:
+            message = await self.receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        return body
+
+    async def form(self):
+        body = await self.body()
+        return dict((key, values[-1]) for (key, values) in
+                    parse_qs(body.decode(), keep_blank_values=True).items())
+
+    async def json(self):
+
+        # None for a body that isn't JSON
+
+        try:
+            return json.loads(await self.body())
+        except ValueError:
+            return None
+
+
+def redirect(location):
+    return (HTTPStatus.FOUND, '', [('location', location)])
+
+
+def html(body, status=HTTPStatus.OK):
+    return (status, body, [('content-type', 'text/html; charset=utf-8')])
+
+
+def text(body, status=HTTPStatus.OK):
+    return (status, body, [('content-type', 'text/plain; charset=utf-8')])
+
+
+def json_response(value, status=HTTPStatus.OK):
+    return (status, json.dumps(value), [('content-type', 'application/json'
+            )])
+
+
+def render(template, **context):
+    return survey.app.jinja_env.get_template(template).render(**context)
+
+
+def survey_url(survey_id, path):
+
+    # the URL of a route for one survey, as url_for() gives it in app.py
+
+    if survey_id == survey.DEFAULT_SURVEY:
+        return path
+    return '/s/{}{}'.format(survey_id, path)
+
+
+def results_url(endpoint, survey_id, **values):
+
+    # url_for() for results.html, which needs a Flask request context
+
+    return survey_url(survey_id, '/results') + '?' + urlencode(dict((key,
+        value) for (key, value) in values.items() if value is not None))
+
+
+async def start(request, session, survey_id):
+    if survey.SURVEY_MODE == 'client':
+        return redirect(survey_url(survey_id, '/survey'))
+    session.clear()
+    session.update(survey.new_survey(survey_id))
+    session.modified = True
+    return redirect(survey_url(survey_id, '/question?q_index=0'))
+
+
+async def question(request, session, survey_id):
+
+    # question() in app.py
+
+    pinned = survey.current_survey(session, survey_id)
+    if pinned is None:
+        return redirect(survey_url(survey_id, '/'))
+    q_index = session.get('q_index', 0)
+    error = None
+
+    if request.method == 'POST':
+        form = await request.form()
+        (response, endpoint, error) = survey.answer_question(session, pinned,
+                form)
+        session.modified = True
+        if response is not None:
+            backend = await storage_for(survey_id)
+            await write_answers(backend, [response], form.get('nonce', ''),
+                                survey_id)
+        if endpoint is not None:
+            return redirect(survey_url(survey_id, '/' + endpoint))
+
+    return html(pinned.questions[q_index].page.render(
+        session['responses'][q_index], error))
+
+
+async def write_answers(backend, responses, nonce, survey_id):
+
+    # write_responses() in app.py, with the write grouped by GroupCommit.
+    # Returns the error storage returned, if any.
+
+    responses = await call_dedup(survey.fresh_responses, responses, nonce)
+    if not responses:
+        return None
+    error = await backend.commits.write(*responses)
+    if error is None:
+        await call_dedup(survey.mark_written, responses, nonce)
+        survey.notify_changes(survey_id)
+    return error
+
+
+async def call_dedup(fn, *args):
+
+    # the SQLite dedup store blocks, so it runs on a thread
+
+    if survey.answer_dedup is not None \
+        and isinstance(survey.answer_dedup.store, survey.SqliteSessionStore):
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+async def client_survey(request, session, survey_id):
+    session.clear()
+    session.update(survey.new_survey(survey_id))
+    session.modified = True
+    return html(survey.surveys.get(survey_id).page)
+
+
+async def api_answers(request, session, survey_id):
+
+    # api_answers() in app.py
+
+    pinned = survey.current_survey(session, survey_id)
+    if pinned is None:
+        return text('No survey in progress.', HTTPStatus.CONFLICT)
+    checkpoint = await request.json()
+    if not isinstance(checkpoint, dict):
+        return text('Invalid checkpoint.', HTTPStatus.BAD_REQUEST)
+    try:
+        applied = survey.apply_checkpoint(session, pinned, checkpoint)
+    except ValueError:
+        return text('Invalid checkpoint.', HTTPStatus.BAD_REQUEST)
+    if applied is None:
+        survey.increment(survey.ANSWERS, ['stale_page'])
+        return json_response(survey.checkpoint_result(0, {}, False))
+    (responses, errors, done) = applied
+    session.modified = True
+    backend = await storage_for(survey_id)
+    error = await write_answers(backend, responses, checkpoint.get('nonce',
+                                ''), survey_id)
+    if error is not None:
+        return text(error, HTTPStatus.INTERNAL_SERVER_ERROR)
+    if done:
+        session.clear()
+        session.update(survey.new_survey(survey_id))
+    return json_response(survey.checkpoint_result(len(responses), errors,
+                         done), (HTTPStatus.UNPROCESSABLE_ENTITY if errors
+                         else HTTPStatus.OK))
+
+
+async def results(request, session, survey_id):
+    after = request.args.get('after')
+    limit = request.args.get('limit')
+    try:
+        after = (survey.decode_cursor(after) if after else None)
+    except (ValueError, TypeError):
+        return text('Invalid cursor.', HTTPStatus.BAD_REQUEST)
+    try:
+        limit = (int(limit) if limit else None)
+    except ValueError:
+        limit = None
+    if limit is not None and limit <= 0:
+        return text('Invalid limit.', HTTPStatus.BAD_REQUEST)
+    try:
+        since = survey.parse_time_arg(request.args.get('since'))
+        until = survey.parse_time_arg(request.args.get('until'))
+    except ValueError:
+        return text('Invalid time range.', HTTPStatus.BAD_REQUEST)
+
+    # as render_results() in app.py; ?stream=1 isn't supported here and
+    # renders the whole table
+
+    backend = await storage_for(survey_id)
+    rows = await backend.results(after, limit, since, until)
+    if not rows and after is None:
+        return html('No responses available.')
+    next_cursor = None
+    if limit is not None and len(rows) == limit:
+        next_cursor = survey.encode_cursor(survey.results_key(rows[-1]))
+    return html(render('results.html', responses=rows,
+                next_cursor=next_cursor, limit=limit, survey_id=survey_id,
+                since=since, until=until, url_for=results_url))
+
+
+async def results_stream(request, session, survey_id):
+
+    # /results/stream in app.py. Streams wait on the event loop rather than
+    # a thread each; the worker's ChangeFeed wakes them from its thread.
+
+    after = request.args.get('after', request.headers.get('last-event-id'))
+    try:
+        after = (int(after) if after else None)
+    except ValueError:
+        return text('Invalid cursor.', HTTPStatus.BAD_REQUEST)
+    return (HTTPStatus.OK, stream_changes(survey_id, after),
+            [('content-type', 'text/event-stream; charset=utf-8'),
+            ('cache-control', 'no-cache')])
+
+
+async def stream_changes(survey_id, after):
+
+    # stream_changes() in app.py
+
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+
+    def wake():
+        loop.call_soon_threadsafe(ready.set)
+
+    feed = survey.change_feed(survey_id)
+    head = await asyncio.to_thread(feed.subscribe, wake)
+    try:
+        after = (head if after is None else after)
+        yield survey.stream_event(after)
+        while True:
+
+            # only catching up from behind the buffer reads storage
+
+            changes = feed.buffered(after)
+            if changes is None:
+                changes = await asyncio.to_thread(feed.changes, after)
+            if changes:
+                after = changes[-1][0]
+                yield survey.stream_event(after, changes)
+                continue
+            try:
+                await asyncio.wait_for(ready.wait(), survey.STREAM_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield survey.STREAM_KEEPALIVE_EVENT
+            ready.clear()
+    finally:
+        feed.unsubscribe(wake)
+
+
+async def reset(request, session, survey_id):
+    session.clear()
+    session.update(survey.new_survey(survey_id))
+    session.modified = True
+    return (HTTPStatus.NO_CONTENT, '', [])
+
+
+async def done(request, session, survey_id):
+    session.clear()
+    session.update(survey.new_survey(survey_id))
+    session.modified = True
+    return html('Thank you for your responses!')
+
+
+ROUTES = {
+    '/': (start, ('GET', 'POST')),
+    '/question': (question, ('GET', 'POST')),
+    '/survey': (client_survey, ('GET', )),
+    '/api/answers': (api_answers, ('POST', )),
+    '/results': (results, ('GET', )),
+    '/results/stream': (results_stream, ('GET', )),
+    '/reset': (reset, ('POST', )),
+    '/done': (done, ('GET', )),
+    }
+
+
+def match(path):
+
+    # (route, survey id) for /<route> and /s/<survey_id>/<route>
+
+    survey_id = survey.DEFAULT_SURVEY
+    if path.startswith('/s/'):
+        (survey_id, slash, path) = path[3:].partition('/')
+        if not slash or survey_id not in survey.surveys.surveys:
+            return None, None
+        path = '/' + path
+    return ROUTES.get(path), survey_id
+
+
+async def handle(scope, receive, send):
+    started = time.perf_counter()
+    request = Request(scope, receive)
+    (route, survey_id) = match(request.path)
+    headers = []
+    if route is None:
+        endpoint = 'unmatched'
+        (status, body, headers) = text('Not Found', HTTPStatus.NOT_FOUND)
+    elif request.method not in route[1]:
+        endpoint = route[0].__name__
+        (status, body, headers) = text('Method Not Allowed',
+                HTTPStatus.METHOD_NOT_ALLOWED)
+    else:
+        (view, methods) = route
+        endpoint = view.__name__
+        session = await sessions.load(request.cookies)
+        (status, body, headers) = await view(request, session, survey_id)
+        cookie = await sessions.save(session)
+        if cookie is not None:
+            headers = headers + [('set-cookie', cookie)]
+    if not isinstance(body, str):
+        await send({
+            'type': 'http.response.start',
+            'status': int(status),
+            'headers': [(key.encode('latin-1'), value.encode('latin-1'))
+                        for (key, value) in headers],
+            })
+        await send_stream(body, receive, send)
+        return
+    body = body.encode()
+    await send({
+        'type': 'http.response.start',
+        'status': int(status),
+        'headers': [(key.encode('latin-1'), value.encode('latin-1'))
+                    for (key, value) in headers] + [(b'content-length',
+                    str(len(body)).encode())],
+        })
+    await send({'type': 'http.response.body', 'body': body})
+    survey.observe(survey.REQUEST_SECONDS, [endpoint, request.method],
+                   time.perf_counter() - started)
+
+
+async def send_stream(body, receive, send):
+
+    # Sends the chunks of an async generator body until it ends or the
+    # client disconnects, which cancels it wherever it is waiting
+
+    async def pump():
+        async for chunk in body:
+            await send({'type': 'http.response.body', 'body': chunk.encode(),
+                       'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    tasks = [asyncio.ensure_future(pump()), asyncio.ensure_future(
+             disconnect())]
+    try:
+        (done, pending) = await asyncio.wait(tasks,
+                return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for task in done:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            for backend in backends.values():
+                await backend.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'http':
+        await handle(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+
+## Routes
+#############################################################
@@ -0,0 +1,119 @@
+# Benchmark of the storage backends in app.BACKENDS on the same workload.
+#
+# For each backend, in a fresh temporary directory: writes --sessions
+# complete surveys one answer at a time (as the question route does without
+# write-behind), writes as many again in batches of --batch (as the
+# write-behind flusher does), then times a first results page, a full
+# results scan, an export, the summary and a crosstab, loading its arrays
+# and then from them.
+#
+# python3 bench/bench_backends.py --sessions=2000 --batch=64
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def generate(app, sessions, prefix):
+    start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    for n in range(sessions):
+        session_id = '{}{:08d}'.format(prefix, n)
+        start_time = str(start + timedelta(seconds=random.randrange(365 * 24
+                         * 3600)))
+        for (q_index, question) in enumerate(app.questions):
+            yield {
+                'session_id': session_id,
+                'start_time': start_time,
+                'q_index': q_index,
+                'question': question.prompt,
+                'response': str(random.randint(1, 6)),
+                }
+
+
+def timed(fn):
+    started = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - started, result
+
+
+def bench_backend(app, name, args):
+    backend = app.set_storage(name)
+    random.seed(0)
+    times = {}
+
+    def write_single():
+        count = 0
+        for answer in generate(app, args.sessions, 'a'):
+            backend.write_answer(answer)
+            count += 1
+        return count
+
+    def write_batched():
+        count = 0
+        batch = []
+        for answer in generate(app, args.sessions, 'b'):
+            batch.append(answer)
+            if len(batch) == args.batch:
+                backend.write_batch(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            backend.write_batch(batch)
+            count += len(batch)
+        return count
+
+    (elapsed, count) = timed(write_single)
+    times['write_answer (/s)'] = count / elapsed
+    (elapsed, count) = timed(write_batched)
+    times['write_batch (/s)'] = count / elapsed
+    (elapsed, rows) = timed(lambda: list(backend.iter_results(None,
+                            args.page)))
+    times['first page (ms)'] = elapsed * 1000
+    (elapsed, rows) = timed(lambda: sum(1 for _ in backend.iter_results()))
+    times['all results (ms)'] = elapsed * 1000
+    (elapsed, rows) = timed(lambda: sum(1 for _ in backend.iter_export()))
+    times['export (ms)'] = elapsed * 1000
+    (elapsed, summary) = timed(backend.summarize)
+    times['summary (ms)'] = elapsed * 1000
+    (elapsed, crosstab) = timed(lambda: app.build_crosstab(
+                                app.response_columns(backend), 0, 1))
+    times['crosstab load (ms)'] = elapsed * 1000
+    (elapsed, crosstab) = timed(lambda: app.build_crosstab(
+                                app.response_columns(backend), 1, 0))
+    times['crosstab (ms)'] = elapsed * 1000
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--storage', action='append',
+                        help='backend to run, repeatable (default: all)')
+    parser.add_argument('--sessions', type=int, default=2000,
+                        help='surveys written by each write pattern')
+    parser.add_argument('--batch', type=int, default=64)
+    parser.add_argument('--page', type=int, default=100)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='survey-backends-')
+    os.environ['CSV_FILE'] = os.path.join(tmp_dir, 'survey_responses.csv')
+    os.environ['DATABASE'] = os.path.join(tmp_dir, 'responses.db')
+    os.environ['LOCAL_BUCKET_DIR'] = os.path.join(tmp_dir, 'bucket')
+    sys.path.insert(0, APP_DIR)
+    import app
+
+    names = args.storage or sorted(app.BACKENDS)
+    results = dict((name, bench_backend(app, name, args)) for name in names)
+    print(('{:<20}' + ' {:>12}' * len(names)).format('', *names))
+    for metric in results[names[0]]:
+        print(('{:<20}' + ' {:>12.1f}' * len(names)).format(metric,
+              *[results[name][metric] for name in names]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,435 @@
+# Load and latency benchmark of the survey flow.
+#
+# For each storage backend and dataset size: seeds the backend with --rows
+# stored answers, then has --clients concurrent clients each run complete
+# surveys the way a browser does (GET /, the question page, Next through
+# every question with one Back, /done) and read a page of /results every
+# --results-every surveys. With --mode=client they take the survey the way
+# the client survey page does instead: GET /survey, then the answers in
+# checkpoints to /api/answers, one every SURVEY_CHECKPOINT_ANSWERS answers
+# and one with the last answer. Requests go either through Flask's test
+# client in this process, or over HTTP to a real gunicorn (sync workers) or
+# uvicorn (the async mode in asgi.py) with --workers processes. Several
+# servers can be given to compare them on the same runs. Reports p50/p95/p99
+# latency per endpoint, overall throughput and requests per survey, and with
+# --output writes the same as JSON, tagged with the git commit, so runs can
+# be compared across commits.
+#
+# python3 bench/bench_load.py --storage=db --rows=10000,100000,1000000
+# python3 bench/bench_load.py --storage=db --mode=server,client
+# python3 bench/bench_load.py --server=gunicorn --workers=4 --clients=16 \
+#     --output=load.json
+# LOCAL_BUCKET_LATENCY=0.02 python3 bench/bench_load.py --storage=object \
+#     --server=gunicorn,uvicorn --workers=2 --clients=64
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import multiprocessing
+import subprocess
+import http.client
+from datetime import datetime, timedelta, timezone
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SEED_BATCH_SIZE = 10000
+STORAGE_TYPES = ['csv', 'db', 'object']
+
+
+def seed(app, name, rows):
+
+    # Seeded sessions start in 2023, so the first /results page reads stored
+    # rows rather than the ones the benchmark writes
+
+    backend = app.set_storage(name)
+    start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    random.seed(0)
+    batch = []
+    for n in range(rows // len(app.questions)):
+        session_id = 'seed{:010d}'.format(n)
+        start_time = str(start + timedelta(seconds=random.randrange(365 * 24
+                         * 3600)))
+        for (q_index, question) in enumerate(app.questions):
+            batch.append({
+                'session_id': session_id,
+                'start_time': start_time,
+                'q_index': q_index,
+                'question': question.prompt,
+                'response': answer_for(question),
+                })
+        if len(batch) >= SEED_BATCH_SIZE:
+            backend.write_batch(batch)
+            batch = []
+    if batch:
+        backend.write_batch(batch)
+    if hasattr(backend, 'merge'):
+        backend.merge()
+
+
+def answer_for(question):
+    if question.type == 'choice':
+        return random.choice(question.options)
+    if question.type == 'range':
+        return str(random.randint(question.range_min, question.range_max))
+    return 'bench'
+
+
+class TestClient:
+
+    def __init__(self, app):
+        self.client = app.app.test_client()
+
+    def request(self, method, path, data=None, payload=None):
+        response = self.client.open(path, method=method, data=data,
+                                    json=payload)
+        response.close()
+        return response.status_code
+
+
+class NoDelayConnection(http.client.HTTPConnection):
+
+    # Requests go out as soon as they're written, see listen()
+
+    def connect(self):
+        super().connect()
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class HttpClient:
+
+    # One connection per client, reopened when gunicorn's sync workers close
+    # it. The session cookie is carried by hand.
+
+    def __init__(self, port):
+        self.conn = NoDelayConnection('127.0.0.1', port, timeout=60)
+        self.cookie = None
+
+    def request(self, method, path, data=None, payload=None):
+        headers = {}
+        body = None
+        if data is not None:
+            body = '&'.join('{}={}'.format(key, value) for (key, value) in
+                            data.items())
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if payload is not None:
+            body = json.dumps(payload)
+            headers['Content-Type'] = 'application/json'
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        try:
+            self.conn.request(method, path, body, headers)
+            response = self.conn.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            self.conn.close()
+            self.conn.request(method, path, body, headers)
+            response = self.conn.getresponse()
+        response.read()
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        if response.getheader('Connection', '').lower() == 'close':
+            self.conn.close()
+        return response.status
+
+
+def run_client(client, questions, surveys, results_every, page, latencies,
+               errors, mode='server', checkpoint_answers=10):
+
+    def timed(label, method, path, data=None, payload=None):
+        started = time.perf_counter()
+        status = client.request(method, path, data, payload)
+        latencies.setdefault(label, []).append(time.perf_counter()
+                - started)
+        if status >= 400:
+            errors.append((label, status))
+
+    for n in range(surveys):
+        if mode == 'client':
+            run_client_survey(timed, questions, n, checkpoint_answers)
+            if results_every and (n + 1) % results_every == 0:
+                timed('results', 'GET', '/results?limit={}'.format(page))
+            continue
+        timed('start', 'GET', '/')
+        timed('question GET', 'GET', '/question')
+        for (q_index, question) in enumerate(questions):
+            timed('question Next', 'POST', '/question',
+                  {'response': answer_for(question), 'action': 'Next'})
+            if q_index == 1:
+                timed('question Back', 'POST', '/question',
+                      {'response': '', 'action': 'Back'})
+                timed('question GET', 'GET', '/question')
+                timed('question Next', 'POST', '/question',
+                      {'response': answer_for(questions[1]),
+                      'action': 'Next'})
+            if q_index < len(questions) - 1:
+                timed('question GET', 'GET', '/question')
+        timed('done', 'GET', '/done')
+        if results_every and (n + 1) % results_every == 0:
+            timed('results', 'GET', '/results?limit={}'.format(page))
+
+
+def run_client_survey(timed, questions, n, checkpoint_answers):
+
+    # What templates/survey.html sends for the same walk through the
+    # questions: Next and Back cost no requests, answers go out once
+    # checkpoint_answers of them are unsent, and the last checkpoint carries
+    # them all
+
+    timed('survey GET', 'GET', '/survey')
+    nonce = 'bench{}-{}'.format(threading.get_ident(), n)
+    answers = {}
+    unsent = set()
+    seq = 0
+    for (q_index, question) in enumerate(questions):
+        answers[q_index] = answer_for(question)
+        unsent.add(q_index)
+        if q_index == 1:
+            answers[q_index] = answer_for(question)
+        if q_index == len(questions) - 1:
+            unsent = set(answers)
+        elif len(unsent) < checkpoint_answers:
+            continue
+        seq += 1
+        done = q_index == len(questions) - 1
+        timed(('checkpoint done' if done else 'checkpoint'), 'POST',
+              '/api/answers', payload={
+            'answers': [{'q_index': sent, 'response': answers[sent]}
+                        for sent in sorted(unsent)],
+            'q_index': q_index,
+            'done': done,
+            'nonce': nonce,
+            'seq': seq,
+            })
+        unsent = set()
+
+
+def percentile(ordered, fraction):
+
+    # nearest rank
+
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered)
+                + 0.5)) - 1))
+    return ordered[index]
+
+
+def latency_stats(samples):
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'mean_ms': sum(ordered) / len(ordered) * 1000,
+        'p50_ms': percentile(ordered, 0.50) * 1000,
+        'p95_ms': percentile(ordered, 0.95) * 1000,
+        'p99_ms': percentile(ordered, 0.99) * 1000,
+        }
+
+
+def listen():
+
+    # The servers are handed a socket bound here with TCP_NODELAY, which
+    # the connections they accept inherit. uvicorn --workers binds its own
+    # without it (asyncio only sets it on sockets it creates), so the body
+    # of every response waited for the client's delayed ACK of the headers,
+    # ~40ms, and that was what runs against it measured.
+
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1024)
+    return listener
+
+
+SERVERS = {
+    'gunicorn': ['gunicorn', '--bind', 'fd://{fd}', '--workers',
+                 '{workers}', '--log-level', 'warning', 'app:app'],
+    'uvicorn': ['uvicorn', '--fd', '{fd}', '--workers', '{workers}',
+                '--log-level', 'warning', 'asgi:app'],
+    }
+
+
+def start_server(server, name, workers, env):
+    listener = listen()
+    port = listener.getsockname()[1]
+    command = [arg.format(fd=listener.fileno(), workers=workers) for arg in
+               SERVERS[server]]
+    proc = subprocess.Popen([sys.executable, '-m'] + command, cwd=APP_DIR,
+                            env=dict(env, STORAGE=name),
+                            pass_fds=[listener.fileno()])
+    listener.close()
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc, port
+        except OSError:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('{} did not start'.format(server))
+
+
+def run(app, name, rows, server, mode, args):
+    started = time.perf_counter()
+    seed(app, name, rows)
+    seeded = time.perf_counter() - started
+
+    proc = None
+    if server in SERVERS:
+        (proc, port) = start_server(server, name, args.workers, os.environ)
+        clients = [HttpClient(port) for _ in range(args.clients)]
+    else:
+        clients = [TestClient(app) for _ in range(args.clients)]
+
+    latencies = [{} for _ in clients]
+    errors = []
+    threads = [threading.Thread(target=run_client, args=(client,
+               app.questions, args.surveys, args.results_every, args.page,
+               latencies[n], errors, mode, app.SURVEY_CHECKPOINT_ANSWERS))
+               for (n, client) in enumerate(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    if proc is not None:
+        proc.terminate()
+        proc.wait()
+
+    by_label = {}
+    for client_latencies in latencies:
+        for (label, samples) in client_latencies.items():
+            by_label.setdefault(label, []).extend(samples)
+    everything = [sample for samples in by_label.values()
+                  for sample in samples]
+    surveys = args.clients * args.surveys
+    return {
+        'server': server,
+        'mode': mode,
+        'workers': (args.workers if server in SERVERS else 1),
+        'storage': name,
+        'rows': rows,
+        'seed_s': seeded,
+        'elapsed_s': elapsed,
+        'requests': len(everything),
+        'errors': len(errors),
+        'throughput_rps': len(everything) / elapsed,
+        'requests_per_survey': (len(everything)
+                                - len(by_label.get('results', []))) / surveys,
+        'all': latency_stats(everything),
+        'endpoints': dict((label, latency_stats(samples)) for (label,
+                          samples) in sorted(by_label.items())),
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=APP_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_run(result):
+    print('{} on {} ({} mode) with {} rows: {} requests in {:.2f}s, {:.0f} '
+          'req/s, {:.1f} per survey, {} errors (seeded in {:.1f}s)'.format(
+          result['storage'], result['server'], result['mode'],
+          result['rows'], result['requests'], result['elapsed_s'],
+          result['throughput_rps'], result['requests_per_survey'],
+          result['errors'], result['seed_s']))
+    print('  {:<16} {:>7} {:>9} {:>9} {:>9}'.format('endpoint', 'count',
+          'p50 ms', 'p95 ms', 'p99 ms'))
+    for (label, stats) in list(result['endpoints'].items()) + [('all',
+            result['all'])]:
+        print('  {:<16} {:>7} {:>9.2f} {:>9.2f} {:>9.2f}'.format(label,
+              stats['count'], stats['p50_ms'], stats['p95_ms'],
+              stats['p99_ms']))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--storage', action='append', choices=STORAGE_TYPES,
+                        help='backend to run, repeatable (default: all)')
+    parser.add_argument('--rows', default='10000',
+                        help='comma-separated stored rows to seed per run')
+    parser.add_argument('--server', default='testclient',
+                        help='comma-separated testclient, gunicorn or uvicorn')
+    parser.add_argument('--mode', default='server',
+                        help='comma-separated server (a request per '
+                        'question) or client (the client survey page)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='server worker processes')
+    parser.add_argument('--clients', type=int, default=1,
+                        help='concurrent clients')
+    parser.add_argument('--surveys', type=int, default=50,
+                        help='surveys completed per client')
+    parser.add_argument('--results-every', type=int, default=10,
+                        help='read a results page every N surveys, 0 for never')
+    parser.add_argument('--page', type=int, default=100)
+    parser.add_argument('--output', help='write the results as JSON here')
+    args = parser.parse_args()
+    servers = args.server.split(',')
+    for server in servers:
+        if server != 'testclient' and server not in SERVERS:
+            parser.error('unknown server {}'.format(server))
+    modes = args.mode.split(',')
+    for mode in modes:
+        if mode not in ('server', 'client'):
+            parser.error('unknown mode {}'.format(mode))
+
+    report = {
+        'commit': git_commit(),
+        'time': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'clients': args.clients,
+        'surveys_per_client': args.surveys,
+        'write_behind': bool(os.getenv('WRITE_BEHIND')),
+        'runs': [],
+        }
+    ctx = multiprocessing.get_context('spawn')
+    for rows in [int(value) for value in args.rows.split(',')]:
+        for name in (args.storage or STORAGE_TYPES):
+            for server in servers:
+                for mode in modes:
+
+                    # each run gets fresh files and a fresh process, since
+                    # the app reads its paths and keeps caches and
+                    # connections from import
+
+                    with ctx.Pool(1) as pool:
+                        result = pool.apply(run_isolated, (name, rows,
+                                            server, mode, args))
+                    print_run(result)
+                    report['runs'].append(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('wrote {}'.format(args.output))
+
+
+def run_isolated(name, rows, server, mode, args):
+    tmp_dir = tempfile.mkdtemp(prefix='survey-load-')
+    os.environ['CSV_FILE'] = os.path.join(tmp_dir, 'survey_responses.csv')
+    os.environ['DATABASE'] = os.path.join(tmp_dir, 'responses.db')
+    os.environ['LOCAL_BUCKET_DIR'] = os.path.join(tmp_dir, 'bucket')
+    os.environ['SESSION_DATABASE'] = os.path.join(tmp_dir, 'sessions.db')
+    os.environ['STORAGE'] = name
+    os.environ['SURVEY_MODE'] = mode
+    sys.path.insert(0, APP_DIR)
+    import app
+    try:
+        return run(app, name, rows, server, mode, args)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# Benchmark of the normalized SQLite schema against the original layout.
+#
+# Builds a database in the original single-table layout (prompt and ISO
+# start_time string in every row), migrates a copy with migrate_db(), and
+# times the results queries on both.
+#
+# python3 bench/bench_schema.py --rows=1000000
+
+import os
+import sys
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+OLD_ORDER = ' ORDER BY start_time, session_id, q_index'
+NEW_ORDER = ' ORDER BY s.start_time, s.session_id, a.q_index'
+
+
+def build_old_db(path, rows, questions):
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE responses '
+                 '(session_id TEXT, start_time TEXT, q_index INTEGER, '
+                 'question TEXT, response TEXT, PRIMARY KEY (session_id, q_index))')
+    start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    random.seed(0)
+
+    def generate():
+        sessions = rows // len(questions)
+        for n in range(sessions):
+            session_id = '{:032x}'.format(random.getrandbits(128))
+            start_time = str(start + timedelta(seconds=random.randrange(
+                             365 * 24 * 3600)))
+            for (q_index, question) in enumerate(questions):
+                yield (session_id, start_time, q_index, question.prompt,
+                       str(random.randint(1, 6)))
+
+    conn.executemany('INSERT INTO responses VALUES (?, ?, ?, ?, ?)',
+                     generate())
+    conn.commit()
+    conn.close()
+
+
+def timed(conn, query, params=(), repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        count = sum(1 for _ in conn.execute(query, params))
+        elapsed = time.perf_counter() - started
+        best = (elapsed if best is None else min(best, elapsed))
+    return best, count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--page', type=int, default=100)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='survey-schema-')
+    os.environ['CSV_FILE'] = os.path.join(tmp_dir, 'unused.csv')
+    os.environ['DATABASE'] = os.path.join(tmp_dir, 'unused.db')
+    sys.path.insert(0, APP_DIR)
+    import app
+
+    old_path = os.path.join(tmp_dir, 'old.db')
+    new_path = os.path.join(tmp_dir, 'new.db')
+    started = time.perf_counter()
+    build_old_db(old_path, args.rows, app.questions)
+    print('built {} rows in {:.1f}s'.format(args.rows,
+          time.perf_counter() - started))
+
+    shutil.copy(old_path, new_path)
+    new = sqlite3.connect(new_path)
+    started = time.perf_counter()
+    new.execute('BEGIN IMMEDIATE')
+    app.create_tables(new)
+    app.migrate_db(new)
+    new.commit()
+    new.execute('VACUUM')
+    print('migrated in {:.1f}s'.format(time.perf_counter() - started))
+    old = sqlite3.connect(old_path)
+
+    # a cursor in the middle of the results, and a one-week time range
+
+    (mid_time, mid_session, mid_q) = old.execute('SELECT start_time, '
+            'session_id, q_index FROM responses' + OLD_ORDER
+            + ' LIMIT 1 OFFSET ?', (args.rows // 2, )).fetchone()
+    mid_epoch = app.to_epoch(mid_time)
+    week_end = str(datetime.fromisoformat(mid_time) + timedelta(days=7))
+
+    cases = [('first page', 'SELECT * FROM responses' + OLD_ORDER
+             + ' LIMIT ?', (args.page, ), app.RESULTS_QUERY_DB + NEW_ORDER
+             + ' LIMIT ?', (args.page, )), ('middle page (keyset)',
+             'SELECT * FROM responses WHERE (start_time, session_id, q_index) > (?, ?, ?)'
+              + OLD_ORDER + ' LIMIT ?', (mid_time, mid_session, mid_q,
+             args.page), app.RESULTS_QUERY_DB
+             + ' WHERE (s.start_time, s.session_id) >= (?, ?) '
+             'AND NOT (s.session_id = ? AND a.q_index <= ?)' + NEW_ORDER
+             + ' LIMIT ?', (mid_epoch, mid_session, mid_session, mid_q,
+             args.page)), ('one week range',
+             'SELECT * FROM responses WHERE start_time >= ? AND start_time < ?'
+              + OLD_ORDER, (mid_time, week_end), app.RESULTS_QUERY_DB
+             + ' WHERE s.start_time >= ? AND s.start_time < ?'
+             + NEW_ORDER, (mid_epoch, app.to_epoch(week_end))),
+             ('all rows in order', 'SELECT * FROM responses' + OLD_ORDER,
+             (), app.RESULTS_QUERY_DB + NEW_ORDER, ())]
+
+    print('{:<22} {:>12} {:>12} {:>9}'.format('query', 'old (ms)',
+          'new (ms)', 'speedup'))
+    for (name, old_query, old_params, new_query, new_params) in cases:
+        (old_time, old_count) = timed(old, old_query, old_params)
+        (new_time, new_count) = timed(new, new_query, new_params)
+        assert old_count == new_count, (name, old_count, new_count)
+        print('{:<22} {:>12.2f} {:>12.2f} {:>8.1f}x'.format(name,
+              old_time * 1000, new_time * 1000, old_time / new_time))
+    print('database size: old {:.1f} MB, new {:.1f} MB'.format(
+          os.path.getsize(old_path) / 1e6, os.path.getsize(new_path) / 1e6))
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
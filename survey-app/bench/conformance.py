@@ -0,0 +1,232 @@
+# Conformance checks for the storage backends in app.BACKENDS.
+#
+# Runs the same sequence of writes and reads against every backend (or the
+# ones given) in a fresh temporary directory and checks that they agree on
+# what the app relies on: last write wins per (session_id, q_index), results
+# order and keyset pages, export and results time filters, summary counts,
+# crosstabs, search, the changes after a cursor, that compaction never
+# changes what is visible (and retention drops only old sessions), and that
+# surveys never see each other's answers. Exits nonzero if any check fails.
+#
+# python3 bench/conformance.py
+# python3 bench/conformance.py --storage=object
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+START = datetime(2023, 5, 1, 12, 0, tzinfo=timezone.utc)
+OTHER_SURVEY = 'other'
+
+
+def make_answer(app, session_id, start_time, q_index, response):
+    return {
+        'session_id': session_id,
+        'start_time': start_time,
+        'q_index': q_index,
+        'question': app.questions[q_index].prompt,
+        'response': response,
+        }
+
+
+def visible(rows):
+    return [(str(row['start_time']), row['session_id'], int(row['q_index']),
+            str(row['response'])) for row in rows]
+
+
+def check_backend(app, name):
+    backend = app.set_storage(name)
+    failures = []
+
+    def expect(label, actual, expected):
+        if actual != expected:
+            failures.append('{}: expected {!r}, got {!r}'.format(label,
+                            expected, actual))
+
+    # three sessions a day apart, written out of order, with overwrites both
+    # across batches and inside one batch
+
+    sessions = [('s{}'.format(n), str(START + timedelta(days=n)))
+                for n in range(3)]
+    expected = {}
+    for (session_id, start_time) in reversed(sessions):
+        for q_index in range(len(app.questions)):
+            backend.write_answer(make_answer(app, session_id, start_time,
+                                 q_index, ''))
+            expected[(session_id, q_index)] = ''
+    (session_id, start_time) = sessions[1]
+    backend.write_batch([make_answer(app, session_id, start_time, 1, 'red'),
+                        make_answer(app, session_id, start_time, 1, 'blue'),
+                        make_answer(app, session_id, start_time, 4, 3)])
+    expected[(session_id, 1)] = 'blue'
+    expected[(session_id, 4)] = '3'
+    backend.write_answer(make_answer(app, session_id, start_time, 4, 5))
+    expected[(session_id, 4)] = '5'
+
+    starts = dict(sessions)
+    want = sorted((starts[session_id], session_id, q_index, response)
+                  for ((session_id, q_index), response) in expected.items())
+
+    rows = visible(backend.iter_results())
+    expect('results', rows, want)
+
+    # keyset pages put together give the same rows
+
+    pages = []
+    after = None
+    while True:
+        page = visible(backend.iter_results(after, 4))
+        if not page:
+            break
+        pages.extend(page)
+        (start_time, session_id, q_index, response) = page[-1]
+        after = (start_time, session_id, q_index)
+    expect('paged results', pages, want)
+
+    # export filters on start time and session
+
+    since = str(START + timedelta(days=1))
+    until = str(START + timedelta(days=2))
+    exported = sorted((str(row[1]), row[0], int(row[2]), str(row[4]))
+                      for row in backend.iter_export(since, until))
+    expect('export since/until', exported, [row for row in want
+           if since <= row[0] < until])
+    exported = sorted((str(row[1]), row[0], int(row[2]), str(row[4]))
+                      for row in backend.iter_export(session_id='s2'))
+    expect('export session', exported, [row for row in want
+           if row[1] == 's2'])
+    expect('results since/until', visible(backend.iter_results(None, None,
+           since, until)), [row for row in want if since <= row[0] < until])
+
+    counts = dict((key, count) for (key, count) in
+                  backend.answer_counts().items() if count)
+    want_counts = {}
+    for ((session_id, q_index), response) in expected.items():
+        key = (q_index, app.summary_bucket(q_index, response))
+        want_counts[key] = want_counts.get(key, 0) + 1
+    expect('answer counts', counts, want_counts)
+    summary = backend.summarize()
+    expect('summary sessions', summary['sessions'], len(sessions))
+
+    # compaction drops overwritten answers only
+
+    backend.compact()
+    expect('results after compaction', visible(backend.iter_results()),
+           want)
+    backend.write_answer(make_answer(app, 's0', starts['s0'], 0, 'Bob'))
+    want = [(row if row[1:3] != ('s0', 0) else row[:3] + ('Bob', ))
+            for row in want]
+    expect('write after compaction', visible(backend.iter_results()), want)
+
+    # crosstabs of the text and range answers follow writes
+
+    def crosstab():
+        return app.build_crosstab(app.response_columns(backend), 1,
+                                  4)['counts']
+
+    expect('crosstab', crosstab(), [[0, 0, 0, 0, 1, 0]])
+    cursor = backend.last_change()
+    backend.write_batch([make_answer(app, 's2', starts['s2'], 1, 'green'),
+                        make_answer(app, 's2', starts['s2'], 4, 2)])
+    want = [(row[:3] + ({1: 'green', 4: '2'}[row[2]], ) if row[1] == 's2'
+            and row[2] in (1, 4) else row) for row in want]
+    expect('crosstab after write', crosstab(), [[0, 1, 0, 0, 1, 0]])
+
+    # changes after a cursor are the answers written since, in order
+
+    changes = backend.changes(cursor)
+    expect('changes', [(row['session_id'], int(row['q_index']),
+           str(row['response'])) for (change, row) in changes], [('s2', 1,
+           'green'), ('s2', 4, '2')])
+    expect('changes cursors', [change for (change, row) in changes][-1:],
+           [backend.last_change()])
+    expect('changes limit', len(backend.changes(None, 3)), 3)
+    expect('changes at head', backend.changes(backend.last_change()), [])
+
+    # search finds the live text answers only
+
+    def search(*terms):
+        return [(row['session_id'], int(row['q_index']), row['response'])
+                for (cursor, row) in backend.search(list(terms))]
+
+    expect('search', search('gre'), [('s2', 1, 'green')])
+    expect('search overwritten', search('red'), [])
+    expect('search prefixes', search('bo') + search('blu'), [('s0', 0,
+           'Bob'), ('s1', 1, 'blue')])
+
+    # newest write first, counting overwrites as new writes
+
+    expect('search order', search('b'), [('s0', 0, 'Bob'), ('s1', 1,
+           'blue')])
+    backend.write_answer(make_answer(app, 's1', starts['s1'], 1, 'blue'))
+    expect('search order after overwrite', search('b'), [('s1', 1, 'blue'),
+           ('s0', 0, 'Bob')])
+
+    # another survey's answers land in its own partition only
+
+    other = app.storage_for(OTHER_SURVEY)
+    answer = make_answer(app, 's0', starts['s0'], 0, 'Eve')
+    other.write_answer(answer)
+    expect('other survey results', visible(other.iter_results()),
+           [(starts['s0'], 's0', 0, 'Eve')])
+    expect('other survey summary', other.summarize()['sessions'], 1)
+    expect('results with another survey', visible(backend.iter_results()),
+           want)
+
+    # retention cut off between the first and second session
+
+    cutoff = START + timedelta(hours=12)
+    app.RETENTION_DAYS = (datetime.now(timezone.utc) - cutoff) \
+        / timedelta(days=1)
+    try:
+        backend.compact()
+    finally:
+        app.RETENTION_DAYS = 0
+    want = [row for row in want if row[1] != 's0']
+    expect('results after retention', visible(backend.iter_results()), want)
+    expect('summary after retention', backend.summarize()['sessions'],
+           len(sessions) - 1)
+    expect('search after retention', search('bob'), [])
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--storage', action='append',
+                        help='backend to check, repeatable (default: all)')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='survey-conformance-')
+    os.environ['CSV_FILE'] = os.path.join(tmp_dir, 'survey_responses.csv')
+    os.environ['DATABASE'] = os.path.join(tmp_dir, 'responses.db')
+    os.environ['LOCAL_BUCKET_DIR'] = os.path.join(tmp_dir, 'bucket')
+
+    # the default survey and a copy of it to check partitioning with
+
+    survey_dir = os.path.join(tmp_dir, 'surveys')
+    os.mkdir(survey_dir)
+    for survey_id in ['default', OTHER_SURVEY]:
+        shutil.copy(os.path.join(APP_DIR, 'surveys', 'default.yaml'),
+                    os.path.join(survey_dir, survey_id + '.yaml'))
+    os.environ['SURVEY_DIR'] = survey_dir
+    sys.path.insert(0, APP_DIR)
+    import app
+
+    failed = False
+    for name in (args.storage or sorted(app.BACKENDS)):
+        failures = check_backend(app, name)
+        print('{}: {}'.format(name, ('ok' if not failures else 'FAILED')))
+        for failure in failures:
+            print('  ' + failure)
+        failed = failed or bool(failures)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
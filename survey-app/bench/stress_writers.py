@@ -0,0 +1,150 @@
+# Multi-process stress test for the storage backends.
+#
+# Starts N worker processes, like gunicorn does, that each run complete
+# surveys through the Flask test client against the same csv file, SQLite
+# database or local bucket. Every survey goes back once to change an answer,
+# and for the log backends another process keeps compacting the log while the
+# writers run. At the end every answer of every survey must be present with
+# its final value.
+#
+# python3 bench/stress_writers.py --storage=csv --workers=8 --sessions=50
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import multiprocessing
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ANSWERS = ['{name}', 'red', 'Dog', 'Apple', '3', '4']
+FINAL_COLOR = 'blue'
+
+
+def load_app(storage):
+    sys.path.insert(0, APP_DIR)
+    import app
+    app.set_storage(storage)
+    return app
+
+
+def run_surveys(storage, worker, sessions):
+    app = load_app(storage)
+    client = app.app.test_client()
+    for n in range(sessions):
+        name = 'w{}-s{}'.format(worker, n)
+        client.get('/')
+        client.post('/question', data={'response': name, 'action': 'Next'})
+        client.post('/question', data={'response': 'red', 'action': 'Next'})
+
+        # go back from the pet question and change the color
+
+        client.post('/question', data={'response': 'Cat', 'action': 'Back'})
+        client.post('/question', data={'response': FINAL_COLOR,
+                    'action': 'Next'})
+        for answer in ANSWERS[2:]:
+            client.post('/question', data={'response': answer,
+                        'action': 'Next'})
+
+    # multiprocessing skips atexit handlers, so flush write-behind explicitly
+
+    app.flush_writes()
+
+
+def compact_forever(storage, stop):
+    app = load_app(storage)
+    while not stop.is_set():
+        app.backend.compact()
+        time.sleep(0.01)
+
+
+def load_rows(app):
+    return [dict(zip(app.EXPORT_COLUMNS, row))
+            for row in app.backend.iter_export()]
+
+
+def check_counts(app, rows):
+
+    # the incrementally maintained summary counts must match the rows
+
+    counts = app.backend.answer_counts()
+    expected = {}
+    for row in rows:
+        key = (int(row['q_index']), app.summary_bucket(int(row['q_index']),
+               row['response']))
+        expected[key] = expected.get(key, 0) + 1
+    return sum(1 for key in set(counts) | set(expected)
+               if counts.get(key, 0) != expected.get(key, 0))
+
+
+def check(rows, workers, sessions):
+    by_session = {}
+    for row in rows:
+        by_session.setdefault(row['session_id'], {})[int(row['q_index'])] = \
+            str(row['response'])
+    names = set()
+    errors = 0
+    for answers in by_session.values():
+        names.add(answers.get(0))
+        if len(answers) != len(ANSWERS) or answers[1] != FINAL_COLOR:
+            errors += 1
+    expected = set('w{}-s{}'.format(w, n) for w in range(workers)
+                   for n in range(sessions))
+    missing = len(expected - names)
+    return missing, errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--storage', choices=['csv', 'db', 'object'],
+                        default='csv')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--sessions', type=int, default=50,
+                        help='surveys completed per worker')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='survey-stress-')
+    os.environ['CSV_FILE'] = os.path.join(tmp_dir, 'survey_responses.csv')
+    os.environ['DATABASE'] = os.path.join(tmp_dir, 'responses.db')
+    os.environ['LOCAL_BUCKET_DIR'] = os.path.join(tmp_dir, 'bucket')
+    ctx = multiprocessing.get_context('spawn')
+
+    started = time.time()
+    procs = [ctx.Process(target=run_surveys, args=(args.storage, w,
+             args.sessions)) for w in range(args.workers)]
+    stop = ctx.Event()
+    if args.storage != 'db':
+        procs.append(ctx.Process(target=compact_forever,
+                     args=(args.storage, stop)))
+    for p in procs:
+        p.start()
+    for p in procs[:args.workers]:
+        p.join()
+    stop.set()
+    for p in procs[args.workers:]:
+        p.join()
+    elapsed = time.time() - started
+
+    failed = [p.exitcode for p in procs if p.exitcode != 0]
+    app = load_app(args.storage)
+    if args.storage == 'object':
+
+        # the workers' shards are only merged on their interval
+
+        app.backend.merge()
+    rows = load_rows(app)
+    missing, errors = check(rows, args.workers, args.sessions)
+    wrong_counts = check_counts(app, rows)
+    answers = args.workers * args.sessions * (len(ANSWERS) + 2)
+    print('{}: {} workers, {} answers in {:.2f}s ({:.0f}/s)'.format(
+        args.storage, args.workers, answers, elapsed, answers / elapsed))
+    print('missing surveys: {}, incomplete or stale surveys: {}, '
+          'wrong summary counts: {}, crashed workers: {}'.format(missing,
+          errors, wrong_counts, len(failed)))
+    if missing or errors or wrong_counts or failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+../survey-app-gcp/fsbucket.py
\ No newline at end of file
@@ -0,0 +1 @@
+../survey-app-gcp/objectstore.py
\ No newline at end of file